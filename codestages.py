@@ -0,0 +1,110 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+
+from config import isInThisCycle, saveConfigJournal
+from datatypes import Status
+from manualsbom import sbomAgentForSubproject
+from manualws import wsAgentBatchForSubprojects, wsAgentForSubproject
+from scheduler import STAGE_FOSSOLOGY_UPLOAD, STAGE_SBOM, STAGE_WS, ZIPPEDCODE_STAGES, getEnabledZippedCodeStages, getReadyStages
+from uploadcode import uploadCodeForSubproject
+
+# Runs one of the stages for the zipped code. Returns True if it's done.
+def runZippedCodeStage(cfg, fossologyServer, prj, sp, stage):
+    try:
+        if stage == STAGE_WS:
+            return wsAgentForSubproject(cfg, prj, sp)
+        elif stage == STAGE_FOSSOLOGY_UPLOAD:
+            return uploadCodeForSubproject(cfg, fossologyServer, prj, sp)
+        elif stage == STAGE_SBOM:
+            return sbomAgentForSubproject(cfg, prj, sp)
+    except Exception:
+        # don't lose what the other stages did
+        print(f"{prj._name}/{sp._name}: unexpected error in stage {stage}")
+        traceback.print_exc()
+        return False
+    print(f"{prj._name}/{sp._name}: unknown stage {stage}")
+    return False
+
+# Runner for ZIPPEDCODE: runs the enabled stages that only need the zipped
+# code -- the WhiteSource agent, the Fossology upload and, if enabled for
+# the project, the sbom agent -- at the same time, rather than one after
+# another. Each stage that finishes is recorded in the subproject's
+# stages-done, so that a failed stage can be tried again without redoing
+# the others. Once all are done, moves on to UPLOADEDCODE. In WhiteSource
+# batch mode, the WhiteSource stage is left for doWSAgentBatch.
+def doZippedCodeStagesForSubproject(cfg, fossologyServer, prj, sp):
+    if sp._status != Status.ZIPPEDCODE:
+        print(f"{prj._name}/{sp._name}: skipping, status is {sp._status.name}, expected ZIPPEDCODE")
+        return True
+    if sp._code_path == "":
+        print(f"{prj._name}/{sp._name}: skipping, no path found for retrieved code")
+        sp._status = Status.STOPPED
+        return True
+
+    enabled = getEnabledZippedCodeStages(cfg, prj, sp)
+    if STAGE_WS not in enabled:
+        print(f"{prj._name}/{sp._name}: skipping WhiteSource, it is disabled")
+    did_something = False
+    while True:
+        ready = getReadyStages(ZIPPEDCODE_STAGES, enabled, sp._stages_done)
+        if cfg._ws_batch and cfg._ws_batch_deferred and STAGE_WS in ready:
+            ready.remove(STAGE_WS)
+        if ready == []:
+            break
+        with ThreadPoolExecutor(max_workers=len(ready)) as pool:
+            futures = [(stage, pool.submit(runZippedCodeStage, cfg, fossologyServer, prj, sp, stage)) for stage in ready]
+            results = [(stage, future.result()) for stage, future in futures]
+        failed = [stage for stage, ok in results if not ok]
+        sp._stages_done.extend([stage for stage, ok in results if ok])
+        if failed != []:
+            print(f"{prj._name}/{sp._name}: stopped, failed stage(s): {', '.join(failed)}")
+            return False
+        did_something = True
+
+    if not all([stage in sp._stages_done for stage in enabled]):
+        if not did_something:
+            print(f"{prj._name}/{sp._name}: waiting for WhiteSource batch")
+        return did_something
+
+    # once we get here, all the stages are done
+    sp._stages_done = []
+    sp._status = Status.UPLOADEDCODE
+
+    # and when we return, the runner framework should update the project's
+    # status to reflect the min of its subprojects
+    return True
+
+# For WhiteSource batch mode: runs the unified agent for all subprojects
+# whose code is zipped and that are only waiting on WhiteSource, in as few
+# agent runs as their products allow, and moves those it ran for on to
+# UPLOADEDCODE. Returns True if it ran for any of them.
+def doWSAgentBatch(scaffold_home, cfg, prj_only, sp_only):
+    from runners import updateProjectPostSubproject
+    did_something = False
+    for prj in cfg._projects.values():
+        if prj_only != "" and prj_only != prj._name:
+            continue
+        waiting = []
+        for sp in prj._subprojects.values():
+            if sp_only != "" and sp_only != sp._name:
+                continue
+            if sp._status != Status.ZIPPEDCODE or not isInThisCycle(cfg, prj, sp):
+                continue
+            enabled = getEnabledZippedCodeStages(cfg, prj, sp)
+            if getReadyStages(ZIPPEDCODE_STAGES, enabled, sp._stages_done) == [STAGE_WS]:
+                waiting.append(sp)
+        if waiting == []:
+            continue
+
+        for sp in wsAgentBatchForSubprojects(cfg, prj, waiting):
+            sp._stages_done.append(STAGE_WS)
+            if all([stage in sp._stages_done for stage in getEnabledZippedCodeStages(cfg, prj, sp)]):
+                sp._stages_done = []
+                sp._status = Status.UPLOADEDCODE
+            saveConfigJournal(scaffold_home, cfg, prj, sp)
+            did_something = True
+        updateProjectPostSubproject(cfg, prj)
+    return did_something
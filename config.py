@@ -3,17 +3,60 @@
 
 import json
 import os
+import time
+from contextlib import contextmanager
 from pathlib import Path
 from shutil import copyfile
 from datetime import date
 
 import yaml
 
+from datefuncs import getYMStr, parseYM, priorMonth
 from datatypes import Config, Finding, JiraSecret, MatchText, Priority, Project, ProjectRepoType, Secrets, SLMCategoryConfig, SLMLicenseConfig, SLMPolicy, Status, Subproject, TicketType, WSSecret
 
+# file alongside config.json that saveConfigJournal appends to
+CONFIG_JOURNAL_FILENAME = "config-journal.jsonl"
+
+# after this many journal records, saveConfigJournal compacts the journal
+# into config.json
+CONFIG_JOURNAL_COMPACT_RECORDS = 200
+
+# file alongside config.json held while writing config.json or its journal
+CONFIG_WRITE_LOCK_FILENAME = "config.json.lock"
+
 def getConfigFilename(scaffoldHome, month):
     return os.path.join(scaffoldHome, month, "config.json")
 
+def getConfigJournalFilename(scaffoldHome, month):
+    return os.path.join(scaffoldHome, month, CONFIG_JOURNAL_FILENAME)
+
+# Reads a month's config.json from f as plain JSON, and brings in the
+# changes journaled since it was last saved. Returns the JSON data and the
+# number of journal records applied.
+def readConfigJSON(f, configFilename):
+    js = json.load(f)
+    journalFilename = os.path.join(os.path.dirname(configFilename), CONFIG_JOURNAL_FILENAME)
+    return js, replayConfigJournal(js, journalFilename)
+
+# Loads the prior month's config.json as plain JSON, with its journal
+# replayed as loadConfig does, but without validating it or needing
+# secrets; returns {} if there isn't one.
+def loadPriorMonthConfigJSON(scaffold_home, cfg):
+    year, month = parseYM(cfg._month)
+    if year == 0 or month == 0:
+        return {}
+    pYear, pMonth = priorMonth(year, month)
+    priorFilename = getConfigFilename(scaffold_home, getYMStr(pYear, pMonth))
+    if not os.path.isfile(priorFilename):
+        return {}
+    try:
+        with open(priorFilename, 'r') as f:
+            js, _ = readConfigJSON(f, priorFilename)
+            return js
+    except json.JSONDecodeError:
+        print(f"Unable to parse prior month config {priorFilename}; ignoring it")
+        return {}
+
 def getMatchesProjectFilename(scaffoldHome, month, prj_name):
     return os.path.join(scaffoldHome, month, f"matches-{prj_name}.json")
 
@@ -180,12 +223,15 @@ def loadSecrets(secrets_file_name = ".scaffold-secrets.json"):
         print(f'Error loading or parsing {secretsFile}: {str(e)}')
         return None
 
-def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secrets.json'):
+# Loads the config for a month. Commands that don't talk to any outside
+# service can pass load_secrets=False, in which case cfg._secrets is None.
+def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secrets.json', load_secrets = True):
     cfg = Config()
 
     try:
         with open(configFilename, 'r') as f:
-            js = json.load(f)
+            # bring in changes journaled since config.json was last saved
+            js, cfg._journal_records = readConfigJSON(f, configFilename)
 
             # Save the secret file name
             cfg._secrets_file = secrets_file_name
@@ -249,6 +295,42 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                 raise RuntimeError(f"No valid wsUnifiedAgentJarPath found in config section")
             # default_env does not need to exist
             cfg._ws_default_env = config_dict.get('wsDefaultEnv', {})
+            # WS API endpoint, rate limit and token cache do not need to exist
+            cfg._ws_api_url = config_dict.get('wsApiUrl', "https://saas.whitesourcesoftware.com/api/v1.3")
+            cfg._ws_api_rate = config_dict.get('wsApiRate', 2)
+            cfg._ws_token_cache_hours = config_dict.get('wsTokenCacheHours', 24)
+            # batch runs of the WS unified agent are off unless specified
+            cfg._ws_batch = config_dict.get('wsBatch', False)
+
+            # worker pool sizes for parallel runs do not need to exist
+            workers_dict = config_dict.get('workers', {})
+            cfg._workers_io = workers_dict.get('io', 0)
+            cfg._workers_cpu = workers_dict.get('cpu', 0)
+            cfg._workers_clone = workers_dict.get('clone', 0)
+            cfg._workers_zip = workers_dict.get('zip', 0)
+
+            # compression level for zipping code does not need to exist
+            cfg._zip_compression_level = config_dict.get('zipCompressionLevel', -1)
+
+            # git mirror cache is off unless specified
+            cfg._git_mirrors = config_dict.get('gitMirrors', False)
+
+            # blob size limit for partial clones; 0 means no limit
+            cfg._clone_blob_limit = config_dict.get('cloneBlobLimit', 0)
+
+            # GitHub code is cloned unless specified
+            cfg._github_retrieval = config_dict.get('githubRetrieval', "clone")
+            if cfg._github_retrieval not in ["clone", "tarball"]:
+                print(f'Invalid githubRetrieval {cfg._github_retrieval} in config section, must be "clone" or "tarball"')
+                raise RuntimeError(f'Invalid githubRetrieval {cfg._github_retrieval} in config section')
+            cfg._github_api_url = config_dict.get('githubApiUrl', "https://api.github.com")
+
+            # carrying forward results for unchanged subprojects is off
+            # unless specified
+            cfg._skip_unchanged = config_dict.get('skipUnchanged', False)
+
+            # batch scheduling of FOSSology jobs is off unless specified
+            cfg._fossology_batch_jobs = config_dict.get('fossologyBatchJobs', False)
             
             # load FOSSOlogy job specified
             defaultJobSpec = {
@@ -274,7 +356,8 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
             cfg._fossology_job_spec = config_dict.get('fossologyJobSpec', defaultJobSpec)
 
             # load secrets
-            cfg._secrets = loadSecrets(secrets_file_name)
+            if load_secrets:
+                cfg._secrets = loadSecrets(secrets_file_name)
 
             # if we get here, main config is at least valid
             cfg._ok = True
@@ -290,11 +373,12 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                 prj = Project()
                 prj._name = prj_name
                 prj._ok = True
-                if not prj_name in cfg._secrets._gitoauth:
+                if cfg._secrets is not None and not prj_name in cfg._secrets._gitoauth:
                 # Update the secrets for any missing project data
                     cfg._secrets._gitoauth[prj_name] = cfg._secrets._default_oauth
                 
                 prj._cycle = prj_dict.get('cycle', 99)
+                prj._clone_workers = prj_dict.get('clone-workers', 0)
 
                 # get project status
                 status_str = prj_dict.get('status', '')
@@ -335,6 +419,9 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                     # now load WS project data
                     parseProjectWSConfig(prj_dict, prj)
 
+                    # now load sbom project data
+                    parseProjectSbomConfig(prj_dict, prj)
+
                     # now load project web data, where applicable
                     parseProjectWebConfig(prj_dict, prj)
 
@@ -366,11 +453,19 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                                 sp._code_path = ""
                                 sp._code_anyfiles = False
                                 sp._code_repos = {}
+                                sp._code_unchanged_from = ""
+                                sp._code_sha1 = ""
+                                sp._code_excluded = {}
+                                sp._code_scan_excluded = {}
                             else:
                                 sp._code_pulled = code_dict.get('pulled', "")
                                 sp._code_path = code_dict.get('path', "")
                                 sp._code_anyfiles = code_dict.get('anyfiles', "")
                                 sp._code_repos = code_dict.get('repos', {})
+                                sp._code_unchanged_from = code_dict.get('unchanged-from', "")
+                                sp._code_sha1 = code_dict.get('sha1', "")
+                                sp._code_excluded = code_dict.get('excluded', {})
+                                sp._code_scan_excluded = code_dict.get('scan-excluded', {})
 
                             # get web data
                             web_dict = sp_dict.get('web', {})
@@ -391,6 +486,12 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                             # now load WS subproject data
                             parseSubprojectWSConfig(sp_dict, prj, sp)
 
+                            # now load FOSSology subproject data
+                            parseSubprojectFossologyConfig(sp_dict, prj, sp)
+
+                            # stages done for the zipped code, if any
+                            sp._stages_done = sp_dict.get('stages-done', [])
+
                             sp_gerrit_dict = sp_dict.get('gerrit', {})
                             if sp_gerrit_dict == {}:
                                 sp._repos = []
@@ -424,6 +525,9 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                     # now load WS project data
                     parseProjectWSConfig(prj_dict, prj)
 
+                    # now load sbom project data
+                    parseProjectSbomConfig(prj_dict, prj)
+
                     # now load project web data, where applicable
                     parseProjectWebConfig(prj_dict, prj)
 
@@ -456,11 +560,19 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                                 sp._code_path = ""
                                 sp._code_anyfiles = False
                                 sp._code_repos = {}
+                                sp._code_unchanged_from = ""
+                                sp._code_sha1 = ""
+                                sp._code_excluded = {}
+                                sp._code_scan_excluded = {}
                             else:
                                 sp._code_pulled = code_dict.get('pulled', "")
                                 sp._code_path = code_dict.get('path', "")
                                 sp._code_anyfiles = code_dict.get('anyfiles', "")
                                 sp._code_repos = code_dict.get('repos', {})
+                                sp._code_unchanged_from = code_dict.get('unchanged-from', "")
+                                sp._code_sha1 = code_dict.get('sha1', "")
+                                sp._code_excluded = code_dict.get('excluded', {})
+                                sp._code_scan_excluded = code_dict.get('scan-excluded', {})
 
                             # get web data
                             web_dict = sp_dict.get('web', {})
@@ -481,6 +593,12 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                             # now load WS subproject data
                             parseSubprojectWSConfig(sp_dict, prj, sp)
 
+                            # now load FOSSology subproject data
+                            parseSubprojectFossologyConfig(sp_dict, prj, sp)
+
+                            # stages done for the zipped code, if any
+                            sp._stages_done = sp_dict.get('stages-done', [])
+
                             # get subproject github-shared details, including repos
                             gs_sp_shared_dict = sp_dict.get('github-shared', {})
                             if gs_sp_shared_dict == {}:
@@ -503,6 +621,9 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                     # now load WS project data
                     parseProjectWSConfig(prj_dict, prj)
 
+                    # now load sbom project data
+                    parseProjectSbomConfig(prj_dict, prj)
+
                     # now load project web data, where applicable
                     parseProjectWebConfig(prj_dict, prj)
 
@@ -537,11 +658,19 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                                 sp._code_path = ""
                                 sp._code_anyfiles = False
                                 sp._code_repos = {}
+                                sp._code_unchanged_from = ""
+                                sp._code_sha1 = ""
+                                sp._code_excluded = {}
+                                sp._code_scan_excluded = {}
                             else:
                                 sp._code_pulled = code_dict.get('pulled', "")
                                 sp._code_path = code_dict.get('path', "")
                                 sp._code_anyfiles = code_dict.get('anyfiles', "")
                                 sp._code_repos = code_dict.get('repos', {})
+                                sp._code_unchanged_from = code_dict.get('unchanged-from', "")
+                                sp._code_sha1 = code_dict.get('sha1', "")
+                                sp._code_excluded = code_dict.get('excluded', {})
+                                sp._code_scan_excluded = code_dict.get('scan-excluded', {})
 
                             # get web data
                             web_dict = sp_dict.get('web', {})
@@ -562,6 +691,12 @@ def loadConfig(configFilename, scaffoldHome, secrets_file_name = '.scaffold-secr
                             # now load WS subproject data
                             parseSubprojectWSConfig(sp_dict, prj, sp)
 
+                            # now load FOSSology subproject data
+                            parseSubprojectFossologyConfig(sp_dict, prj, sp)
+
+                            # stages done for the zipped code, if any
+                            sp._stages_done = sp_dict.get('stages-done', [])
+
                             # get subproject github details
                             github_dict = sp_dict.get('github', {})
                             if github_dict == {}:
@@ -624,6 +759,10 @@ def parseProjectSLMConfig(prj_dict, prj):
         prj._slm_combined_report = prj_slm_dict.get('combinedReport', False)
         prj._slm_extensions_skip = prj_slm_dict.get('extensions-skip', [])
         prj._slm_thirdparty_dirs = prj_slm_dict.get('thirdparty-dirs', [])
+        scan_exclude_dict = prj_slm_dict.get('scan-exclude', {})
+        prj._slm_scan_exclude_globs = scan_exclude_dict.get('globs', [])
+        prj._slm_scan_exclude_max_size = scan_exclude_dict.get('max-size', 0)
+        prj._slm_scan_exclude_mime_types = scan_exclude_dict.get('mime-types', [])
 
         # build policies
         prj._slm_policies = {}
@@ -675,6 +814,11 @@ def parseProjectWSConfig(prj_dict, prj):
     prj._ws_enabled = prj_ws_dict.get("enabled", False)
     prj._ws_env = prj_ws_dict.get("env", {})
 
+def parseProjectSbomConfig(prj_dict, prj):
+    prj_sbom_dict = prj_dict.get('sbom', {})
+    # fine if missing, since the sbom agent is otherwise run by hand
+    prj._sbom_enabled = prj_sbom_dict.get("enabled", False)
+
 def parseProjectWebConfig(prj_dict, prj):
     prj_web_dict = prj_dict.get('web', {})
     # it's okay if there's no web report data; possible we just haven't created it yet
@@ -729,26 +873,64 @@ def parseSubprojectWSConfig(sp_dict, prj, sp):
     sp._ws_override_project = sp_ws_dict.get("override-project", "")
     sp._ws_env = sp_ws_dict.get("env", {})
 
+def parseSubprojectFossologyConfig(sp_dict, prj, sp):
+    sp_fossology_dict = sp_dict.get('fossology', {})
+    # job ID is only present while a scanning job is outstanding
+    sp._fossology_job_id = sp_fossology_dict.get("job-id", -1)
+    # upload ID is present once the code has been uploaded, or an existing
+    # upload of the same zip file was found
+    sp._fossology_upload_id = sp_fossology_dict.get("upload-id", -1)
+
 class ConfigJSONEncoder(json.JSONEncoder):
     def default(self, o): # pylint: disable=method-hidden
         if isinstance(o, Config):
+            config_section = {
+                "storepath": o._storepath,
+                "zippath": o._zippath,
+                "month": o._month,
+                "version": o._version,
+                "spdxGithubOrg": o._spdx_github_org,
+                "spdxGithubSignoff": o._spdx_github_signoff,
+                "webServer": o._web_server,
+                "webServerUsername": o._web_server_username,
+                "webReportsPath": o._web_reports_path,
+                "webReportsUrl": o._web_reports_url,
+                "wsServerUrl": o._ws_server_url,
+                "wsUnifiedAgentJarPath": o._ws_unified_agent_jar_path,
+                "wsDefaultEnv": o._ws_default_env,
+                "fossologyJobSpec": o._fossology_job_spec,
+            }
+            if o._workers_io != 0 or o._workers_cpu != 0 or o._workers_clone != 0 or o._workers_zip != 0:
+                config_section["workers"] = {
+                    "io": o._workers_io,
+                    "cpu": o._workers_cpu,
+                    "clone": o._workers_clone,
+                    "zip": o._workers_zip,
+                }
+            if o._zip_compression_level != -1:
+                config_section["zipCompressionLevel"] = o._zip_compression_level
+            if o._fossology_batch_jobs:
+                config_section["fossologyBatchJobs"] = True
+            if o._git_mirrors:
+                config_section["gitMirrors"] = True
+            if o._clone_blob_limit != 0:
+                config_section["cloneBlobLimit"] = o._clone_blob_limit
+            if o._github_retrieval != "clone":
+                config_section["githubRetrieval"] = o._github_retrieval
+            if o._github_api_url != "https://api.github.com":
+                config_section["githubApiUrl"] = o._github_api_url
+            if o._skip_unchanged:
+                config_section["skipUnchanged"] = True
+            if o._ws_api_url != "https://saas.whitesourcesoftware.com/api/v1.3":
+                config_section["wsApiUrl"] = o._ws_api_url
+            if o._ws_api_rate != 2:
+                config_section["wsApiRate"] = o._ws_api_rate
+            if o._ws_token_cache_hours != 24:
+                config_section["wsTokenCacheHours"] = o._ws_token_cache_hours
+            if o._ws_batch:
+                config_section["wsBatch"] = True
             return {
-                "config": {
-                    "storepath": o._storepath,
-                    "zippath": o._zippath,
-                    "month": o._month,
-                    "version": o._version,
-                    "spdxGithubOrg": o._spdx_github_org,
-                    "spdxGithubSignoff": o._spdx_github_signoff,
-                    "webServer": o._web_server,
-                    "webServerUsername": o._web_server_username,
-                    "webReportsPath": o._web_reports_path,
-                    "webReportsUrl": o._web_reports_url,
-                    "wsServerUrl": o._ws_server_url,
-                    "wsUnifiedAgentJarPath": o._ws_unified_agent_jar_path,
-                    "wsDefaultEnv": o._ws_default_env,
-                    "fossologyJobSpec": o._fossology_job_spec,
-                },
+                "config": config_section,
                 "projects": o._projects,
             }
 
@@ -758,6 +940,9 @@ class ConfigJSONEncoder(json.JSONEncoder):
             if o._cycle != 99:
                 retval["cycle"] = o._cycle
 
+            if o._clone_workers != 0:
+                retval["clone-workers"] = o._clone_workers
+
             # build ticket data, if any
             if o._ticket_type == TicketType.JIRA:
                 retval["ticket-type"] = "jira"
@@ -769,6 +954,15 @@ class ConfigJSONEncoder(json.JSONEncoder):
                 "extensions-skip": o._slm_extensions_skip,
                 "thirdparty-dirs": o._slm_thirdparty_dirs,
             }
+            scan_exclude_section = {}
+            if o._slm_scan_exclude_globs != []:
+                scan_exclude_section["globs"] = o._slm_scan_exclude_globs
+            if o._slm_scan_exclude_max_size != 0:
+                scan_exclude_section["max-size"] = o._slm_scan_exclude_max_size
+            if o._slm_scan_exclude_mime_types != []:
+                scan_exclude_section["mime-types"] = o._slm_scan_exclude_mime_types
+            if scan_exclude_section != {}:
+                slm_section["scan-exclude"] = scan_exclude_section
             retval["slm"] = slm_section
 
             if o._slm_combined_report == True:
@@ -780,6 +974,9 @@ class ConfigJSONEncoder(json.JSONEncoder):
                     }
                     retval["web"] = web_section
 
+            if o._sbom_enabled:
+                retval["sbom"] = {"enabled": True}
+
             # build WS data
             ws_section = {"enabled": o._ws_enabled}
             if o._ws_env != {}:
@@ -840,6 +1037,13 @@ class ConfigJSONEncoder(json.JSONEncoder):
             if o._ws_env != {}:
                 ws_section["env"] = o._ws_env
 
+            # build FOSSology data
+            fossology_section = {}
+            if o._fossology_job_id != -1:
+                fossology_section["job-id"] = o._fossology_job_id
+            if o._fossology_upload_id != -1:
+                fossology_section["upload-id"] = o._fossology_upload_id
+
             if o._repotype == ProjectRepoType.GITHUB:
                 js = {
                     "status": o._status.name,
@@ -860,6 +1064,10 @@ class ConfigJSONEncoder(json.JSONEncoder):
                     js["github"]["branch"] = o._github_branch
                 if ws_section != {}:
                     js["ws"] = ws_section
+                if fossology_section != {}:
+                    js["fossology"] = fossology_section
+                if o._stages_done != []:
+                    js["stages-done"] = sorted(o._stages_done)
                 if o._cycle != 99:
                     js["cycle"] = o._cycle
                 if o._code_pulled != "":
@@ -868,6 +1076,14 @@ class ConfigJSONEncoder(json.JSONEncoder):
                     js["code"]["path"] = o._code_path
                 if o._code_repos != {}:
                     js["code"]["repos"] = o._code_repos
+                if o._code_unchanged_from != "":
+                    js["code"]["unchanged-from"] = o._code_unchanged_from
+                if o._code_sha1 != "":
+                    js["code"]["sha1"] = o._code_sha1
+                if o._code_excluded != {}:
+                    js["code"]["excluded"] = o._code_excluded
+                if o._code_scan_excluded != {}:
+                    js["code"]["scan-excluded"] = o._code_scan_excluded
                 if o._web_html_url != "":
                     js["web"]["htmlurl"] = o._web_html_url
                 if o._web_sbom_url != "":
@@ -894,6 +1110,10 @@ class ConfigJSONEncoder(json.JSONEncoder):
                 }
                 if ws_section != {}:
                     js["ws"] = ws_section
+                if fossology_section != {}:
+                    js["fossology"] = fossology_section
+                if o._stages_done != []:
+                    js["stages-done"] = sorted(o._stages_done)
                 if o._cycle != 99:
                     js["cycle"] = o._cycle
                 if o._code_pulled != "":
@@ -902,6 +1122,14 @@ class ConfigJSONEncoder(json.JSONEncoder):
                     js["code"]["path"] = o._code_path
                 if o._code_repos != {}:
                     js["code"]["repos"] = o._code_repos
+                if o._code_unchanged_from != "":
+                    js["code"]["unchanged-from"] = o._code_unchanged_from
+                if o._code_sha1 != "":
+                    js["code"]["sha1"] = o._code_sha1
+                if o._code_excluded != {}:
+                    js["code"]["excluded"] = o._code_excluded
+                if o._code_scan_excluded != {}:
+                    js["code"]["scan-excluded"] = o._code_scan_excluded
                 if o._web_html_url != "":
                     js["web"]["htmlurl"] = o._web_html_url
                 if o._web_sbom_url != "":
@@ -926,6 +1154,10 @@ class ConfigJSONEncoder(json.JSONEncoder):
                 }
                 if ws_section != {}:
                     js["ws"] = ws_section
+                if fossology_section != {}:
+                    js["fossology"] = fossology_section
+                if o._stages_done != []:
+                    js["stages-done"] = sorted(o._stages_done)
                 if o._cycle != 99:
                     js["cycle"] = o._cycle
                 if o._code_pulled != "":
@@ -934,6 +1166,14 @@ class ConfigJSONEncoder(json.JSONEncoder):
                     js["code"]["path"] = o._code_path
                 if o._code_repos != {}:
                     js["code"]["repos"] = o._code_repos
+                if o._code_unchanged_from != "":
+                    js["code"]["unchanged-from"] = o._code_unchanged_from
+                if o._code_sha1 != "":
+                    js["code"]["sha1"] = o._code_sha1
+                if o._code_excluded != {}:
+                    js["code"]["excluded"] = o._code_excluded
+                if o._code_scan_excluded != {}:
+                    js["code"]["scan-excluded"] = o._code_scan_excluded
                 if o._web_html_url != "":
                     js["web"]["htmlurl"] = o._web_html_url
                 if o._web_sbom_url != "":
@@ -981,20 +1221,180 @@ def saveBackupConfig(scaffoldHome, cfg):
             os.makedirs(backupDir)
         copyfile(configFilename, backupFilename)
 
+        # and the journal, which is part of the current config until saved
+        journalFilename = getConfigJournalFilename(scaffoldHome, cfg._month)
+        if os.path.isfile(journalFilename):
+            copyfile(journalFilename, os.path.join(backupDir, f"config-{cfg._version}-journal.jsonl"))
+
     # now, increment the config version
     cfg._version += 1
 
     # don't save it back to disk yet -- we'll do that later (repeatedly)
 
+# Holds the month's config write lock, so that separate scaffold processes
+# working on different projects don't write config.json or its journal at
+# the same time. Only held briefly, while writing.
+@contextmanager
+def configWriteLock(scaffoldHome, month, timeout=60):
+    lockFilename = os.path.join(scaffoldHome, month, CONFIG_WRITE_LOCK_FILENAME)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lockFilename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                print(f"Timed out waiting for {lockFilename}; if no other scaffold process is running, run the `clearlock` command")
+                raise RuntimeError(f"Timed out waiting for config write lock {lockFilename}")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.remove(lockFilename)
+
+# Returns True if this process holds the lock for the whole project, or
+# for the whole month, and so can change the project's own fields (its
+# status, pending repos, combined reports and so on) as well as its
+# subprojects'.
+def holdsProjectLock(cfg, prj_name):
+    return cfg._lock_scopes is None or (prj_name, "") in cfg._lock_scopes
+
+# Returns the JSON data to save for this config. If the process only holds
+# locks for some projects or subprojects (cfg._lock_scopes), those are
+# taken from cfg and everything else from what is currently on disk, so
+# that changes saved by other processes in the meantime aren't lost. For a
+# subproject, only the subproject is taken from cfg; the project's own
+# fields are left as they are on disk.
+def getConfigJSONToSave(scaffoldHome, cfg):
+    our_js = json.loads(json.dumps(cfg, cls=ConfigJSONEncoder))
+    configFilename = getConfigFilename(scaffoldHome, cfg._month)
+    if cfg._lock_scopes is None or not os.path.isfile(configFilename):
+        return our_js
+
+    with open(configFilename, 'r') as f:
+        js = json.load(f)
+    replayConfigJournal(js, getConfigJournalFilename(scaffoldHome, cfg._month))
+    js['config']['version'] = max(js.get('config', {}).get('version', 0), cfg._version)
+
+    projects_dict = js.setdefault('projects', {})
+    for prj_name, sp_name in cfg._lock_scopes:
+        our_prj_dict = our_js['projects'].get(prj_name, None)
+        if our_prj_dict is None:
+            continue
+        if sp_name == "" or prj_name not in projects_dict:
+            projects_dict[prj_name] = our_prj_dict
+            continue
+        # just this subproject
+        if sp_name in our_prj_dict.get('subprojects', {}):
+            projects_dict[prj_name].setdefault('subprojects', {})[sp_name] = our_prj_dict['subprojects'][sp_name]
+    return js
+
 def saveConfig(scaffoldHome, cfg):
     configFilename = getConfigFilename(scaffoldHome, cfg._month)
 
     # don't increment the config version -- we should have done that
     # by saving a backup
 
-    # save the config file out as json
-    with open(configFilename, "w") as f:
-        json.dump(cfg, f, indent=4, cls=ConfigJSONEncoder)
+    # save the config file out as json, to a temporary file that then
+    # replaces config.json, so that a crash while saving never leaves a
+    # half-written config behind
+    tmpFilename = configFilename + ".tmp"
+    with cfg._lock, configWriteLock(scaffoldHome, cfg._month):
+        js = getConfigJSONToSave(scaffoldHome, cfg)
+        with open(tmpFilename, "w") as f:
+            json.dump(js, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpFilename, configFilename)
+
+        # everything journaled is now in config.json
+        journalFilename = getConfigJournalFilename(scaffoldHome, cfg._month)
+        if os.path.exists(journalFilename):
+            os.remove(journalFilename)
+        cfg._journal_records = 0
+
+# Saves the current state of this project, and of this subproject if one
+# is given, by appending a record to the month's config journal rather
+# than rewriting all of config.json. Use after steps that only change
+# this project and subproject; anything else needs saveConfig. The
+# project's own fields are only saved if this process holds the lock for
+# the whole project.
+def saveConfigJournal(scaffoldHome, cfg, prj, sp=None):
+    record = {
+        "project": prj._name,
+    }
+    if holdsProjectLock(cfg, prj._name):
+        # encode the project's own fields, leaving out its subprojects
+        prj_dict = ConfigJSONEncoder().default(prj)
+        prj_dict.pop("subprojects", None)
+        record["fields"] = prj_dict
+    elif sp is None:
+        return
+    if sp is not None:
+        record["subproject"] = sp._name
+        record["subproject-fields"] = sp
+    line = json.dumps(record, cls=ConfigJSONEncoder)
+
+    with cfg._lock:
+        journalFilename = getConfigJournalFilename(scaffoldHome, cfg._month)
+        with configWriteLock(scaffoldHome, cfg._month):
+            with open(journalFilename, "a") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        cfg._journal_records += 1
+
+        # compact from time to time, so that the journal doesn't keep growing
+        if cfg._journal_records >= CONFIG_JOURNAL_COMPACT_RECORDS:
+            saveConfig(scaffoldHome, cfg)
+
+# Applies the records in the journal, if any, to the JSON data loaded
+# from config.json. Returns the number of records applied.
+def replayConfigJournal(js, journalFilename):
+    if not os.path.isfile(journalFilename):
+        return 0
+
+    numRecords = 0
+    projects_dict = js.get('projects', {})
+    with open(journalFilename, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # a crash while appending can leave a partial last line
+                print(f"Skipping incomplete record in config journal {journalFilename}")
+                continue
+            prj_dict = projects_dict.get(record.get('project', ""), None)
+            if prj_dict is None:
+                print(f"Skipping config journal record for unknown project {record.get('project', '')}")
+                continue
+
+            # records hold the full state of the project's own fields, if
+            # the process that wrote them held the project's lock, and of
+            # the subproject, so just replace them
+            sps_dict = prj_dict.get('subprojects', {})
+            if 'fields' in record:
+                prj_dict.clear()
+                prj_dict.update(record['fields'])
+                prj_dict['subprojects'] = sps_dict
+            sp_name = record.get('subproject', "")
+            if sp_name != "":
+                sps_dict[sp_name] = record.get('subproject-fields', {})
+            numRecords += 1
+
+    return numRecords
+
+# Gives a config loaded with load_secrets=False the secrets that were
+# loaded earlier, e.g. by a long-running process, filling in the default
+# GitHub OAuth token for new projects as loadConfig does.
+def useLoadedSecrets(cfg, secrets):
+    cfg._secrets = secrets
+    if secrets is None:
+        return
+    for prj_name in cfg._projects:
+        if prj_name not in secrets._gitoauth:
+            secrets._gitoauth[prj_name] = secrets._default_oauth
 
 def updateProjectStatusToSubprojectMin(cfg, prj):
     minStatus = Status.MAX
@@ -29,7 +29,7 @@ def doCreateReportForSubproject(cfg, prj, sp):
     categories = loadSLMCategories(prj, sp, jsonPath)
 
     # generate the workbook
-    wb = makeXlsx(categories)
+    wb = makeXlsx(categories, sp._code_scan_excluded)
 
     # was it successful?
     if wb is None:
@@ -74,8 +74,14 @@ def doCreateReportForProject(cfg, prj):
     # load JSON license scan results for combined project data
     categories = loadSLMCategories(prj, None, jsonPath)
 
+    # add up the files each subproject left out of the scan
+    excludedCounts = {}
+    for sp in prj._subprojects.values():
+        for reason, count in sp._code_scan_excluded.items():
+            excludedCounts[reason] = excludedCounts.get(reason, 0) + count
+
     # generate the workbook
-    wb = makeXlsx(categories)
+    wb = makeXlsx(categories, excludedCounts)
 
     # was it successful?
     if wb is None:
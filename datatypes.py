@@ -3,6 +3,7 @@
 
 from enum import Enum
 from datetime import date
+import threading
 
 class ProjectRepoType(Enum):
     UNKNOWN = 0
@@ -33,6 +34,12 @@ class Status(Enum):
     STOPPED = 90
     MAX = 99
 
+# kind of work done to advance a subproject out of a given status
+class StageClass(Enum):
+    NONE = 0
+    IO = 1
+    CPU = 2
+
 class Priority(Enum):
     UNKNOWN = 0
     LOW = 1
@@ -223,6 +230,10 @@ class Project:
         # 99 = not specified, run every month
         self._cycle = 99
 
+        # number of repos to clone at the same time for each subproject;
+        # 0 means use the config-wide setting
+        self._clone_workers = 0
+
         # only if Gerrit
         self._gerrit_apiurl = ""
         self._gerrit_subproject_config = "manual"
@@ -240,13 +251,30 @@ class Project:
         self._slm_policies = {}
         self._slm_extensions_skip = []
         self._slm_thirdparty_dirs = []
+        # files left out of the zip file, so they aren't scanned: globs of
+        # file names or paths, a maximum size in bytes (0 for none), and
+        # globs of MIME types, guessed from the file name
+        self._slm_scan_exclude_globs = []
+        self._slm_scan_exclude_max_size = 0
+        self._slm_scan_exclude_mime_types = []
+
+        # run the sbom agent as part of `run`, alongside the WhiteSource
+        # and Fossology uploads
+        self._sbom_enabled = False
 
         # WhiteSource vars
         self._ws_enabled = False
         self._ws_env = {}
-        ## NOT SAVED, refreshed on each run
+        ## NOT SAVED, loaded from the WS token cache or the API on each run
         self._ws_product_tokens = {}
         self._ws_project_tokens = {}
+        # key of the org token the tokens above are for, "" if not loaded
+        self._ws_tokens_key = ""
+        # when the tokens were got from the API, as seconds since the epoch
+        self._ws_tokens_fetched = 0
+        # whether the tokens were got from the API in this run, rather
+        # than from the cache
+        self._ws_tokens_fresh = False
 
         # web upload vars, only for combined reports
         self._web_combined_uuid = ""
@@ -292,6 +320,25 @@ class Subproject:
         self._code_anyfiles = False
         # mapping of repo name to pulled commit hash
         self._code_repos = {}
+        # month whose results were carried forward, because none of the
+        # repos had changed since then; "" if the code was pulled
+        self._code_unchanged_from = ""
+        # SHA1 of the zip file, which is built the same way each time from
+        # the same code
+        self._code_sha1 = ""
+        # mapping of repo name to what was left out when getting its code:
+        # "dirs" from repo-dirs-delete, and "large-files" over the blob
+        # size limit
+        self._code_excluded = {}
+        # mapping of reason ("glob", "size" or "mime") to number of files
+        # left out of the zip file by the project's scan-exclude policy
+        self._code_scan_excluded = {}
+        # stages for the zipped code ("ws", "fossology-upload", "sbom")
+        # that are done, while the subproject is in ZIPPEDCODE
+        self._stages_done = []
+        # bytes sent, seconds and tries for the last Fossology upload in
+        # this step, for its timing record; not saved in the config
+        self._upload_metrics = {}
 
         # only if GitHub
         self._github_org = ""
@@ -312,6 +359,12 @@ class Subproject:
         self._ws_override_product = ""
         self._ws_override_project = ""
 
+        # FOSSology vars
+        # ID of scanning job scheduled but not yet seen to complete, or -1
+        self._fossology_job_id = -1
+        # ID of the FOSSology upload holding this month's code, or -1
+        self._fossology_upload_id = -1
+
         # web upload vars
         self._web_uuid = ""
         self._web_html_url = ""
@@ -326,12 +379,21 @@ class Subproject:
         self._code_path = ""
         self._code_anyfiles = False
         self._code_repos = {}
+        self._code_unchanged_from = ""
+        self._code_sha1 = ""
+        self._code_excluded = {}
+        self._code_scan_excluded = {}
+        self._stages_done = []
 
         # reset scan-dependent SLM vars
         self._slm_report_xlsx = ""
         self._slm_report_json = ""
         self._slm_pending_lics = []
 
+        # reset FOSSology vars
+        self._fossology_job_id = -1
+        self._fossology_upload_id = -1
+
         # reset web upload vars
         self._web_uuid = ""
         self._web_html_url = ""
@@ -420,6 +482,37 @@ class Config:
         self._ws_server_url = ""
         self._ws_unified_agent_jar_path = ""
         self._ws_default_env = {}
+        # WS API endpoint, most calls per second made to it, and hours
+        # that product and project tokens are cached under storepath for;
+        # 0 means no limit or no cache
+        self._ws_api_url = "https://saas.whitesourcesoftware.com/api/v1.3"
+        self._ws_api_rate = 2
+        self._ws_token_cache_hours = 24
+        # leave the WhiteSource unified agent until the other subprojects
+        # have zipped their code too, and run it for them in batches
+        self._ws_batch = False
+        # worker pool sizes for parallel runs; 0 means use the default
+        self._workers_io = 0
+        self._workers_cpu = 0
+        self._workers_clone = 0
+        self._workers_zip = 0
+        # zlib compression level for zipping code; -1 means zlib's default
+        self._zip_compression_level = -1
+        # keep bare mirrors of repos under storepath, and fetch into them
+        # rather than cloning each month
+        self._git_mirrors = False
+        # blobs bigger than this many bytes aren't fetched when cloning; 0
+        # means no limit
+        self._clone_blob_limit = 0
+        # how GitHub code is retrieved: "clone" with git, or "tarball" of
+        # the top commit over the REST API at github_api_url
+        self._github_retrieval = "clone"
+        self._github_api_url = "https://api.github.com"
+        # carry forward last month's results for subprojects whose repos
+        # haven't changed since
+        self._skip_unchanged = False
+        # schedule FOSSology jobs for all subprojects before waiting for any
+        self._fossology_batch_jobs = False
         self._fossology_job_spec = {
                 "analysis": {
                     "bucket": False,
@@ -443,6 +536,26 @@ class Config:
         # DO NOT OUTPUT THESE TO CONFIG.JSON
         self._secrets = None
         self._secrets_file = None
+        # guards changes to shared state and saving when subprojects
+        # are being run in parallel
+        self._lock = threading.RLock()
+        # number of records in the config journal since config.json was saved
+        self._journal_records = 0
+        # (project, subproject) pairs this process holds locks for, with ""
+        # for a whole project; None if it holds the lock for the whole month
+        self._lock_scopes = None
+        # mapping of (API URL, org, token key) to the org's sorted repos,
+        # shared by subprojects listing the same org in this run
+        self._github_listings = {}
+        # mapping of Gerrit API URL to its active and locked projects,
+        # shared by projects on the same server in this run
+        self._gerrit_listings = {}
+        # mapping of Fossology project folder ID to its uploads by SHA1,
+        # shared by the project's subprojects in this run
+        self._fossology_upload_indexes = {}
+        # in WhiteSource batch mode, whether the unified agent is left for
+        # doWSAgentBatch rather than being run for each subproject
+        self._ws_batch_deferred = True
 
     def __repr__(self):
         is_ok = "OK"
@@ -450,3 +563,13 @@ class Config:
             is_ok = "NOT OK"
 
         return f"Config ({is_ok}): {self._storepath}, PROJECTS: {self._projects}"
+
+    # locks can't be pickled, e.g. when sending the config to a worker process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
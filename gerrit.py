@@ -3,30 +3,170 @@
 
 from collections import defaultdict
 import json
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
 
-def getRepoJSONData(apiurl):
-    url = f"{apiurl}/projects/"
-    r = requests.get(url)
-    if r.status_code != 200:
-        print(f"Error: Got invalid status code {r.status_code} from {url}")
-        return None
-    # skip first few chars, which are added to avoid JSON poisoning problems?
-    return json.loads(r.text[5:])
+# seconds to wait for Gerrit to connect or send more data
+GERRIT_TIMEOUT = 60
+
+# projects per page of a listing
+LISTING_PAGE_SIZE = 500
+
+# characters of a listing read at a time
+LISTING_CHUNK_SIZE = 64 * 1024
+
+# Gerrit starts its JSON responses with this, to guard against XSSI
+XSSI_PREFIX = ")]}'"
+
+# one lock for each Gerrit server being listed, so that projects on the
+# same server wait for one listing rather than each making their own
+_listingLocksLock = threading.Lock()
+_listingLocks = {}
+
+# Yields the (key, value) pairs of the JSON object in the text chunks, as
+# they're read, so that only one value and one chunk are held at a time.
+# Skips prefix if the text starts with it. Raises ValueError if the text
+# isn't a JSON object.
+def iterJSONObjectItems(chunks, prefix=""):
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    # what comes next: the prefix, "{", a key (or "}" if it's the first),
+    # or "," / "}" after a value
+    expect = "prefix" if prefix != "" else "{"
+    first = True
+    while True:
+        while pos < len(buf) and buf[pos].isspace():
+            pos += 1
+        # need more text if the buffer is used up, if the prefix might be
+        # cut off, or if a key and value might be (a number at the end of
+        # the buffer might go on in the next chunk, so a value only counts
+        # once there's something after it)
+        if pos >= len(buf) or (expect == "prefix" and len(buf) - pos < len(prefix)):
+            chunk = next(chunks, None)
+            if chunk is None:
+                if expect == "prefix":
+                    expect = "{"
+                    continue
+                raise ValueError("JSON object ended early")
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
 
-def parseRepoJSONData(rj):
+        if expect == "prefix":
+            if buf.startswith(prefix, pos):
+                pos += len(prefix)
+            expect = "{"
+        elif expect == "{":
+            if buf[pos] != "{":
+                raise ValueError(f"expected JSON object, got {buf[pos:pos+20]!r}")
+            pos += 1
+            expect = "key"
+        elif expect == "next":
+            if buf[pos] == "}":
+                return
+            if buf[pos] != ",":
+                raise ValueError(f"expected ',' or '}}', got {buf[pos:pos+20]!r}")
+            pos += 1
+            expect = "key"
+            first = False
+        else:
+            if buf[pos] == "}" and first:
+                return
+            item = None
+            try:
+                key, end = decoder.raw_decode(buf, pos)
+                while end < len(buf) and buf[end].isspace():
+                    end += 1
+                if end < len(buf):
+                    if buf[end] != ":" or not isinstance(key, str):
+                        raise ValueError(f"expected key, got {buf[pos:pos+20]!r}")
+                    end += 1
+                    while end < len(buf) and buf[end].isspace():
+                        end += 1
+                    value, end = decoder.raw_decode(buf, end)
+                    if end < len(buf):
+                        item = (key, value)
+            except json.JSONDecodeError:
+                item = None
+            if item is None:
+                # the key and value aren't all here yet
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError("JSON object ended early")
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            buf = buf[end:]
+            pos = 0
+            expect = "next"
+
+# Gets a session for the Gerrit REST API, which reuses its connection for
+# each page of a listing.
+def getGerritSession():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Lists the projects on a Gerrit server a page at a time, with each page
+# parsed as it's received. Returns the sorted names of the active and of
+# the locked (read-only) projects, as a dict with "active" and "locked"
+# lists, or None on errors.
+def listGerritRepos(apiurl):
     repos = { 'active': [], 'locked': [] }
-    for repo_name, data in rj.items():
-        state = data.get("state", None)
-        if state == 'ACTIVE':
-            repos['active'].append(repo_name)
-        elif state == 'READ_ONLY':
-            repos['locked'].append(repo_name)
+    start = 0
+    with getGerritSession() as session:
+        while True:
+            url = f"{apiurl}/projects/?n={LISTING_PAGE_SIZE}&S={start}"
+            count = 0
+            more = False
+            try:
+                with session.get(url, stream=True, timeout=GERRIT_TIMEOUT) as r:
+                    if r.status_code != 200:
+                        print(f"Error: Got invalid status code {r.status_code} from {url}")
+                        return None
+                    if r.encoding is None:
+                        r.encoding = "utf-8"
+                    for repo_name, data in iterJSONObjectItems(r.iter_content(chunk_size=LISTING_CHUNK_SIZE, decode_unicode=True), XSSI_PREFIX):
+                        count += 1
+                        state = data.get("state", None)
+                        if state == 'ACTIVE':
+                            repos['active'].append(repo_name)
+                        elif state == 'READ_ONLY':
+                            repos['locked'].append(repo_name)
+                        if data.get("_more_projects", False):
+                            more = True
+            except (requests.RequestException, ValueError, AttributeError) as e:
+                print(f"Error: Unable to list projects from {url}: {e}")
+                return None
+            # a server that doesn't page sends everything at once
+            if count > LISTING_PAGE_SIZE or (count < LISTING_PAGE_SIZE and not more):
+                break
+            start += count
     repos['active'].sort()
     repos['locked'].sort()
     return repos
 
+# Gets the active and locked projects on a Gerrit server, or None on
+# errors. Projects in the same run that are on the same server share one
+# listing, in cfg._gerrit_listings.
+def getGerritRepos(cfg, apiurl):
+    with _listingLocksLock:
+        serverLock = _listingLocks.setdefault(apiurl, threading.Lock())
+    with serverLock:
+        if apiurl not in cfg._gerrit_listings:
+            repos = listGerritRepos(apiurl)
+            if repos is None:
+                return None
+            cfg._gerrit_listings[apiurl] = repos
+        return cfg._gerrit_listings[apiurl]
+
 def splitReposToDict(repos):
     repoDict = defaultdict(list)
     for repo in repos:
@@ -34,13 +174,15 @@ def splitReposToDict(repos):
         repoDict[prefix].append(repo)
     return repoDict
 
-def getGerritRepoDict(apiurl):
-    rj = getRepoJSONData(apiurl)
-    repos = parseRepoJSONData(rj)
+def getGerritRepoDict(cfg, apiurl):
+    repos = getGerritRepos(cfg, apiurl)
+    if repos is None:
+        return None
     repodict = splitReposToDict(repos['active'])
     return dict(repodict)
 
-def getGerritRepoList(apiurl):
-    rj = getRepoJSONData(apiurl)
-    repos = parseRepoJSONData(rj)
-    return repos['active']
+def getGerritRepoList(cfg, apiurl):
+    repos = getGerritRepos(cfg, apiurl)
+    if repos is None:
+        return None
+    return list(repos['active'])
@@ -1,64 +1,436 @@
 # Copyright The Linux Foundation
 # SPDX-License-Identifier: Apache-2.0
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 import os
+import tarfile
 import util
 
 import git
 
 from datatypes import ProjectRepoType, Status
+from github import downloadGithubTarball, getGithubCommit, getGithubSession
+
+# number of repos cloned at the same time for each subproject, unless set
+# in the config
+DEFAULT_CLONE_WORKERS = 4
+
+# Gets ready to resume cloning into ziporg_path, given a mapping of each of
+# the subproject's repos to the folder it gets cloned into. Repos recorded
+# in sp._code_repos whose clones are still there are kept; anything else
+# in ziporg_path, such as a partial clone or a repo that has since been
+# dropped from the subproject, is removed. Returns the set of repos that
+# don't need to be cloned again.
+def prepareRepoCheckpoints(prj, sp, ziporg_path, repoFolders):
+    done = set()
+    for repo, folder in repoFolders.items():
+        # repos are only recorded once fully cloned, exported or downloaded
+        if repo in sp._code_repos and os.path.exists(os.path.join(ziporg_path, folder)):
+            done.add(repo)
+    # forget commits and exclusions for anything we're going to clone again
+    for repo in list(sp._code_repos.keys()):
+        if repo not in done:
+            del sp._code_repos[repo]
+    for repo in list(sp._code_excluded.keys()):
+        if repo not in done:
+            del sp._code_excluded[repo]
+
+    keepFolders = [repoFolders[repo] for repo in done]
+    if os.path.exists(ziporg_path):
+        for entry in os.listdir(ziporg_path):
+            if entry not in keepFolders:
+                entry_path = os.path.join(ziporg_path, entry)
+                if os.path.isdir(entry_path):
+                    util.retry_rmtree(entry_path)
+                else:
+                    os.remove(entry_path)
+    else:
+        os.makedirs(ziporg_path)
+
+    if len(done) > 0:
+        print(f"{prj._name}/{sp._name}: already cloned {len(done)} of {len(repoFolders)} repos, skipping those")
+    return done
+
+# Gets the URL that a repo of this subproject is cloned from.
+def getRepoURL(prj, sp, repo):
+    if prj._repotype == ProjectRepoType.GERRIT:
+        return os.path.join(prj._gerrit_apiurl, repo)
+    elif sp._repotype == ProjectRepoType.GITHUB_SHARED:
+        return f"git@github.com:{prj._github_shared_org}/{repo}.git"
+    return f"git@github.com:{sp._github_org}/{repo}.git"
+
+def getCloneWorkers(cfg, prj):
+    if prj._clone_workers > 0:
+        return prj._clone_workers
+    if cfg._workers_clone > 0:
+        return cfg._workers_clone
+    return DEFAULT_CLONE_WORKERS
+
+# Gets the top commit of the repo cloned into repo_path, or "" if it has
+# none.
+def getTopCommit(repo_path):
+    r = git.Repo(os.path.join(repo_path, ".git"), odbt=git.GitCmdObjectDB)
+    try:
+        if len(r.refs) > 0:
+            cmts = list(r.iter_commits(max_count=1))
+            if len(cmts) > 0:
+                return cmts[0].hexsha
+    except:
+        pass # We'll just leave this as empty.  git throws an exception if there are no commits - issue #49
+    finally:
+        r.close()
+    return ""
+
+# Clones each of the subproject's repos that isn't in done, up to workers
+# at a time. cloneFn(repo) clones one repo and returns its top commit, ""
+# if it has none, or None if it couldn't be cloned. A repo that fails
+# doesn't stop the others. Records the top commits in sp._code_repos, in
+# the same order as sp._repos, and returns the list of repos that failed.
+def cloneRepos(prj, sp, done, workers, cloneFn):
+    todo = [repo for repo in sp._repos if repo not in done]
+    commits = {}
+    failed = []
+    if len(todo) > 0:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(todo)))) as pool:
+            futures = [(repo, pool.submit(cloneFn, repo)) for repo in todo]
+            for repo, future in futures:
+                try:
+                    commit = future.result()
+                except Exception as e:
+                    print(f"{prj._name}/{sp._name}: error cloning {repo}: {e}")
+                    commit = None
+                if commit is None:
+                    failed.append(repo)
+                else:
+                    commits[repo] = commit
+
+    # the commit also marks the repo as done, if it has one
+    code_repos = {}
+    for repo in sp._repos:
+        if repo in done:
+            code_repos[repo] = sp._code_repos[repo]
+        elif commits.get(repo, "") != "":
+            code_repos[repo] = commits[repo]
+    sp._code_repos = code_repos
+
+    if len(failed) > 0:
+        print(f"{prj._name}/{sp._name}: failed to clone {len(failed)} of {len(sp._repos)} repos: {', '.join(failed)}")
+    return failed
+
+# Gets the partial clone filter for a repo with these repo-dirs-delete:
+# blobs over the blob size limit are never fetched, and if there's no
+# limit but there are directories to leave out, blobs are only fetched
+# for the files that are checked out. Returns "" if a full clone will do.
+def getCloneFilter(cfg, dirs):
+    if cfg._clone_blob_limit > 0:
+        return f"blob:limit={cfg._clone_blob_limit}"
+    if len(dirs) > 0:
+        return "blob:none"
+    return ""
+
+def isUnderDirs(path, dirs):
+    for d in dirs:
+        d = d.strip("/")
+        if path == d or path.startswith(d + "/"):
+            return True
+    return False
+
+# Gets the paths of the files in commit whose blobs are missing from the
+# partial clone or mirror r, because they're over the blob size limit,
+# other than those under dirs. This doesn't fetch them.
+def getMissingBlobPaths(r, commit, dirs):
+    missing = set()
+    for line in r.git.rev_list("--objects", "--missing=print", "--no-walk", commit).splitlines():
+        if line.startswith("?"):
+            missing.add(line[1:])
+    if len(missing) == 0:
+        return []
+    paths = []
+    for entry in r.git.ls_tree("-r", "-z", commit).split("\0"):
+        info, _, path = entry.partition("\t")
+        if info.split(" ")[-1] in missing and not isUnderDirs(path, dirs):
+            paths.append(path)
+    return sorted(paths)
+
+# Escapes a path for a sparse-checkout pattern, which is read like a line
+# of .gitignore.
+def escapeSparsePattern(path):
+    escaped = "".join("\\" + c if c in "\\*?[" else c for c in path)
+    if escaped.endswith(" "):
+        escaped = escaped[:-1] + "\\ "
+    return escaped
+
+# Records what was left out of a repo's code in sp._code_excluded.
+def recordExclusions(sp, repo, dirs, largeFiles):
+    excluded = {}
+    if len(dirs) > 0:
+        excluded["dirs"] = sorted(dirs)
+    if len(largeFiles) > 0:
+        excluded["large-files"] = largeFiles
+    if excluded != {}:
+        sp._code_excluded[repo] = excluded
+    else:
+        sp._code_excluded.pop(repo, None)
+
+# Clones git_url into dst_path as a shallow partial clone with filterSpec,
+# and checks out everything but dirs and the files whose blobs weren't
+# fetched, using sparse checkout, so that none of those are transferred.
+# Returns the paths of the files left out for being over the size limit.
+def partialClone(git_url, dst_path, branch, dirs, filterSpec):
+    args = ["--depth=1", "--no-checkout", f"--filter={filterSpec}"]
+    if branch != "":
+        args += ["--branch", branch, "--single-branch"]
+    git.Git().clone(*args, git_url, dst_path)
+    r = git.Repo(dst_path)
+    try:
+        if not r.head.is_valid():
+            # no commits, so nothing to check out
+            return []
+        largeFiles = []
+        if filterSpec.startswith("blob:limit"):
+            largeFiles = getMissingBlobPaths(r, "HEAD", dirs)
+        patterns = ["/*"]
+        patterns += [f"!/{escapeSparsePattern(d.strip('/'))}/" for d in dirs]
+        patterns += [f"!/{escapeSparsePattern(path)}" for path in largeFiles]
+        r.git.config("core.sparseCheckout", "true")
+        os.makedirs(os.path.join(r.git_dir, "info"), exist_ok=True)
+        with open(os.path.join(r.git_dir, "info", "sparse-checkout"), "w") as f:
+            f.write("\n".join(patterns) + "\n")
+        # fetches the blobs for the files being checked out, all at once
+        r.git.read_tree("-mu", "HEAD")
+        return largeFiles
+    finally:
+        r.close()
+
+def getMirrorsPath(cfg, prj, sp):
+    return os.path.join(cfg._storepath, "mirrors", prj._name, sp._name)
+
+# Gets the default branch of the mirror's remote, or "" if it has none,
+# e.g. because the repo is empty.
+def getRemoteDefaultBranch(r):
+    for line in r.git.ls_remote("--symref", "origin", "HEAD").splitlines():
+        if line.startswith("ref: refs/heads/"):
+            return line[len("ref: refs/heads/"):].split("\t")[0]
+    return ""
+
+# Brings the bare mirror of git_url at mirror_path up to date for branch
+# (or the remote's default branch, if ""), creating the mirror if needed,
+# and exports that branch's tree into dst_path, without a .git folder.
+# Only the one branch is fetched, so after the first month this only
+# transfers what has changed. If blob_limit is more than 0, blobs over
+# that many bytes aren't fetched. Those files and dirs are left out of
+# the export. Returns the exported commit, or "" if the repo has no
+# commits, and the paths of the files left out for being over the limit.
+def exportFromMirror(git_url, mirror_path, branch, dst_path, dirs=[], blob_limit=0):
+    if os.path.isdir(mirror_path):
+        r = git.Repo(mirror_path)
+        # in case the repo has moved
+        r.git.remote("set-url", "origin", git_url)
+    else:
+        r = git.Repo.init(mirror_path, bare=True, mkdir=True)
+        r.git.remote("add", "origin", git_url)
+    try:
+        if branch == "":
+            branch = getRemoteDefaultBranch(r)
+        if branch == "":
+            os.makedirs(dst_path)
+            return "", []
+        fetchArgs = ["--no-tags"]
+        if blob_limit > 0:
+            fetchArgs.append(f"--filter=blob:limit={blob_limit}")
+        r.git.fetch(*fetchArgs, "origin", f"+refs/heads/{branch}:refs/heads/{branch}")
+        commit = r.git.rev_parse(f"refs/heads/{branch}^{{commit}}")
+        largeFiles = getMissingBlobPaths(r, commit, dirs) if blob_limit > 0 else []
+        excludes = [f":(exclude,literal){path.strip('/')}" for path in dirs + largeFiles]
+
+        # export to a temporary folder first, so that dst_path only
+        # appears once the export is complete
+        tmp_path = dst_path + ".export"
+        if os.path.exists(tmp_path):
+            util.retry_rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        try:
+            proc = r.git.archive(commit, "--", ".", *excludes, format="tar", as_process=True)
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                if hasattr(tarfile, "tar_filter"):
+                    tar.extractall(tmp_path, filter="tar")
+                else:
+                    tar.extractall(tmp_path)
+            # raises GitCommandError if git archive failed, e.g. partway
+            # through, so that a partial export isn't used
+            proc.wait()
+        except Exception:
+            util.retry_rmtree(tmp_path)
+            raise
+        os.rename(tmp_path, dst_path)
+        return commit, largeFiles
+    finally:
+        r.close()
+
+# Checks whether the mirror at mirror_path is still a sound git repo.
+def isMirrorOK(mirror_path):
+    try:
+        r = git.Repo(mirror_path)
+    except (git.exc.GitError, OSError):
+        return False
+    try:
+        r.git.fsck("--connectivity-only", "--no-progress")
+        return True
+    except git.exc.GitError:
+        return False
+    finally:
+        r.close()
+
+# Gets one repo's code from its mirror into dst_path, for cloneRepos,
+# leaving out its repo-dirs-delete and any files over the blob size limit.
+# If that fails, the repo is left to be tried again; the mirror is kept,
+# since the next try then only fetches what's missing, unless it's
+# corrupt, in which case it's removed so that the next try starts afresh.
+def exportRepoFromMirror(cfg, prj, sp, repo, git_url, mirror_path, branch, dst_path):
+    print(f"{prj._name}/{sp._name}: fetching {git_url}" + (f" branch {branch}" if branch != "" else ""))
+    dirs = sp._repo_dirs_delete.get(repo, [])
+    try:
+        commit, largeFiles = exportFromMirror(git_url, mirror_path, branch, dst_path, dirs, cfg._clone_blob_limit)
+        recordExclusions(sp, repo, dirs, largeFiles)
+        return commit
+    except (git.exc.GitError, tarfile.TarError, OSError) as e:
+        print(f"{prj._name}/{sp._name}: error fetching {git_url}: {e}")
+        if os.path.isdir(mirror_path) and not isMirrorOK(mirror_path):
+            print(f"{prj._name}/{sp._name}: removing corrupt mirror {mirror_path}")
+            util.retry_rmtree(mirror_path)
+        return None
+
+# Removes the subproject's mirrors of repos that aren't in repoFolders,
+# e.g. because they've been dropped from the subproject.
+def pruneMirrors(cfg, prj, sp, repoFolders):
+    mirrors_path = getMirrorsPath(cfg, prj, sp)
+    if not os.path.isdir(mirrors_path):
+        return
+    keep = [f"{folder}.git" for folder in repoFolders.values()]
+    for entry in os.listdir(mirrors_path):
+        if entry not in keep:
+            print(f"{prj._name}/{sp._name}: removing mirror {entry}, no longer in subproject")
+            util.retry_rmtree(os.path.join(mirrors_path, entry))
+
+def getTarballPath(ziporg_path, repo):
+    return os.path.join(ziporg_path, f"{repo}.tar.gz")
+
+# Downloads the tarball of one repo's top commit into ziporg_path, for
+# cloneRepos, over the GitHub REST API rather than with git.
+def fetchGithubTarball(cfg, prj, sp, session, ziporg_path, repo):
+    org = prj._github_shared_org if sp._repotype == ProjectRepoType.GITHUB_SHARED else sp._github_org
+    ref = sp._github_branch if sp._github_branch != "" else "HEAD"
+    commit = getGithubCommit(session, cfg._github_api_url, org, repo, ref)
+    if commit is None or commit == "":
+        return commit
+    print(f"{prj._name}/{sp._name}: downloading {org}/{repo} at {commit}")
+    if not downloadGithubTarball(session, cfg._github_api_url, org, repo, commit, getTarballPath(ziporg_path, repo)):
+        return None
+    # these are left out when zipping
+    recordExclusions(sp, repo, sp._repo_dirs_delete.get(repo, []), [])
+    return commit
+
+# Partially clones one repo into dst_path, for cloneRepos, recording what
+# was left out.
+def partialCloneRepo(prj, sp, repo, git_url, dst_path, branch, dirs, filterSpec):
+    print(f"{prj._name}/{sp._name}: cloning {git_url}" + (f" branch {branch}" if branch != "" else "") + f" with filter {filterSpec}")
+    try:
+        largeFiles = partialClone(git_url, dst_path, branch, dirs, filterSpec)
+    except git.exc.GitError as e:
+        print(f"{prj._name}/{sp._name}: error cloning {git_url}: {e}")
+        return None
+    if len(largeFiles) > 0:
+        print(f"{prj._name}/{sp._name}: left out {len(largeFiles)} files in {repo} over the blob size limit")
+    recordExclusions(sp, repo, dirs, largeFiles)
+    return getTopCommit(dst_path)
+
+# Clones one repo from GitHub into ziporg_path, for cloneRepos.
+def cloneGithubRepo(cfg, prj, sp, ziporg_path, repo):
+    git_url = getRepoURL(prj, sp, repo)
+    if cfg._git_mirrors:
+        mirror_path = os.path.join(getMirrorsPath(cfg, prj, sp), f"{repo}.git")
+        return exportRepoFromMirror(cfg, prj, sp, repo, git_url, mirror_path, sp._github_branch, os.path.join(ziporg_path, repo))
+    dirs = sp._repo_dirs_delete.get(repo, [])
+    filterSpec = getCloneFilter(cfg, dirs)
+    if filterSpec != "":
+        return partialCloneRepo(prj, sp, repo, git_url, os.path.join(ziporg_path, repo), sp._github_branch, dirs, filterSpec)
+    try:
+        if sp._github_branch != "":
+            print(f"{prj._name}/{sp._name}: cloning {git_url} branch {sp._github_branch}")
+            git.Git(ziporg_path).clone(git_url, depth=1, branch=sp._github_branch, single_branch=True)
+        else:
+            print(f"{prj._name}/{sp._name}: cloning {git_url}")
+            git.Git(ziporg_path).clone(git_url, depth=1)
+    except git.exc.GitError as e:
+        print(f"{prj._name}/{sp._name}: error cloning {git_url}: {e}")
+        return None
+    return getTopCommit(os.path.join(ziporg_path, repo))
+
+# Clones one repo from Gerrit into ziporg_path, for cloneRepos.
+def cloneGerritRepo(cfg, prj, sp, ziporg_path, repo):
+    # parse repo name
+    dashName = repo.replace("/", "-")
+    dstFolder = os.path.join(ziporg_path, dashName)
+    gitAddress = os.path.join(prj._gerrit_apiurl, repo)
+    if cfg._git_mirrors:
+        mirror_path = os.path.join(getMirrorsPath(cfg, prj, sp), f"{dashName}.git")
+        return exportRepoFromMirror(cfg, prj, sp, repo, gitAddress, mirror_path, "", dstFolder)
+    dirs = sp._repo_dirs_delete.get(repo, [])
+    filterSpec = getCloneFilter(cfg, dirs)
+    if filterSpec != "":
+        return partialCloneRepo(prj, sp, repo, gitAddress, dstFolder, "", dirs, filterSpec)
+    print(f"{prj._name}/{sp._name}: cloning {gitAddress}")
+    try:
+        git.Repo.clone_from(gitAddress, dstFolder, depth=1)
+    except git.exc.GitError as e:
+        print(f"{prj._name}/{sp._name}: error cloning {gitAddress}: {e}")
+        return None
+    return getTopCommit(dstFolder)
 
 # Runner for GOTLISTING in GITHUB and GITHUB_SHARED
 def doGetRepoCodeForSubproject(cfg, prj, sp):
     # first, get path and make directory (if doesn't exist) for collecting code
     today = datetime.today().strftime("%Y-%m-%d")
     sp_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name)
-    org = ""
     ziporg_path = ""
     if sp._repotype == ProjectRepoType.GITHUB_SHARED:
-        org = prj._github_shared_org
         ziporg_path = os.path.join(sp_path, sp._name)
     elif sp._repotype == ProjectRepoType.GITHUB:
-        org = sp._github_org
         ziporg_path = os.path.join(sp_path, sp._github_ziporg)
-    # clear contents if it's already there
-    if os.path.exists(ziporg_path):
-        util.retry_rmtree(ziporg_path)
-    # and create it if it isn't
-    if not os.path.exists(ziporg_path):
-        os.makedirs(ziporg_path)
+    # keep repos cloned on an earlier try, and clear out everything else
+    if cfg._github_retrieval == "tarball":
+        repoFolders = {repo: os.path.basename(getTarballPath(ziporg_path, repo)) for repo in sp._repos}
+    else:
+        repoFolders = {repo: repo for repo in sp._repos}
+    done = prepareRepoCheckpoints(prj, sp, ziporg_path, repoFolders)
 
-    # clone each repo and remove its .git directory
-    for repo in sp._repos:
-        git_url = f"git@github.com:{org}/{repo}.git"
-        dotgit_path = os.path.join(ziporg_path, repo, ".git")
-        if sp._github_branch != "":
-            print(f"{prj._name}/{sp._name}: cloning {git_url} branch {sp._github_branch}")
-            git.Git(ziporg_path).clone(git_url, depth=1, branch=sp._github_branch, single_branch=True)
-        else:
-            print(f"{prj._name}/{sp._name}: cloning {git_url}")
-            git.Git(ziporg_path).clone(git_url, depth=1)
-        # Record the top commit
-        r = git.Repo(dotgit_path, odbt=git.GitCmdObjectDB)
-        try:
-            cmts = []
-            try:
-                cmts = list(r.iter_commits())
-            except:
-                pass # We'll just leave this as empty.  git throws an exception if there are no commits - issue #49
-            if len(cmts) > 0:
-                sp._code_repos[repo] = cmts[0].hexsha
-        finally:
-            r.close()
+    # clone or download each repo that isn't there yet, several at a time
+    workers = getCloneWorkers(cfg, prj)
+    if cfg._github_retrieval == "tarball":
+        with getGithubSession(cfg._secrets._gitoauth.get(prj._name), workers) as session:
+            failed = cloneRepos(prj, sp, done, workers, partial(fetchGithubTarball, cfg, prj, sp, session, ziporg_path))
+    else:
+        failed = cloneRepos(prj, sp, done, workers, partial(cloneGithubRepo, cfg, prj, sp, ziporg_path))
+        if cfg._git_mirrors:
+            pruneMirrors(cfg, prj, sp, repoFolders)
+
+    # try again next time for the ones that failed, keeping the rest
+    if len(failed) > 0:
+        return False
 
     # before finishing, check and see whether it actually has any files
     anyfiles = False
     gitPattern = ".git"+os.sep
-    for dirpath, _, files in os.walk(ziporg_path):
-        if files and gitPattern not in dirpath and not dirpath.endswith(".git"):
-            anyfiles = True
-            break
+    if cfg._github_retrieval == "tarball":
+        # only repos with commits have tarballs
+        anyfiles = len(sp._code_repos) > 0
+    else:
+        for dirpath, _, files in os.walk(ziporg_path):
+            if files and gitPattern not in dirpath and not dirpath.endswith(".git"):
+                anyfiles = True
+                break
     if not anyfiles:
         print(f"{prj._name}/{sp._name}: skipping, no files found")
         sp._code_anyfiles = False
@@ -81,32 +453,18 @@ def doGetRepoCodeForGerritSubproject(cfg, prj, sp):
     today = datetime.today().strftime("%Y-%m-%d")
     sp_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name)
     ziporg_path = os.path.join(sp_path, sp._name)
-    # clear contents if it's already there
-    if os.path.exists(ziporg_path):
-        util.retry_rmtree(ziporg_path)
-    # and create it if it isn't
-    if not os.path.exists(ziporg_path):
-        os.makedirs(ziporg_path)
+    # keep repos cloned on an earlier try, and clear out everything else
+    repoFolders = {repo: repo.replace("/", "-") for repo in sp._repos}
+    done = prepareRepoCheckpoints(prj, sp, ziporg_path, repoFolders)
 
-    # clone each repo and remove its .git directory
-    for repo in sp._repos:
-        # parse repo name
-        dashName = repo.replace("/", "-")
-        dstFolder = os.path.join(ziporg_path, dashName)
-        gitAddress = os.path.join(prj._gerrit_apiurl, repo)
-        # get repo
-        print(f"{prj._name}/{sp._name}: cloning {gitAddress}")
-        git.Repo.clone_from(gitAddress, dstFolder, depth=1)
-        # also record the top commit
-        dotgit_path = os.path.join(dstFolder, ".git")
-        r = git.Repo(dotgit_path)
-        try:
-            if len(r.refs) > 0:
-                cmts = list(r.iter_commits())
-                if len(cmts) > 0:
-                    sp._code_repos[repo] = cmts[0].hexsha
-        finally:
-            r.close()
+    # clone each repo that isn't there yet, several at a time
+    failed = cloneRepos(prj, sp, done, getCloneWorkers(cfg, prj), partial(cloneGerritRepo, cfg, prj, sp, ziporg_path))
+    if cfg._git_mirrors:
+        pruneMirrors(cfg, prj, sp, repoFolders)
+
+    # try again next time for the ones that failed, keeping the rest
+    if len(failed) > 0:
+        return False
 
     # before zipping it all together, check and see whether it actually has any files
     anyfiles = False
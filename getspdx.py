@@ -5,11 +5,10 @@ import os
 from pathlib import Path
 
 from datatypes import Status, ProjectRepoType
-from runagents import getUploadFolder, getUpload
+from runagents import getUploadForSubproject
 from fossology.obj import ReportFormat
 def doGetSPDXForSubproject(cfg, fossologyServer, prj, sp):
     uploadName = os.path.basename(sp._code_path)
-    uploadFolderName = f"{prj._name}-{cfg._month}"
     spdxFolder = os.path.join(cfg._storepath, cfg._month, "spdx", prj._name)
     spdxFilename = f"{sp._name}-{sp._code_pulled}.spdx"
 
@@ -17,11 +16,7 @@ def doGetSPDXForSubproject(cfg, fossologyServer, prj, sp):
         print(f"{prj._name}/{sp._name}: no code path in config, so no upload name; not running agents")
         return False
 
-    uploadFolder = getUploadFolder(fossologyServer, uploadFolderName)
-    if not uploadFolder:
-        print(f"{prj._name}/{sp._name}: error getting the upload folder for generation of SPDX file")
-        return False
-    upload = getUpload(fossologyServer, uploadFolder, uploadName)
+    _, upload = getUploadForSubproject(cfg, fossologyServer, prj, sp)
     if not upload:
         print(f"{prj._name}/{sp._name}: error getting the upload generation of SPDX file")
         return False
@@ -1,28 +1,30 @@
 # Copyright The Linux Foundation
 # SPDX-License-Identifier: Apache-2.0
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import threading
+from urllib.parse import parse_qs, urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
 
-GITHUB_API_URL = "https://api.github.com"
+# seconds to wait for GitHub to connect or send more data
+GITHUB_TIMEOUT = 60
 
-def getOrgJSONData(gh_oauth_token, org, page):
-    url = f"{GITHUB_API_URL}/orgs/{org}/repos?page={page}&per_page=100"
-    r = requests.get(url, headers={"Authorization": f"token {gh_oauth_token}"})
-    if r.status_code == 200:
-        return r.json()
-
-    # if r is 404, then this might be a user, not an org -- try that instead
-    if r.status_code == 404:
-        user_url = f"{GITHUB_API_URL}/users/{org}/repos?page={page}&per_page=100"
-        r2 = requests.get(user_url, headers={"Authorization": f"token {gh_oauth_token}"})
-        if r2.status_code == 200:
-            return r2.json()
-        print(f"Error: Got invalid status code {r.status_code} from {url}, and {r2.status_code} from {user_url}")
-        return None
+# repos per page of a listing, the most GitHub allows
+LISTING_PAGE_SIZE = 100
 
-    # else just fail
-    print(f"Error: Got invalid status code {r.status_code} from {url}")
-    return None
+# number of pages of a listing fetched at the same time
+LISTING_WORKERS = 4
+
+# one lock for each org being listed, so that subprojects listing the
+# same org at the same time wait for one listing rather than each making
+# their own
+_listingLocksLock = threading.Lock()
+_listingLocks = {}
 
 def parseOrgJSONData(rj):
     repos = []
@@ -33,19 +35,177 @@ def parseOrgJSONData(rj):
     repos.sort()
     return repos
 
-def getGithubRepoList(gh_oauth_token, org):
-    repos = []
-    stillSomeRepos = True
-    page = 1
-    while stillSomeRepos:
-        rj = getOrgJSONData(gh_oauth_token, org, page)
-        gotRepos = parseOrgJSONData(rj)
-        if len(gotRepos) <= 0:
-            stillSomeRepos = False
-            break
-        else:
-            for r in gotRepos:
-                repos.append(r)
+def getListingCachePath(cfg, org):
+    return os.path.join(cfg._storepath, "github-cache", f"{org}.json")
+
+# Gets a key for the token a listing was made with, without storing the
+# token itself, since it decides which private repos are listed.
+def getTokenKey(gh_oauth_token):
+    return hashlib.sha256((gh_oauth_token or "").encode("utf-8")).hexdigest()[:16]
+
+# Loads the cached pages of an org's listing, or {} if there are none for
+# this token.
+def loadListingCache(path, tokenKey):
+    try:
+        with open(path, "r") as f:
+            js = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    if js.get("token", "") != tokenKey:
+        return {}
+    return js
+
+def saveListingCache(path, js):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(js, f, indent=4)
+    os.replace(tmp_path, path)
+
+# Gets the number of the last page from a response's Link header, or
+# `page` if there is no later page.
+def getLastPage(r, page):
+    url = r.links.get("last", {}).get("url", "")
+    pages = parse_qs(urlparse(url).query).get("page", [])
+    if len(pages) > 0 and pages[0].isdigit():
+        return int(pages[0])
+    return page
+
+# Gets one page of the repos of an org ("orgs") or user ("users"), sending
+# the ETag of the cached page, if any, so that an unchanged page costs a
+# 304 that doesn't count against the rate limit. Returns the status code
+# and the page, as a dict with its "etag", "repos" and, for the first
+# page, the "last" page number; the page is None on errors.
+def getListingPage(session, api_url, kind, org, page, cached):
+    url = f"{api_url}/{kind}/{org}/repos?page={page}&per_page={LISTING_PAGE_SIZE}"
+    headers = {"Accept": "application/vnd.github+json"}
+    if cached and cached.get("etag", "") != "":
+        headers["If-None-Match"] = cached["etag"]
+    try:
+        r = session.get(url, headers=headers, timeout=GITHUB_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Error: Unable to get {url}: {e}")
+        return None, None
+    if r.status_code == 304 and cached:
+        return r.status_code, cached
+    if r.status_code != 200:
+        return r.status_code, None
+    return r.status_code, {
+        "etag": r.headers.get("ETag", ""),
+        "repos": parseOrgJSONData(r.json()),
+        "last": getLastPage(r, page),
+    }
+
+# Lists the repos of a GitHub org, or of a user if there's no such org.
+# Once the first page says how many there are, the other pages are fetched
+# at the same time, all with conditional requests against the ETags cached
+# under storepath. Returns the sorted repo names, or None on errors.
+def listGithubRepos(cfg, gh_oauth_token, org):
+    tokenKey = getTokenKey(gh_oauth_token)
+    cachePath = getListingCachePath(cfg, org)
+    cache = loadListingCache(cachePath, tokenKey)
+    kind = cache.get("kind", "orgs")
+    cachedPages = cache.get("pages", {})
+
+    with getGithubSession(gh_oauth_token, LISTING_WORKERS) as session:
+        code, first = getListingPage(session, cfg._github_api_url, kind, org, 1, cachedPages.get("1"))
+        # if it isn't an org, then this might be a user -- try that instead
+        if code == 404 and kind == "orgs":
+            kind = "users"
+            cachedPages = {}
+            code, first = getListingPage(session, cfg._github_api_url, kind, org, 1, None)
+        if first is None:
+            print(f"Error: Got invalid status code {code} listing repos for {org}")
+            return None
+
+        pages = {1: first}
+        if first["last"] > 1:
+            with ThreadPoolExecutor(max_workers=LISTING_WORKERS) as pool:
+                futures = [(page, pool.submit(getListingPage, session, cfg._github_api_url, kind, org, page, cachedPages.get(str(page)))) for page in range(2, first["last"] + 1)]
+                for page, future in futures:
+                    code, pages[page] = future.result()
+                    if pages[page] is None:
+                        print(f"Error: Got invalid status code {code} listing page {page} of repos for {org}")
+                        return None
+        # repos added since the first page was cached can spill over onto
+        # pages after the last one it knew about
+        page = max(pages.keys())
+        while len(pages[page]["repos"]) >= LISTING_PAGE_SIZE:
             page += 1
+            code, pages[page] = getListingPage(session, cfg._github_api_url, kind, org, page, cachedPages.get(str(page)))
+            if pages[page] is None:
+                print(f"Error: Got invalid status code {code} listing page {page} of repos for {org}")
+                return None
 
-    return repos
+    try:
+        saveListingCache(cachePath, {"token": tokenKey, "kind": kind, "pages": {str(page): p for page, p in pages.items()}})
+    except OSError as e:
+        print(f"Unable to cache listing of repos for {org}: {e}")
+
+    repos = set()
+    for p in pages.values():
+        repos.update(p["repos"])
+    return sorted(repos)
+
+# Gets the sorted names of the repos in a GitHub org (or user's repos),
+# or None on errors. Subprojects in the same run that list the same org
+# share one listing, in cfg._github_listings.
+def getGithubRepoList(cfg, gh_oauth_token, org):
+    key = (cfg._github_api_url, org, getTokenKey(gh_oauth_token))
+    with _listingLocksLock:
+        orgLock = _listingLocks.setdefault(key, threading.Lock())
+    with orgLock:
+        if key not in cfg._github_listings:
+            repos = listGithubRepos(cfg, gh_oauth_token, org)
+            if repos is None:
+                return None
+            cfg._github_listings[key] = repos
+        return list(cfg._github_listings[key])
+
+# Gets a session for the GitHub REST API, with room in its connection pool
+# for `workers` requests at a time, so that they reuse connections.
+def getGithubSession(gh_oauth_token, workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max(1, workers), pool_maxsize=max(1, workers))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if gh_oauth_token:
+        session.headers["Authorization"] = f"token {gh_oauth_token}"
+    return session
+
+# Gets the commit that ref (a branch, or "HEAD" for the default branch)
+# points to in org/repo. Returns "" if the repo is empty, or None if the
+# commit couldn't be found.
+def getGithubCommit(session, api_url, org, repo, ref):
+    url = f"{api_url}/repos/{org}/{repo}/commits/{ref}"
+    try:
+        r = session.get(url, headers={"Accept": "application/vnd.github.sha"}, timeout=GITHUB_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Error: Unable to get {url}: {e}")
+        return None
+    if r.status_code == 200:
+        return r.text.strip()
+    # GitHub says 409 Conflict for repos with no commits
+    if r.status_code == 409:
+        return ""
+    print(f"Error: Got invalid status code {r.status_code} from {url}")
+    return None
+
+# Downloads the tarball of org/repo at commit to dst_path, as it's
+# received. Returns True if it was downloaded.
+def downloadGithubTarball(session, api_url, org, repo, commit, dst_path):
+    url = f"{api_url}/repos/{org}/{repo}/tarball/{commit}"
+    tmp_path = dst_path + ".part"
+    try:
+        with session.get(url, stream=True, timeout=GITHUB_TIMEOUT) as r:
+            if r.status_code != 200:
+                print(f"Error: Got invalid status code {r.status_code} from {url}")
+                return False
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+    except (requests.RequestException, OSError) as e:
+        print(f"Error: Unable to download {url}: {e}")
+        return False
+    os.replace(tmp_path, dst_path)
+    return True
@@ -0,0 +1,73 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from datetime import datetime
+import glob
+import os
+
+from config import CONFIG_WRITE_LOCK_FILENAME
+
+LOCK_FILE_NAME = "lock.lock"
+
+def get_lock_filename(config_dir, prj_name="", sp_name=""):
+    ''' Gets the lock file name for the month, or for one project or subproject in it
+    '''
+    if prj_name == "":
+        return os.path.join(config_dir, LOCK_FILE_NAME)
+    if sp_name == "":
+        return os.path.join(config_dir, f"lock@{prj_name}.lock")
+    return os.path.join(config_dir, f"lock@{prj_name}@{sp_name}.lock")
+
+def get_lock_scope(lock_filename):
+    ''' Gets the (project, subproject) names a lock file is for, with "" for the month or whole project
+    '''
+    parts = os.path.basename(lock_filename)[len("lock"):-len(".lock")].split("@")
+    return (parts[1] if len(parts) > 1 else "", parts[2] if len(parts) > 2 else "")
+
+def lock_scopes_overlap(scope1, scope2):
+    ''' Returns true if two lock scopes cover any of the same projects or subprojects
+    '''
+    for name1, name2 in zip(scope1, scope2):
+        if name1 == "" or name2 == "":
+            return True
+        if name1 != name2:
+            return False
+    return True
+
+def lockfile(config_dir, prj_name="", sp_name=""):
+    ''' Lock the lockfile for the month, or for one project or subproject in it
+    config_dir - directory for the month containing the configuration file
+    prj_name - optional project to lock, instead of the whole month
+    sp_name - optional subproject to lock, instead of the whole project
+    Returns true if successfully locked or false if it, or a lock that overlaps it, is already locked
+    '''
+    lockfile = get_lock_filename(config_dir, prj_name, sp_name)
+    try:
+        with open(lockfile, 'x') as f:
+            f.write('Open for lock on ')
+            f.write(str(datetime.now()))
+    except:
+        return False
+
+    # now that ours is in place, check for any other lock covering the same
+    # projects; if two processes get here at once, both back off
+    scope = (prj_name, sp_name)
+    for other in glob.glob(os.path.join(config_dir, "lock*.lock")):
+        if os.path.basename(other) != os.path.basename(lockfile) and lock_scopes_overlap(scope, get_lock_scope(other)):
+            os.remove(lockfile)
+            return False
+    return True
+
+def unlockfile(config_dir, prj_name="", sp_name=""):
+    ''' Unlocks the lockfile for the month, or for one project or subproject in it
+    '''
+    lockfile = get_lock_filename(config_dir, prj_name, sp_name)
+    os.remove(lockfile)
+
+def clear_lock(config_dir):
+    '''
+    Clears all the lock files for the month
+    '''
+    for lockfile in glob.glob(os.path.join(config_dir, "lock*.lock")) + [os.path.join(config_dir, CONFIG_WRITE_LOCK_FILENAME)]:
+        if os.path.exists(lockfile):
+            os.remove(lockfile)
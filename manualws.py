@@ -8,15 +8,10 @@ import ws.wsagent
 import ws.wsapi
 import ws.wscfg
 
-# run WS agent, either through manual trigger or runner
-def wsAgentForSubproject(cfg, prj, sp):
-    # it's possible to re-run even if the agent has already run once
-    # (e.g., we might change configuration and re-run)
-    # have to at least have the code
-    if not (sp._status.value >= Status.ZIPPEDCODE.value and sp._status != Status.STOPPED):
-        print(f"{prj._name}/{sp._name}: skipping, status is {sp._status.name}, expected ZIPPEDCODE or higher")
-        return False
-
+# Makes sure that the subproject's product exists in WhiteSource, and its
+# project within that product, creating them if not. Returns True if they
+# exist.
+def ensureWSProductAndProject(cfg, prj, sp):
     userkey = ws.wscfg.getWSUserKey(cfg, prj)
     org_token = ws.wscfg.getWSOrgToken(cfg, prj, sp)
 
@@ -44,6 +39,21 @@ def wsAgentForSubproject(cfg, prj, sp):
             print(f"Unable to get project token for {project_name} from WSAPI; bailing")
             return False
 
+    return True
+
+# run WS agent, either through manual trigger or runner
+def wsAgentForSubproject(cfg, prj, sp):
+    # it's possible to re-run even if the agent has already run once
+    # (e.g., we might change configuration and re-run)
+    # have to at least have the code
+    if not (sp._status.value >= Status.ZIPPEDCODE.value and sp._status != Status.STOPPED):
+        print(f"{prj._name}/{sp._name}: skipping, status is {sp._status.name}, expected ZIPPEDCODE or higher")
+        return False
+
+    # make sure the product and project exist in WhiteSource
+    if not ensureWSProductAndProject(cfg, prj, sp):
+        return False
+
     # it exists, so we can proceed
     print(f"{prj._name}/{sp._name}: running WhiteSource unified agent")
     retval = ws.wsagent.runUnifiedAgent(cfg, prj, sp)
@@ -56,9 +66,28 @@ def wsAgentForSubproject(cfg, prj, sp):
     # don't update status; runner can update if it wants to
     return True
 
+# run WS agent for several of a project's subprojects, with one unified
+# agent for each batch of them that share a product (see
+# ws.wsagent.getWSBatches); returns the subprojects it ran for
+def wsAgentBatchForSubprojects(cfg, prj, sps):
+    ready = []
+    for sp in sps:
+        if not (sp._status.value >= Status.ZIPPEDCODE.value and sp._status != Status.STOPPED):
+            print(f"{prj._name}/{sp._name}: skipping, status is {sp._status.name}, expected ZIPPEDCODE or higher")
+            continue
+        if ensureWSProductAndProject(cfg, prj, sp):
+            ready.append(sp)
+
+    done = []
+    for batch in ws.wsagent.getWSBatches(cfg, prj, ready):
+        done.extend(ws.wsagent.runUnifiedAgentBatch(cfg, prj, batch))
+
+    # don't update status; runner can update if it wants to
+    return done
+
 def runManualWSAgent(cfg, prj_only="", sp_only=""):
     if prj_only == "":
-        print(f"Error: `ws` command requires specifying only one project and only one subproject")
+        print(f"Error: `ws` command requires specifying one project")
         return False
 
     prj = cfg._projects.get(prj_only, None)
@@ -66,6 +95,15 @@ def runManualWSAgent(cfg, prj_only="", sp_only=""):
         print(f"{prj_only}: Project not found in config")
         return False
 
+    # with no subproject, run for all of the project's subprojects that
+    # have WhiteSource enabled, in batches
+    if sp_only == "":
+        sps = [sp for sp in prj._subprojects.values() if ws.wscfg.isWSEnabled(cfg, prj, sp) and sp._status.value >= Status.ZIPPEDCODE.value and sp._status != Status.STOPPED]
+        if sps == []:
+            print(f"{prj_only}: no subprojects with zipped code and WhiteSource enabled")
+            return False
+        return len(wsAgentBatchForSubprojects(cfg, prj, sps)) == len(sps)
+
     sp = prj._subprojects.get(sp_only, None)
     if not sp:
         print(f"{prj_only}/{sp_only}: Subproject not found in project config")
@@ -4,6 +4,7 @@
 import os
 
 from datatypes import SLMCategory, SLMFile, SLMLicense, Status
+from scanexclude import getScanExcludeReason
 from slmjson import loadSLMCategories, saveSLMCategories
 from slm.tvReader import TVReader
 from slm.tvParser import TVParser
@@ -164,6 +165,11 @@ def applyNoLicenseFoundFindings(cfg, prj, fdList):
                 if exactPattern == str.lower(os.path.split(fd.path)[1]):
                     fd.finding_extensions = "yes"
 
+            # also check the scan-exclude policy, for files it would now
+            # leave out of the scan
+            if getScanExcludeReason(prj, fd.path) != "":
+                fd.finding_extensions = "yes"
+
             # also check third party dirs
             for directory in prj._slm_thirdparty_dirs:
                 if directory in fd.path:
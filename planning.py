@@ -0,0 +1,117 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+from operator import itemgetter
+
+from tabulate import tabulate
+
+from config import isInThisCycle, loadPriorMonthConfigJSON
+from datatypes import ProjectRepoType, Status
+from runners import getNextStepForSubproject
+from scheduler import getStageClass
+from timings import CODE_VOLUME_STEPS, estimateStageSeconds, formatSeconds, loadTimings
+
+# why `run` stops at a status
+SUBPROJECT_STOP_REASONS = {
+    Status.START: "needs project repo listing",
+    Status.RANAGENTS: "needs `clear`",
+    Status.MADEDRAFTFINDINGS: "needs `approve`",
+    Status.FILEDTICKETS: "needs `deliver`",
+    Status.DELIVERED: "done",
+    Status.STOPPED: "stopped",
+}
+
+# Returns the list of (status, step) that `run` would go through for this
+# subproject, and the status it would then stop at, walking the same steps
+# as runners.doNextThingForSubproject. Doesn't change anything, though with
+# skipUnchanged, it checks the repos for changes the way `run` would.
+def planStepsForSubproject(scaffold_home, cfg, prj, sp):
+    steps = []
+    status = sp._status
+    # subprojects of shared and Gerrit projects get going once the
+    # project-level repo listing is done
+    if prj._repotype != ProjectRepoType.GITHUB and prj._status == Status.START:
+        status = Status.GOTLISTING
+    while True:
+        nextStep = getNextStepForSubproject(scaffold_home, cfg, prj, sp, status)
+        if nextStep is None:
+            break
+        step, nextStatus, _ = nextStep
+        # e.g. draft findings, which stay put until approved
+        if nextStatus == status:
+            break
+        steps.append((status, step))
+        status = nextStatus
+    return steps, status
+
+# Estimates the number of repos and the size in bytes of this subproject's
+# zipped code, from this month's zip if it exists, or else from last
+# month's. Returns 0 for anything that isn't known.
+def estimateCodeVolume(prior_js, prj, sp):
+    prior_sp_dict = prior_js.get('projects', {}).get(prj._name, {}).get('subprojects', {}).get(sp._name, {})
+    prior_code_dict = prior_sp_dict.get('code', {})
+
+    numRepos = len(sp._repos)
+    if numRepos == 0:
+        numRepos = len(prior_code_dict.get('repos', {}))
+
+    numBytes = 0
+    for path in [sp._code_path, prior_code_dict.get('path', "")]:
+        if path != "" and os.path.isfile(path):
+            numBytes = os.path.getsize(path)
+            break
+
+    return numRepos, numBytes
+
+def formatBytes(numBytes):
+    if numBytes == 0:
+        return "-"
+    return f"{numBytes / (1024 * 1024):.1f} MB"
+
+# Prints what `run` would do next for each subproject, with estimates of
+# the volume of work and of how long it will take, without doing any of it.
+def printPlan(scaffold_home, cfg, prj_only, sp_only):
+    prior_js = loadPriorMonthConfigJSON(scaffold_home, cfg)
+    # timings from this month and earlier, oldest first
+    records = [r for r in loadTimings(scaffold_home) if r.get("month", "") <= cfg._month]
+
+    headers = ["Project", "Subproject", "Status", "Next step", "Steps", "Stops at", "Repos", "Est. size", "Est. time"]
+    table = []
+    # step name => [pool, count, bytes, seconds]
+    totals = {}
+    for prj in cfg._projects.values():
+        if prj_only != "" and prj_only != prj._name:
+            continue
+        for sp in prj._subprojects.values():
+            if sp_only != "" and sp_only != sp._name:
+                continue
+            if not isInThisCycle(cfg, prj, sp):
+                table.append([prj._name, sp._name, sp._status.name, "", 0, "off-cycle", "", "", ""])
+                continue
+
+            steps, stopStatus = planStepsForSubproject(scaffold_home, cfg, prj, sp)
+            numRepos, numBytes = estimateCodeVolume(prior_js, prj, sp)
+            spSeconds = 0
+            for (status, step) in steps:
+                t = totals.setdefault(step, [getStageClass(status).name, 0, 0, 0])
+                t[1] += 1
+                if status in CODE_VOLUME_STEPS:
+                    t[2] += numBytes
+                secs = estimateStageSeconds(records, prj, sp, status, numBytes)
+                if secs is not None:
+                    t[3] += secs
+                    spSeconds += secs
+
+            nextStep = steps[0][1] if steps != [] else ""
+            if prj._repotype != ProjectRepoType.GITHUB and prj._status == Status.START:
+                nextStep = "get repo listing for project"
+            stopsAt = f"{stopStatus.name} ({SUBPROJECT_STOP_REASONS.get(stopStatus, 'unknown')})"
+            table.append([prj._name, sp._name, sp._status.name, nextStep, len(steps), stopsAt, numRepos, formatBytes(numBytes), formatSeconds(spSeconds) if spSeconds > 0 else "-"])
+
+    table = sorted(table, key=itemgetter(0, 1))
+    print(tabulate(table, headers=headers))
+    print("")
+
+    summary = [[step, t[0], t[1], formatBytes(t[2]), formatSeconds(t[3]) if t[3] > 0 else "-"] for step, t in totals.items()]
+    print(tabulate(summary, headers=["Step", "Pool", "Subprojects", "Est. size", "Est. time"]))
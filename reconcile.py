@@ -0,0 +1,162 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from datetime import datetime
+import json
+import os
+import threading
+
+# file in the month's directory that appendRepoChanges appends to
+REPO_CHANGES_FILENAME = "repo-changes.jsonl"
+
+# serializes appends from threads in this process
+_repo_changes_lock = threading.Lock()
+
+# Changes that one repo listing made to a project's or subproject's repo
+# lists.
+class RepoDiff:
+
+    def __init__(self, prj_name, sp_name=""):
+        super(RepoDiff, self).__init__()
+
+        self._prj_name = prj_name
+        # "" for project-level listings, e.g. for github-shared and gerrit
+        self._sp_name = sp_name
+
+        # subproject name => repos added to its repos
+        self._added = {}
+        # subproject name => repos removed from its repos, since they're
+        # no longer listed
+        self._removed = {}
+        # new repos added to repos-pending, to be assigned by hand
+        self._pending = []
+        # repos removed from repos-ignore, since they're no longer listed
+        self._ignore_removed = []
+        # subprojects created or removed, for gerrit auto projects
+        self._subprojects_added = []
+        self._subprojects_removed = []
+
+    def __repr__(self):
+        return f"RepoDiff {self._prj_name}/{self._sp_name}: added {self._added}, removed {self._removed}, pending {self._pending}, ignore removed {self._ignore_removed}"
+
+def isRepoDiffEmpty(diff):
+    return diff._added == {} and diff._removed == {} and diff._pending == [] and diff._ignore_removed == [] and diff._subprojects_added == [] and diff._subprojects_removed == []
+
+# Removes the repos that aren't in listedSet from repos, in place and
+# keeping the order of the rest. Returns the removed repos.
+def removeUnlisted(repos, listedSet):
+    removed = [r for r in repos if r not in listedSet]
+    if removed != []:
+        repos[:] = [r for r in repos if r in listedSet]
+    return removed
+
+# Reconciles the repos of subprojects with the repos that a listing found,
+# recording the changes in diff. This uses set differences rather than
+# list lookups, since orgs and Gerrit servers can have thousands of repos.
+#   - repos no longer listed are removed from each subproject's repos and,
+#     if ignore is given, from ignore;
+#   - listed repos that aren't in any of the subprojects, ignore or pending
+#     are added to pending if it's given, or else to the first (normally
+#     the only) subproject's repos, in the order they were listed.
+# Lists are updated in place.
+def reconcileRepos(diff, listed, subprojects, ignore=None, pending=None):
+    listedSet = set(listed)
+    known = set()
+    for sp in subprojects:
+        removed = removeUnlisted(sp._repos, listedSet)
+        if removed != []:
+            diff._removed.setdefault(sp._name, []).extend(removed)
+        known.update(sp._repos)
+    if ignore is not None:
+        diff._ignore_removed.extend(removeUnlisted(ignore, listedSet))
+        known.update(ignore)
+    if pending is not None:
+        known.update(pending)
+
+    new = []
+    for r in listed:
+        if r not in known:
+            new.append(r)
+            known.add(r)
+    if new == []:
+        return
+    if pending is not None:
+        pending.extend(new)
+        diff._pending.extend(new)
+    else:
+        subprojects[0]._repos.extend(new)
+        diff._added.setdefault(subprojects[0]._name, []).extend(new)
+
+def getRepoChangesFilename(scaffold_home, month):
+    return os.path.join(scaffold_home, month, REPO_CHANGES_FILENAME)
+
+def getRepoDiffRecord(cfg, diff):
+    record = {
+        "month": cfg._month,
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "project": diff._prj_name,
+    }
+    if diff._sp_name != "":
+        record["subproject"] = diff._sp_name
+    if diff._subprojects_added != []:
+        record["subprojects-added"] = diff._subprojects_added
+    if diff._subprojects_removed != []:
+        record["subprojects-removed"] = diff._subprojects_removed
+    if diff._added != {}:
+        record["added"] = diff._added
+    if diff._removed != {}:
+        record["removed"] = diff._removed
+    if diff._pending != []:
+        record["pending"] = diff._pending
+    if diff._ignore_removed != []:
+        record["ignore-removed"] = diff._ignore_removed
+    return record
+
+def appendRepoChanges(scaffold_home, cfg, diff):
+    line = json.dumps(getRepoDiffRecord(cfg, diff)) + "\n"
+    with _repo_changes_lock:
+        # one write per record, so that records appended by worker
+        # processes at the same time don't get interleaved
+        with open(getRepoChangesFilename(scaffold_home, cfg._month), "a") as f:
+            f.write(line)
+
+# Loads the month's repo change records; returns a list of dicts.
+def loadRepoChanges(scaffold_home, month):
+    records = []
+    repoChangesFilename = getRepoChangesFilename(scaffold_home, month)
+    if not os.path.isfile(repoChangesFilename):
+        return records
+    with open(repoChangesFilename, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # a crash while appending can leave a partial last line
+                continue
+    return records
+
+# Prints the changes in diff and, if there are any, appends them to the
+# month's repo change log.
+def reportRepoDiff(scaffold_home, cfg, diff):
+    prefix = diff._prj_name if diff._sp_name == "" else f"{diff._prj_name}/{diff._sp_name}"
+    for sp_name in diff._subprojects_added:
+        print(f"{diff._prj_name}: added subproject {sp_name}")
+    for sp_name, repos in diff._added.items():
+        for r in repos:
+            print(f"{diff._prj_name}/{sp_name}: added {r} to repos")
+    for r in diff._pending:
+        print(f"{prefix}: new pending repo: {r}")
+    for sp_name, repos in diff._removed.items():
+        for r in repos:
+            print(f"{diff._prj_name}/{sp_name}: removed {r} from repos")
+    for r in diff._ignore_removed:
+        print(f"{prefix}: removed {r} from repos-ignore")
+    for sp_name in diff._subprojects_removed:
+        print(f"{diff._prj_name}: removed subproject {sp_name}")
+
+    if isRepoDiffEmpty(diff):
+        return
+    try:
+        appendRepoChanges(scaffold_home, cfg, diff)
+    except OSError as e:
+        print(f"{prefix}: unable to record repo changes: {e}")
@@ -4,33 +4,19 @@
 from datatypes import ProjectRepoType, Status, Subproject
 from github import getGithubRepoList
 from gerrit import getGerritRepoDict, getGerritRepoList
+from reconcile import RepoDiff, reconcileRepos, reportRepoDiff
 
 # Runner for START in GitHub
-def doRepoListingForSubproject(cfg, prj, sp):
-    allrepos = getGithubRepoList(cfg._secrets._gitoauth.get(prj._name), sp._github_org)
-
-    # first, figure out what repos need to be added
-    for r in allrepos:
-        if r not in sp._repos and r not in sp._github_repos_ignore and r not in sp._github_repos_pending:
-            sp._github_repos_pending.append(r)
-            print(f"{prj._name}/{sp._name}: new pending repo: {r}")
-
-    # then, figure out what repos need to be removed
-    repos_to_remove = []
-    for r in sp._repos:
-        if r not in allrepos:
-            repos_to_remove.append(r)
-    for r in repos_to_remove:
-        sp._repos.remove(r)
-        print(f"{prj._name}/{sp._name}: removed {r} from repos")
-
-    repos_ignore_to_remove = []
-    for r in sp._github_repos_ignore:
-        if r not in allrepos:
-            repos_ignore_to_remove.append(r)
-    for r in repos_ignore_to_remove:
-        sp._github_repos_ignore.remove(r)
-        print(f"{prj._name}/{sp._name}: removed {r} from repos-ignore")
+def doRepoListingForSubproject(scaffold_home, cfg, prj, sp):
+    allrepos = getGithubRepoList(cfg, cfg._secrets._gitoauth.get(prj._name), sp._github_org)
+    if allrepos is None:
+        print(f"{prj._name}/{sp._name}: unable to list repos for {sp._github_org}")
+        return False
+
+    # new repos go to pending, and repos no longer there are removed
+    diff = RepoDiff(prj._name, sp._name)
+    reconcileRepos(diff, allrepos, [sp], sp._github_repos_ignore, sp._github_repos_pending)
+    reportRepoDiff(scaffold_home, cfg, diff)
 
     # finally, throw a "fail" if any new repos are pending
     if len(sp._github_repos_pending) > 0:
@@ -42,41 +28,19 @@ def doRepoListingForSubproject(cfg, prj, sp):
         return True
 
 # Runner for START in GITHUB-SHARED
-def doRepoListingForProject(cfg, prj):
+def doRepoListingForProject(scaffold_home, cfg, prj):
     if prj._repotype == ProjectRepoType.GITHUB_SHARED:
-        # collect all configured repos, and what subprojects they're in
-        allcfgrepos = {}
-        for sp_name, sp in prj._subprojects.items():
-            for r in sp._repos:
-                allcfgrepos[r] = sp_name
-
         # collect all real repos currently on GitHub
-        allrealrepos = getGithubRepoList(cfg._secrets._gitoauth.get(prj._name), prj._github_shared_org)
-
-        # first, figure out what repos need to be added
-        for r in allrealrepos:
-            config_sp = allcfgrepos.get(r, "")
-            if config_sp == "" and r not in prj._github_shared_repos_ignore and r not in prj._github_shared_repos_pending:
-                prj._github_shared_repos_pending.append(r)
-                print(f"{prj._name}: new pending repo: {r}")
-
-        # then, figure out what repos need to be removed
-        for sp_name, sp in prj._subprojects.items():
-            repos_to_remove = []
-            for r in sp._repos:
-                if r not in allrealrepos:
-                    repos_to_remove.append(r)
-            for r in repos_to_remove:
-                sp._repos.remove(r)
-                print(f"{prj._name}/{sp._name}: removed {r} from repos")
-
-        repos_ignore_to_remove = []
-        for r in prj._github_shared_repos_ignore:
-            if r not in allrealrepos:
-                repos_ignore_to_remove.append(r)
-        for r in repos_ignore_to_remove:
-            prj._github_shared_repos_ignore.remove(r)
-            print(f"{prj._name}: removed {r} from repos-ignore")
+        allrealrepos = getGithubRepoList(cfg, cfg._secrets._gitoauth.get(prj._name), prj._github_shared_org)
+        if allrealrepos is None:
+            print(f"{prj._name}: unable to list repos for {prj._github_shared_org}")
+            return False
+
+        # new repos that aren't in any subproject go to pending, and repos
+        # no longer there are removed
+        diff = RepoDiff(prj._name)
+        reconcileRepos(diff, allrealrepos, list(prj._subprojects.values()), prj._github_shared_repos_ignore, prj._github_shared_repos_pending)
+        reportRepoDiff(scaffold_home, cfg, diff)
 
         # finally, throw a "fail" if any new repos are pending
         if len(prj._github_shared_repos_pending) > 0:
@@ -90,28 +54,33 @@ def doRepoListingForProject(cfg, prj):
             return True
 
 # Runner for START in GERRIT
-def doRepoListingForGerritProject(cfg, prj):
+def doRepoListingForGerritProject(scaffold_home, cfg, prj):
     if prj._gerrit_subproject_config == "auto":
-        return doRepoListingForGerritAutoProject(cfg, prj)
+        return doRepoListingForGerritAutoProject(scaffold_home, cfg, prj)
     elif prj._gerrit_subproject_config == "one":
-        return doRepoListingForGerritOneProject(cfg, prj)
+        return doRepoListingForGerritOneProject(scaffold_home, cfg, prj)
     elif prj._gerrit_subproject_config == "manual":
-        return doRepoListingForGerritManualProject(cfg, prj)
+        return doRepoListingForGerritManualProject(scaffold_home, cfg, prj)
     else:
         print(f"{prj._name}: invalid subproject-config value: {prj._gerrit_subproject_config}")
         return False
 
 # Runner for START in GERRIT where subproject-config is auto
-def doRepoListingForGerritAutoProject(cfg, prj):
+def doRepoListingForGerritAutoProject(scaffold_home, cfg, prj):
     # get the sorted dictionary of repos by top-level grouping, if any
-    rd = getGerritRepoDict(prj._gerrit_apiurl)
+    rd = getGerritRepoDict(cfg, prj._gerrit_apiurl)
+    if rd is None:
+        print(f"{prj._name}: unable to list repos for {prj._gerrit_apiurl}")
+        return False
 
     # now, figure out which repos to assign to which subprojects
     # and create subprojects where needed
-    groupings_seen = []
+    diff = RepoDiff(prj._name)
+    ignoreSet = set(prj._gerrit_repos_ignore)
+    groupings_seen = set()
     for grouping, repos in rd.items():
-        if grouping not in prj._gerrit_repos_ignore:
-            groupings_seen.append(grouping)
+        if grouping not in ignoreSet:
+            groupings_seen.add(grouping)
             sp = prj._subprojects.get(grouping, None)
             if sp == None:
                 sp = Subproject()
@@ -119,30 +88,15 @@ def doRepoListingForGerritAutoProject(cfg, prj):
                 sp._repotype = ProjectRepoType.GERRIT
                 sp._status = Status.START
                 prj._subprojects[grouping] = sp
-            # now, figure out which new repos in this grouping we need to add
-            repos_seen = []
-            repos_to_remove = []
-            for repo in repos:
-                repos_seen.append(repo)
-                if repo not in sp._repos:
-                    sp._repos.append(repo)
-                    print(f"{prj._name}/{sp._name}: added {repo} to repos")
-            # and which old repos we need to remove
-            for repo in sp._repos:
-                if repo not in repos_seen:
-                    repos_to_remove.append(repo)
-            for repo in repos_to_remove:
-                sp._repos.remove(repo)
-                print(f"{prj._name}/{sp._name}: removed {repo} from repos")
+                diff._subprojects_added.append(grouping)
+            # add the grouping's new repos and remove its old ones
+            reconcileRepos(diff, repos, [sp])
 
     # now, finally, figure out which old subprojects we need to remove
-    subprojects_to_remove = []
-    for sp_name in prj._subprojects.keys():
-        if sp_name not in groupings_seen:
-            subprojects_to_remove.append(sp_name)
-    for sp_name in subprojects_to_remove:
+    for sp_name in [sp_name for sp_name in prj._subprojects.keys() if sp_name not in groupings_seen]:
         del prj._subprojects[sp_name]
-        print(f"{prj._name}: removed subproject {sp_name}")
+        diff._subprojects_removed.append(sp_name)
+    reportRepoDiff(scaffold_home, cfg, diff)
 
     # finally, update status for remaining subprojects
     for sp in prj._subprojects.values():
@@ -152,7 +106,7 @@ def doRepoListingForGerritAutoProject(cfg, prj):
     return True
 
 # Runner for START in GERRIT where subproject-config is one
-def doRepoListingForGerritOneProject(cfg, prj):
+def doRepoListingForGerritOneProject(scaffold_home, cfg, prj):
     # check that there's only one subproject and that it has the right name
     if len(prj._subprojects) > 1:
         print(f"{prj._name}: subproject-config value is 'one' but more than one subproject exists")
@@ -172,29 +126,24 @@ def doRepoListingForGerritOneProject(cfg, prj):
         prj._subprojects[prj._name] = sp
 
     # get the sorted dictionary of repos by top-level grouping, if any
-    rd = getGerritRepoDict(prj._gerrit_apiurl)
+    rd = getGerritRepoDict(cfg, prj._gerrit_apiurl)
+    if rd is None:
+        print(f"{prj._name}: unable to list repos for {prj._gerrit_apiurl}")
+        return False
 
-    # now, figure out which repos to add
-    repos_seen = []
+    # now, figure out which repos to add and which ones to remove
     sp = prj._subprojects.get(prj._name, None)
     if sp == None:
         print(f"{prj._name}: unable to get subproject {prj._name}")
         return False
+    ignoreSet = set(prj._gerrit_repos_ignore)
+    repos_seen = []
     for grouping, repos in rd.items():
-        if grouping not in prj._gerrit_repos_ignore:
-            for repo in repos:
-                repos_seen.append(repo)
-                if repo not in sp._repos:
-                    sp._repos.append(repo)
-                    print(f"{prj._name}/{sp._name}: added {repo} to repos")
-    # and which ones to remove
-    repos_to_remove = []
-    for repo in sp._repos:
-        if repo not in repos_seen:
-            repos_to_remove.append(repo)
-    for repo in repos_to_remove:
-        sp._repos.remove(repo)
-        print(f"{prj._name}/{sp._name}: removed {repo} from repos")
+        if grouping not in ignoreSet:
+            repos_seen.extend(repos)
+    diff = RepoDiff(prj._name)
+    reconcileRepos(diff, repos_seen, [sp])
+    reportRepoDiff(scaffold_home, cfg, diff)
 
     # finally, update status for remaining subprojects
     sp._status = Status.GOTLISTING
@@ -203,40 +152,18 @@ def doRepoListingForGerritOneProject(cfg, prj):
     return True
 
 # Runner for START in GERRIT where subproject-config is manual
-def doRepoListingForGerritManualProject(cfg, prj):
-    # collect all configured repos, and what subprojects they're in
-    allcfgrepos = {}
-    for sp_name, sp in prj._subprojects.items():
-        for r in sp._repos:
-            allcfgrepos[r] = sp_name
-
+def doRepoListingForGerritManualProject(scaffold_home, cfg, prj):
     # collect all real repos currently on Gerrit
-    allrealrepos = getGerritRepoList(prj._gerrit_apiurl)
-
-    # first, figure out what repos need to be added
-    for r in allrealrepos:
-        config_sp = allcfgrepos.get(r, "")
-        if config_sp == "" and r not in prj._gerrit_repos_ignore and r not in prj._gerrit_repos_pending:
-            prj._gerrit_repos_pending.append(r)
-            print(f"{prj._name}: new pending repo: {r}")
-
-    # then, figure out what repos need to be removed
-    for sp_name, sp in prj._subprojects.items():
-        repos_to_remove = []
-        for r in sp._repos:
-            if r not in allrealrepos:
-                repos_to_remove.append(r)
-        for r in repos_to_remove:
-            sp._repos.remove(r)
-            print(f"{prj._name}/{sp._name}: removed {r} from repos")
-
-    repos_ignore_to_remove = []
-    for r in prj._gerrit_repos_ignore:
-        if r not in allrealrepos:
-            repos_ignore_to_remove.append(r)
-    for r in repos_ignore_to_remove:
-        prj._gerrit_repos_ignore.remove(r)
-        print(f"{prj._name}: removed {r} from repos-ignore")
+    allrealrepos = getGerritRepoList(cfg, prj._gerrit_apiurl)
+    if allrealrepos is None:
+        print(f"{prj._name}: unable to list repos for {prj._gerrit_apiurl}")
+        return False
+
+    # new repos that aren't in any subproject go to pending, and repos
+    # no longer there are removed
+    diff = RepoDiff(prj._name)
+    reconcileRepos(diff, allrealrepos, list(prj._subprojects.values()), prj._gerrit_repos_ignore, prj._gerrit_repos_pending)
+    reportRepoDiff(scaffold_home, cfg, diff)
 
     # finally, throw a "fail" if any new repos are pending
     if len(prj._gerrit_repos_pending) > 0:
@@ -3,11 +3,22 @@
 
 import os
 import copy
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from config import isInThisCycle, saveConfigJournal
 from datatypes import Status, ProjectRepoType
 from datefuncs import parseYM, priorMonth, getYMStr
 
+# seconds to wait between checks on scheduled FOSSology jobs
+JOB_POLL_INTERVAL = 30
+# job statuses meaning FOSSology hasn't finished with the job yet
+JOB_PENDING_STATUSES = ["Queued", "Processing"]
+# checks on a scheduled job in a row that can fail, e.g. because the job
+# was deleted or the API keeps erroring, before giving up on it
+JOB_CHECK_ATTEMPTS = 20
+
 def getUploadFolder(fossologyServer, uploadFolderName):
     ''' Gets the prior upload folder searching all folders for a matching name
         returns None if no upload or priorUploadFolder exists
@@ -31,6 +42,25 @@ def getUpload(fossologyServer, uploadFolder, uploadNameFragment):
             return upload
     return None     # Didn't find it
 
+def getUploadForSubproject(cfg, fossologyServer, prj, sp):
+    '''
+    Gets the folder and upload holding this month's code for the subproject: the upload recorded for it, which
+    might be an earlier upload of the same zip file, or else the upload in this month's folder named after its
+    zip file.  Returns (None, None) if there isn't one
+    '''
+    if sp._fossology_upload_id != -1:
+        try:
+            upload = fossologyServer.detail_upload(sp._fossology_upload_id)
+            return fossologyServer.detail_folder(upload.folderid), upload
+        except Exception as e:
+            print(f"{prj._name}/{sp._name}: unable to get upload {sp._fossology_upload_id}, looking for it by name: {e}")
+
+    uploadFolder = getUploadFolder(fossologyServer, f"{prj._name}-{cfg._month}")
+    upload = getUpload(fossologyServer, uploadFolder, os.path.basename(sp._code_path))
+    if not upload:
+        return None, None
+    return uploadFolder, upload
+
 def uploadExists(fossologyServer, priorUploadFolder, uploadNameFragment):
     folder = priorUploadFolder
     if isinstance(folder, str):
@@ -43,10 +73,31 @@ def uploadExists(fossologyServer, priorUploadFolder, uploadNameFragment):
         return False
 
 def doRunAgentsForSubproject(cfg, fossologyServer, prj, sp):
+    # schedule the agents, unless a job was already scheduled for this
+    # subproject on an earlier run
+    if sp._fossology_job_id == -1:
+        if not scheduleAgentsForSubproject(cfg, fossologyServer, prj, sp):
+            return False
+
+    # in batch mode, leave the job running; doRunAgentsBatch waits for it
+    # together with the jobs for the other subprojects
+    if cfg._fossology_batch_jobs:
+        print(f"{prj._name}/{sp._name}: scheduled scanning job {sp._fossology_job_id}, will wait for it in batch")
+        return False
+
+    # Poll for completion
+    job = fossologyServer.detail_job(sp._fossology_job_id, wait=True, timeout=10)
+    while job.status in JOB_PENDING_STATUSES:
+        print(f"{prj._name}/{sp._name}: Waiting for scan completion...")
+        job = fossologyServer.detail_job(job.id, wait=True, timeout=JOB_POLL_INTERVAL)
+    return finishAgentsForSubproject(prj, sp, job)
+
+# schedules the nomos / monk / reuser jobs for this subproject, without
+# waiting for them to run, and records the job ID in sp._fossology_job_id
+def scheduleAgentsForSubproject(cfg, fossologyServer, prj, sp):
     year, month = parseYM(cfg._month)
 
     uploadName = os.path.basename(sp._code_path)
-    uploadFolderName = f"{prj._name}-{cfg._month}"
 
     if uploadName == "":
         print(f"{prj._name}/{sp._name}: no code path in config, so no upload name; not running agents")
@@ -54,13 +105,9 @@ def doRunAgentsForSubproject(cfg, fossologyServer, prj, sp):
 
     # run nomos and monk
     print(f"{prj._name}/{sp._name}: running nomos and monk")
-    uploadFolder = getUploadFolder(fossologyServer, uploadFolderName)
-    if not uploadFolder:
-        print(f"{prj._name}/{sp._name}: Upload folder not found")
-        return False
-    upload = getUpload(fossologyServer, uploadFolder, uploadName)
+    uploadFolder, upload = getUploadForSubproject(cfg, fossologyServer, prj, sp)
     if not upload:
-        print(f"{prj._name}/{sp._name}: Upload found")
+        print(f"{prj._name}/{sp._name}: Upload not found")
         return False
         
     jobSpec = copy.deepcopy(cfg._fossology_job_spec)
@@ -77,7 +124,13 @@ def doRunAgentsForSubproject(cfg, fossologyServer, prj, sp):
         priorFolder = getUploadFolder(fossologyServer, priorFolderName)
         if priorFolder:
             priorUpload = getUpload(fossologyServer, priorFolder, priorUploadFragment)
-            if priorUpload:           
+            if priorUpload and priorUpload.id == upload.id:
+                # the code hasn't changed since then, and its upload was
+                # reused, so its earlier clearing is already there
+                foundPrior = True
+                print(f"{prj._name}/{sp._name}: reusing upload from {pYM}, no need for reuser")
+                break
+            elif priorUpload:
                 foundPrior = True
                 print(f"{prj._name}/{sp._name}: running reuser from {pYM}")
                 jobSpec["reuse"] = {
@@ -121,20 +174,94 @@ def doRunAgentsForSubproject(cfg, fossologyServer, prj, sp):
         '''
     # We have everything configured, we can start the run
     try:
-        job = fossologyServer.schedule_jobs(uploadFolder, upload, jobSpec, wait=True, timeout=10)
+        job = fossologyServer.schedule_jobs(uploadFolder, upload, jobSpec)
     except Exception:
          print(f"{prj._name}/{sp._name}: Exception running scanning job - see FOSSology for details")
          return False
-    # Poll for completion
-    while job.status == "Processing":
-        print(f"{prj._name}/{sp._name}: Waiting for scan completion...")
-        job = fossologyServer.detail_job(job.id, wait=True, timeout=30)
+    sp._fossology_job_id = job.id
+    return True
+
+# given the latest details for this subproject's scanning job, updates the
+# subproject if the job is done; returns True if the agents have been run
+def finishAgentsForSubproject(prj, sp, job):
+    if job.status in JOB_PENDING_STATUSES:
+        return False
+    # schedule a new job on the next run if this one didn't succeed
+    sp._fossology_job_id = -1
     if job.status != "Completed":
         print(f"{prj._name}/{sp._name}: Error running scanning job - see FOSSology for details")
         return False
     # once we get here, the agents have been run
     sp._status = Status.RANAGENTS
-    
+
     # and when we return, the runner framework should update the project's
     # status to reflect the min of its subprojects
     return True
+
+# gets the details of a subproject's scanning job, or None if they couldn't
+# be got this time, e.g. because of a network error, so that the job is
+# just checked again on the next poll
+def getJobDetails(fossologyServer, prj, sp):
+    try:
+        return fossologyServer.detail_job(sp._fossology_job_id)
+    except Exception as e:
+        print(f"{prj._name}/{sp._name}: unable to check scanning job {sp._fossology_job_id}, will try again: {e}")
+        return None
+
+# schedules scanning jobs for every subproject in UPLOADEDCODE that doesn't
+# have one yet, so that FOSSology can run them all in parallel, and then
+# waits for all of the scheduled jobs at once; gives up on a job once
+# JOB_CHECK_ATTEMPTS checks on it in a row have failed
+def doRunAgentsBatch(scaffold_home, cfg, fossologyServer, prj_only, sp_only):
+    from runners import updateProjectPostSubproject
+    pending = []
+    for prj in cfg._projects.values():
+        if prj_only != "" and prj_only != prj._name:
+            continue
+        for sp in prj._subprojects.values():
+            if sp_only != "" and sp_only != sp._name:
+                continue
+            if sp._status != Status.UPLOADEDCODE or not isInThisCycle(cfg, prj, sp):
+                continue
+            if sp._fossology_job_id == -1:
+                if not scheduleAgentsForSubproject(cfg, fossologyServer, prj, sp):
+                    continue
+                # save now, so the job ID isn't lost if we're interrupted
+                saveConfigJournal(scaffold_home, cfg, prj, sp)
+            print(f"{prj._name}/{sp._name}: scanning job {sp._fossology_job_id} scheduled")
+            pending.append((prj, sp))
+
+    if pending == []:
+        return True
+
+    # failed checks in a row for each subproject's job
+    failedChecks = {}
+    with ThreadPoolExecutor() as pool:
+        while pending != []:
+            print(f"Waiting for {len(pending)} scanning jobs...")
+            time.sleep(JOB_POLL_INTERVAL)
+            jobs = pool.map(lambda item: getJobDetails(fossologyServer, item[0], item[1]), pending)
+            still_pending = []
+            for (prj, sp), job in zip(pending, jobs):
+                key = (prj._name, sp._name)
+                if job is None:
+                    failedChecks[key] = failedChecks.get(key, 0) + 1
+                    if failedChecks[key] < JOB_CHECK_ATTEMPTS:
+                        still_pending.append((prj, sp))
+                        continue
+                    # schedule a new job on the next run
+                    print(f"{prj._name}/{sp._name}: Error checking scanning job {sp._fossology_job_id} {JOB_CHECK_ATTEMPTS} times in a row; giving up on it, will schedule a new one on the next run")
+                    sp._fossology_job_id = -1
+                    saveConfigJournal(scaffold_home, cfg, prj, sp)
+                    continue
+                failedChecks[key] = 0
+                if job.status in JOB_PENDING_STATUSES:
+                    still_pending.append((prj, sp))
+                    continue
+                if finishAgentsForSubproject(prj, sp, job):
+                    print(f"{prj._name}/{sp._name}: scanning job {job.id} completed")
+                    updateProjectPostSubproject(cfg, prj)
+                saveConfigJournal(scaffold_home, cfg, prj, sp)
+            pending = still_pending
+
+    return True
@@ -1,16 +1,21 @@
 # Copyright The Linux Foundation
 # SPDX-License-Identifier: Apache-2.0
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
 from datetime import datetime
 import os
 import shutil
+import traceback
 
-from config import saveConfig, updateProjectStatusToSubprojectMin, isInThisCycle
+from config import holdsProjectLock, saveConfig, saveConfigJournal, updateProjectStatusToSubprojectMin, isInThisCycle
 from datatypes import ProjectRepoType, Status, Subproject
 from repolisting import doRepoListingForProject, doRepoListingForGerritProject, doRepoListingForSubproject
 from getcode import doGetRepoCodeForSubproject, doGetRepoCodeForGerritSubproject
+from unchanged import carryForwardPriorResults, findUnchangedPriorResults, getCarryForwardStatus
 from zipcode import doZipRepoCodeForSubproject, doZipRepoCodeForGerritSubproject
-from uploadws import doUploadWSForSubproject
+from codestages import doZippedCodeStagesForSubproject
 from uploadcode import doUploadCodeForProject, doUploadCodeForSubproject
 from runagents import doRunAgentsForSubproject
 from getspdx import doGetSPDXForSubproject
@@ -21,6 +26,8 @@ from approving import doApprove
 from uploadspdx import doUploadSPDXForSubproject
 from uploadreport import doUploadReportsForSubproject, doUploadReportsForProject
 from tickets import doFileTicketsForSubproject
+from scheduler import STAGE_SBOM, STAGE_WS, StageScheduler, getEnabledZippedCodeStages
+from timings import PROJECT_LISTING_STAGE, runTimedStep, runTimedSubprojectStep
 
 def doNextThing(scaffold_home, cfg, fossologyServer, prj_only, sp_only):
     for prj in cfg._projects.values():
@@ -32,6 +39,126 @@ def doNextThing(scaffold_home, cfg, fossologyServer, prj_only, sp_only):
             else:
                 print(f"{prj._name}: not in this cycle; skipping")
 
+# Same as doNextThing, but advances up to `jobs` independent subprojects
+# concurrently, with I/O-bound and CPU-bound steps going to separate
+# worker pools (see scheduler.py). Each project still runs its own
+# project-level steps (repo listings, combined reports) one at a time.
+def doNextThingParallel(scaffold_home, cfg, fossologyServer, prj_only, sp_only, jobs):
+    prjs = []
+    for prj in cfg._projects.values():
+        if prj_only == "" or prj_only == prj._name:
+            if isInThisCycle(cfg, prj, None):
+                prjs.append(prj)
+            else:
+                print(f"{prj._name}: not in this cycle; skipping")
+    if prjs == []:
+        return
+
+    # one thread per project just waits on its subprojects, so the
+    # actual amount of work in flight is bounded by the scheduler
+    with StageScheduler(jobs, cfg._workers_io, cfg._workers_cpu) as scheduler:
+        with ThreadPoolExecutor(max_workers=len(prjs)) as prjExecutor:
+            futures = []
+            for prj in prjs:
+                futures.append(prjExecutor.submit(_doAllThingsForProjectParallel, scaffold_home, cfg, fossologyServer, prj, sp_only, scheduler))
+            for f in futures:
+                f.result()
+
+def _doAllThingsForProjectParallel(scaffold_home, cfg, fossologyServer, prj, sp_only, scheduler):
+    retval = True
+    while retval:
+        retval = doNextThingForProjectParallel(scaffold_home, cfg, fossologyServer, prj, sp_only, scheduler)
+
+# Parallel version of doNextThingForProject. Returns True if accomplished
+# something, or False if accomplished nothing.
+def doNextThingForProjectParallel(scaffold_home, cfg, fossologyServer, prj, sp_only, scheduler):
+    if not isInThisCycle(cfg, prj, None):
+        print(f"{prj._name}: not in this cycle; skipping")
+        return False
+    # if GitHub project, go to subprojects
+    if prj._repotype == ProjectRepoType.GITHUB:
+        return doSubprojectsParallel(scaffold_home, cfg, fossologyServer, prj, sp_only, scheduler, doNextThingForSubproject)
+
+    elif prj._repotype == ProjectRepoType.GITHUB_SHARED or prj._repotype == ProjectRepoType.GERRIT:
+        did_something = False
+        retval_prj = True
+        while retval_prj:
+            if prj._status == Status.START:
+                # get repo listing at project level and see if we're good
+                retval_prj = doRepoListingForProjectParallel(scaffold_home, cfg, prj)
+                if retval_prj:
+                    did_something = True
+            else:
+                if prj._repotype == ProjectRepoType.GERRIT:
+                    nextThingFn = doNextThingForGerritSubproject
+                else:
+                    nextThingFn = doNextThingForSubproject
+                retval_sp_all = doSubprojectsParallel(scaffold_home, cfg, fossologyServer, prj, sp_only, scheduler, nextThingFn)
+                if retval_sp_all:
+                    did_something = True
+                else:
+                    break
+        return did_something
+
+    else:
+        print(f"Invalid project repotype for {prj._name}: {prj._repotype}")
+        return False
+
+# Runs the project-level repo listing on a copy of the project, and swaps
+# the results in while holding the config lock, so that subprojects of
+# other projects can keep saving the config in the meantime.
+def doRepoListingForProjectParallel(scaffold_home, cfg, prj):
+    work_prj = copy.deepcopy(prj)
+    if prj._repotype == ProjectRepoType.GERRIT:
+        retval = runTimedStep(scaffold_home, cfg, work_prj, None, PROJECT_LISTING_STAGE, doRepoListingForGerritProject, scaffold_home, cfg, work_prj)
+        updateProjectStatusToSubprojectMin(cfg, work_prj)
+    else:
+        retval = runTimedStep(scaffold_home, cfg, work_prj, None, PROJECT_LISTING_STAGE, doRepoListingForProject, scaffold_home, cfg, work_prj)
+    with cfg._lock:
+        prj.__dict__.update(work_prj.__dict__)
+        saveConfig(scaffold_home, cfg)
+    return retval
+
+# Submits each of the project's subprojects to the executor, and waits
+# for all of them to go as far as they can. Returns True if any of them
+# accomplished something.
+def doSubprojectsParallel(scaffold_home, cfg, fossologyServer, prj, sp_only, scheduler, nextThingFn):
+    futures = []
+    for sp in prj._subprojects.values():
+        if sp_only == "" or sp_only == sp._name:
+            futures.append(scheduler.submit(doAllThingsForSubprojectParallel, scaffold_home, cfg, fossologyServer, prj, sp, scheduler, nextThingFn))
+    did_something = False
+    for f in futures:
+        if f.result():
+            did_something = True
+    return did_something
+
+# Keeps doing the next thing for this subproject until it can't go any
+# further. Each step runs on a private copy of the subproject; the changes
+# are only copied back into the shared config, together with the
+# project-level update and the save, while holding the config lock.
+def doAllThingsForSubprojectParallel(scaffold_home, cfg, fossologyServer, prj, sp, scheduler, nextThingFn):
+    did_something = False
+    retval = True
+    timedNextThingFn = functools.partial(runTimedSubprojectStep, nextThingFn)
+    while retval:
+        work_sp = copy.deepcopy(sp)
+        try:
+            retval = scheduler.runStep(scaffold_home, cfg, fossologyServer, prj, work_sp, timedNextThingFn)
+        except Exception:
+            # don't take down the other subprojects; leave this one
+            # as it was before the failed step
+            print(f"{prj._name}/{sp._name}: unexpected error, stopping this subproject")
+            traceback.print_exc()
+            return did_something
+        with cfg._lock:
+            sp.__dict__.update(work_sp.__dict__)
+            updateProjectPostSubproject(cfg, prj)
+            saveConfigJournal(scaffold_home, cfg, prj, sp)
+        if retval:
+            did_something = True
+    return did_something
+
 # Tries to do the next thing for this project. Returns True if
 # accomplished something (meaning that we could call this again
 # and possibly do the next-next thing), or False if accomplished
@@ -47,9 +174,9 @@ def doNextThingForProject(scaffold_home, cfg, fossologyServer, prj, sp_only):
             if sp_only == "" or sp_only == sp._name:
                 retval = True
                 while retval:
-                    retval = doNextThingForSubproject(scaffold_home, cfg, fossologyServer, prj, sp)
+                    retval = runTimedSubprojectStep(doNextThingForSubproject, scaffold_home, cfg, fossologyServer, prj, sp)
                     updateProjectPostSubproject(cfg, prj)
-                    saveConfig(scaffold_home, cfg)
+                    saveConfigJournal(scaffold_home, cfg, prj, sp)
                     if retval:
                         did_something = True
         return did_something
@@ -61,7 +188,7 @@ def doNextThingForProject(scaffold_home, cfg, fossologyServer, prj, sp_only):
         while retval_prj:
             if prj._status == Status.START:
                 # get repo listing at project level and see if we're good
-                retval_prj = doRepoListingForProject(cfg, prj)
+                retval_prj = runTimedStep(scaffold_home, cfg, prj, None, PROJECT_LISTING_STAGE, doRepoListingForProject, scaffold_home, cfg, prj)
                 saveConfig(scaffold_home, cfg)
                 if retval_prj:
                     did_something = True
@@ -78,9 +205,9 @@ def doNextThingForProject(scaffold_home, cfg, fossologyServer, prj, sp_only):
                     if sp_only == "" or sp_only == sp._name:
                         retval = True
                         while retval:
-                            retval = doNextThingForSubproject(scaffold_home, cfg, fossologyServer, prj, sp)
+                            retval = runTimedSubprojectStep(doNextThingForSubproject, scaffold_home, cfg, fossologyServer, prj, sp)
                             updateProjectPostSubproject(cfg, prj)
-                            saveConfig(scaffold_home, cfg)
+                            saveConfigJournal(scaffold_home, cfg, prj, sp)
                             if retval:
                                 did_something = True
                                 retval_sp_all = True
@@ -94,7 +221,7 @@ def doNextThingForProject(scaffold_home, cfg, fossologyServer, prj, sp_only):
         while retval_prj:
             if prj._status == Status.START:
                 # get repo listing at project level and see if we're good
-                retval_prj = doRepoListingForGerritProject(cfg, prj)
+                retval_prj = runTimedStep(scaffold_home, cfg, prj, None, PROJECT_LISTING_STAGE, doRepoListingForGerritProject, scaffold_home, cfg, prj)
                 updateProjectStatusToSubprojectMin(cfg, prj)
                 saveConfig(scaffold_home, cfg)
                 if retval_prj:
@@ -112,9 +239,9 @@ def doNextThingForProject(scaffold_home, cfg, fossologyServer, prj, sp_only):
                     if sp_only == "" or sp_only == sp._name:
                         retval = True
                         while retval:
-                            retval = doNextThingForGerritSubproject(scaffold_home, cfg, fossologyServer, prj, sp)
+                            retval = runTimedSubprojectStep(doNextThingForGerritSubproject, scaffold_home, cfg, fossologyServer, prj, sp)
                             updateProjectPostSubproject(cfg, prj)
-                            saveConfig(scaffold_home, cfg)
+                            saveConfigJournal(scaffold_home, cfg, prj, sp)
                             if retval:
                                 did_something = True
                                 retval_sp_all = True
@@ -126,148 +253,119 @@ def doNextThingForProject(scaffold_home, cfg, fossologyServer, prj, sp_only):
         print(f"Invalid project repotype for {prj._name}: {prj._repotype}")
         return False
 
-# Tries to do the next thing for this subproject. Returns True if
-# accomplished something (meaning that we could call this again
-# and possibly do the next-next thing), or False if accomplished
-# nothing (meaning that we probably need to intervene).
-def doNextThingForSubproject(scaffold_home, cfg, fossologyServer, prj, sp):
-    if not isInThisCycle(cfg, prj, sp):
-        print(f"{prj._name}/{sp._name}: not in this cycle; skipping")
-        return False
-    status = sp._status
+# Gets what `run` does next for a subproject at this status, without doing
+# any of it: a description of the step, the status it moves the subproject
+# on to, and the function that does it, called as fn(fossologyServer).
+# Returns None if the subproject waits for manual action, or is done. Both
+# the runners below and the planner go through this, so that they agree.
+def getNextStepForSubproject(scaffold_home, cfg, prj, sp, status):
+    isGerrit = prj._repotype == ProjectRepoType.GERRIT
     if status == Status.START:
-        # get repo listing and see if we're good
-        return doRepoListingForSubproject(cfg, prj, sp)
+        # get repo listing; Gerrit subprojects get theirs from the project
+        if isGerrit:
+            return None
+        return ("get repo listing", Status.GOTLISTING, lambda fossologyServer: doRepoListingForSubproject(scaffold_home, cfg, prj, sp))
     elif status == Status.GOTLISTING:
         # get code
-        return doGetRepoCodeForSubproject(cfg, prj, sp)
+        getCode = doGetRepoCodeForGerritSubproject if isGerrit else doGetRepoCodeForSubproject
+        # skip ahead if nothing has changed since last month, or get the
+        # code after all if last month's results can't be brought in
+        if cfg._skip_unchanged:
+            prior = findUnchangedPriorResults(scaffold_home, cfg, prj, sp)
+            if prior is not None:
+                return ("carry forward unchanged results", getCarryForwardStatus(prj), lambda fossologyServer: carryForwardPriorResults(cfg, prj, sp, prior) or getCode(cfg, prj, sp))
+        return ("clone repos", Status.GOTCODE, lambda fossologyServer: getCode(cfg, prj, sp))
     elif status == Status.GOTCODE:
         # delete .git folder and zip code
-        return doZipRepoCodeForSubproject(cfg, prj, sp)
+        zipCode = doZipRepoCodeForGerritSubproject if isGerrit else doZipRepoCodeForSubproject
+        return ("zip code", Status.ZIPPEDCODE, lambda fossologyServer: zipCode(cfg, prj, sp))
     elif status == Status.ZIPPEDCODE:
-        # upload to WhiteSource
-        return doUploadWSForSubproject(cfg, prj, sp)
+        # upload to WhiteSource and Fossology, and run sbom agent if enabled
+        step = "upload to Fossology"
+        enabled = getEnabledZippedCodeStages(cfg, prj, sp)
+        if STAGE_WS in enabled:
+            step += " + WhiteSource in batch" if cfg._ws_batch and cfg._ws_batch_deferred else " + WhiteSource"
+        if STAGE_SBOM in enabled:
+            step += " + sbom"
+        return (step, Status.UPLOADEDCODE, lambda fossologyServer: doZippedCodeStagesForSubproject(cfg, fossologyServer, prj, sp))
     elif status == Status.UPLOADEDWS:
-        # upload code
-        return doUploadCodeForSubproject(cfg, fossologyServer, prj, sp)
+        # upload code, if uploaded to WhiteSource before the stages for
+        # zipped code ran at the same time
+        return ("upload to Fossology", Status.UPLOADEDCODE, lambda fossologyServer: doUploadCodeForSubproject(cfg, fossologyServer, prj, sp))
     elif status == Status.UPLOADEDCODE:
         # run agents
-        return doRunAgentsForSubproject(cfg, fossologyServer, prj, sp)
-    elif status == Status.RANAGENTS:
-        # needs manual clearing
-        print(f"{prj._name}/{sp._name}: status is RANAGENTS; clear in Fossology then run `clear` action")
-        return False
+        step = "run Fossology agents in batch" if cfg._fossology_batch_jobs else "run Fossology agents"
+        return (step, Status.RANAGENTS, lambda fossologyServer: doRunAgentsForSubproject(cfg, fossologyServer, prj, sp))
     elif status == Status.CLEARED:
         # get SPDX tag-value file
-        return doGetSPDXForSubproject(cfg, fossologyServer, prj, sp)
+        return ("get SPDX", Status.GOTSPDX, lambda fossologyServer: doGetSPDXForSubproject(cfg, fossologyServer, prj, sp))
     elif status == Status.GOTSPDX:
         # parse SPDX tag-value file
-        return doParseSPDXForSubproject(cfg, prj, sp)
+        return ("parse SPDX", Status.PARSEDSPDX, lambda fossologyServer: doParseSPDXForSubproject(cfg, prj, sp))
     elif status == Status.PARSEDSPDX:
         # create report for subproject
-        return doCreateReportForSubproject(cfg, prj, sp)
+        return ("create reports", Status.CREATEDREPORTS, lambda fossologyServer: doCreateReportForSubproject(cfg, prj, sp))
     elif status == Status.CREATEDREPORTS or status == Status.MADEDRAFTFINDINGS:
-        # create draft of findings report for subproject, if none yet
-        return doMakeDraftFindingsIfNoneForSubproject(cfg, prj, sp)
+        # create draft of findings report for subproject, if none yet;
+        # stays at MADEDRAFTFINDINGS until approved
+        return ("make draft findings", Status.MADEDRAFTFINDINGS, lambda fossologyServer: doMakeDraftFindingsIfNoneForSubproject(cfg, prj, sp))
     elif status == Status.APPROVEDFINDINGS:
         # create final draft of findings report for subproject
-        return doMakeFinalFindingsForSubproject(cfg, prj, sp)
+        return ("make final findings", Status.MADEFINALFINDINGS, lambda fossologyServer: doMakeFinalFindingsForSubproject(cfg, prj, sp))
     elif status == Status.MADEFINALFINDINGS:
         # upload SPDX file to GitHub org
-        return doUploadSPDXForSubproject(cfg, prj, sp)
+        return ("upload SPDX", Status.UPLOADEDSPDX, lambda fossologyServer: doUploadSPDXForSubproject(cfg, prj, sp))
     elif status == Status.UPLOADEDSPDX:
         # upload findings report to unique URL
-        return doUploadReportsForSubproject(cfg, prj, sp)
+        return ("upload reports", Status.UPLOADEDREPORTS, lambda fossologyServer: doUploadReportsForSubproject(cfg, prj, sp))
     elif status == Status.UPLOADEDREPORTS:
         # file and update tickets for instances, if using ticket tracker
-        return doFileTicketsForSubproject(cfg, prj, sp)
-    elif status == Status.FILEDTICKETS:
-        # needs manual delivering
-        print(f"{prj._name}/{sp._name}: status is FILEDTICKETS; deliver report then run `deliver` action")
-        return False
-    elif status == Status.DELIVERED:
-        # we are done
-        return False
-    elif status == Status.STOPPED:
-        # we aren't going any further
-        return False
-
+        return ("file tickets", Status.FILEDTICKETS, lambda fossologyServer: doFileTicketsForSubproject(cfg, prj, sp))
     else:
-        return False
-
+        # RANAGENTS and FILEDTICKETS need manual action, DELIVERED is
+        # done and STOPPED isn't going any further
+        return None
 
-# Tries to do the next thing for this Gerrit subproject. Returns True if
-# accomplished something (meaning that we could call this again and possibly do
-# the next-next thing), or False if accomplished nothing (meaning that we
-# probably need to intervene). Does not handle START case because that is
-# handled at the project level.
-def doNextThingForGerritSubproject(scaffold_home, cfg, fossologyServer, prj, sp):
+# Tries to do the next thing for this subproject. Returns True if
+# accomplished something (meaning that we could call this again
+# and possibly do the next-next thing), or False if accomplished
+# nothing (meaning that we probably need to intervene).
+def doNextThingForSubproject(scaffold_home, cfg, fossologyServer, prj, sp):
     if not isInThisCycle(cfg, prj, sp):
         print(f"{prj._name}/{sp._name}: not in this cycle; skipping")
         return False
     status = sp._status
-    if status == Status.GOTLISTING:
-        # get code
-        return doGetRepoCodeForGerritSubproject(cfg, prj, sp)
-    elif status == Status.GOTCODE:
-        # delete .git folder and zip code
-        return doZipRepoCodeForGerritSubproject(cfg, prj, sp)
-    elif status == Status.ZIPPEDCODE:
-        # upload to WhiteSource
-        return doUploadWSForSubproject(cfg, prj, sp)
-    elif status == Status.UPLOADEDWS:
-        # upload code
-        return doUploadCodeForSubproject(cfg, fossologyServer, prj, sp)
-    elif status == Status.UPLOADEDCODE:
-        # run agents
-        return doRunAgentsForSubproject(cfg, fossologyServer, prj, sp)
-    elif status == Status.RANAGENTS:
+    nextStep = getNextStepForSubproject(scaffold_home, cfg, prj, sp, status)
+    if nextStep is not None:
+        _, _, fn = nextStep
+        return fn(fossologyServer)
+    if status == Status.RANAGENTS:
         # needs manual clearing
         print(f"{prj._name}/{sp._name}: status is RANAGENTS; clear in Fossology then run `clear` action")
-        return False
-    elif status == Status.CLEARED:
-        # get SPDX tag-value file
-        return doGetSPDXForSubproject(cfg, fossologyServer, prj, sp)
-    elif status == Status.GOTSPDX:
-        # parse SPDX tag-value file
-        return doParseSPDXForSubproject(cfg, prj, sp)
-    elif status == Status.PARSEDSPDX:
-        # create report for subproject
-        return doCreateReportForSubproject(cfg, prj, sp)
-    elif status == Status.CREATEDREPORTS or status == Status.MADEDRAFTFINDINGS:
-        # create draft of findings report for subproject, if none yet
-        return doMakeDraftFindingsIfNoneForSubproject(cfg, prj, sp)
-    elif status == Status.APPROVEDFINDINGS:
-        # create final draft of findings report for subproject
-        return doMakeFinalFindingsForSubproject(cfg, prj, sp)
-    elif status == Status.MADEFINALFINDINGS:
-        # upload SPDX file to GitHub org
-        return doUploadSPDXForSubproject(cfg, prj, sp)
-    elif status == Status.UPLOADEDSPDX:
-        # upload findings report to unique URL
-        return doUploadReportsForSubproject(cfg, prj, sp)
-    elif status == Status.UPLOADEDREPORTS:
-        # file and update tickets for instances, if using ticket tracker
-        return doFileTicketsForSubproject(cfg, prj, sp)
     elif status == Status.FILEDTICKETS:
         # needs manual delivering
         print(f"{prj._name}/{sp._name}: status is FILEDTICKETS; deliver report then run `deliver` action")
-        return False
-    elif status == Status.DELIVERED:
-        # we are done
-        return False
-    elif status == Status.STOPPED:
-        # we aren't going any further
-        return False
+    return False
 
-    else:
-        return False
+# Tries to do the next thing for this Gerrit subproject. Returns True if
+# accomplished something (meaning that we could call this again and possibly do
+# the next-next thing), or False if accomplished nothing (meaning that we
+# probably need to intervene). Does not handle START case because that is
+# handled at the project level.
+def doNextThingForGerritSubproject(scaffold_home, cfg, fossologyServer, prj, sp):
+    return doNextThingForSubproject(scaffold_home, cfg, fossologyServer, prj, sp)
 
 # For some steps, after all subprojects have reached a particular
 # point, sometimes a step needs to be taken at the project level
 # before the status is advanced. This includes (if appropriate)
 # advancing the status of the project.
 def updateProjectPostSubproject(cfg, prj):
+    # the project's status and combined reports depend on all of its
+    # subprojects, so they're only updated by a process holding the lock
+    # for the whole project
+    if not holdsProjectLock(cfg, prj._name):
+        return
+
     # if all subprojects have either parsed SPDX into JSON or are
     # stopped, then we should check whether we need to prepare
     # a combined project JSON as well
@@ -4,36 +4,18 @@
 from pathlib import Path
 from operator import itemgetter
 from datetime import date, timedelta
+import importlib
 import os
 import sys
 
-from tabulate import tabulate
-
-from fossology import fossology_token, Fossology
-from fossology.obj import TokenScope
-
-
 from config import loadConfig, saveBackupConfig, saveConfig, isInThisCycle, updateFossologyToken
 import datefuncs
-from runners import doNextThing
-from manualws import runManualWSAgent
-from manualsbom import runManualSbomAgent
-from clearing import doCleared
-from newmonth import copyToNextMonth
-from approving import doApprove
-from emailing import printEmail, printAllLinks, printReportLinks
-from delivering import doDelivered
-from metrics import getMetrics, printMetrics
-from metricsfile import saveMetrics
-from transfer import doTransfer
-from datetime import datetime
+from locks import lockfile, unlockfile, clear_lock
 from secrets import token_urlsafe
 
-LOCK_FILE_NAME = "lock.lock"
-
 def printUsage():
     print(f"""
-Usage: {sys.argv[0]} <month> <command> [<project>] [<subproject>]
+Usage: {sys.argv[0]} <month> <command> [<project>] [<subproject>] [<options>]
 Month: in format YYYY-MM
 
 Commands:
@@ -41,31 +23,43 @@ Commands:
   Running:
     newmonth:         Begin a new month and reset status for all projects
     run:              Run next steps for all subprojects
+    serve:            Keep running next steps for subprojects as they become ready, until stopped
     clear:            Flag cleared in Fossology for [sub]project
     approve:          Flag approved auto-generated findings in report for [sub]project
     deliver:          Flag delivered report for [sub]project
 
   Manual run:
-    ws:               Manually run a new WhiteSource scan
+    ws:               Manually run a new WhiteSource scan (for all of a
+                      project's subprojects, in batches, if none is given)
     sbom:             Manually run a dependency scan and generate an SBOM
 
   Printing:
     status:           Print status for all subprojects
+    plan:             Print what run would do next for all subprojects, with estimates
     printemail:       Print email with links to reports for [sub]project
     printlinks:       Print links to all reports for [sub]project
     printreportlinks: Print only findings link(s) for [sub]project
 
   Metrics:
+    timings:          Print time spent in each step of runs, by stage, project, subproject or month
     getmetrics:       Analyze and save metrics for overall current status to JSON file
     printmetrics:     Load and print metrics from JSON file
 
   Admin:
     transfer:         Transfer project scans from old Fossology server to new.  New server is in default .scaffold-secrets.json, old server is in .scaffold-secrets-old.json
-    clearlock:        Clear the lock file
+    clearlock:        Clear the lock files
+
+Options:
+    --jobs N:         For run and serve, advance up to N subprojects in parallel
+    --interval S:     For serve, check for subprojects that are ready every S seconds (default 60)
+    --port P:         For serve, port for the control interface on 127.0.0.1 (default 8470)
+    --by KEY:         For timings, group by stage (default), project, subproject or month
 
 """)
 
 def status(cfg, prj_only, sp_only):
+    from tabulate import tabulate
+
     headers = ["Project", "Subproject", "Status", "Notes"]
     table = []
     projects = cfg._projects
@@ -81,6 +75,8 @@ def status(cfg, prj_only, sp_only):
                         extras.append(f"off-cycle")
                     if sp._github_branch != "":
                         extras.append(f"branch: {sp._github_branch}")
+                    if sp._code_unchanged_from != "":
+                        extras.append(f"unchanged from {sp._code_unchanged_from}")
 
                     row = [prj._name, sp._name, sp._status.name, ";".join(extras)]
                     table.append(row)
@@ -92,6 +88,9 @@ def generateFossologyToken(secrets, secrets_file_name):
     '''
     Generates a FOSSOlogy token and stores it in the secrets file
     '''
+    from fossology import fossology_token
+    from fossology.obj import TokenScope
+
     expire = date.today() + timedelta(days=30)
     try:
         token = fossology_token(
@@ -113,6 +112,8 @@ def generateFossologyToken(secrets, secrets_file_name):
     return token
 
 def fossologySetup(secrets, secrets_file_name):
+    from fossology import Fossology
+
     token = secrets._fossology_token
     if not token or not secrets._fossology_token_expiration or secrets._fossology_token_expiration < date.today() + timedelta(days=2):
         token = generateFossologyToken(secrets, secrets_file_name)
@@ -131,195 +132,253 @@ def fossologySetup(secrets, secrets_file_name):
             return None
     return server
 
-def lockfile(config_dir):
-    ''' Lock the lockfile for the month
-    config_dir - directory for the month containing the configuration file
-    Returns true if the month was successfully locked or false if the month is already locked
+def parse_options(argv):
     '''
-    
-    lockfile = os.path.join(config_dir, LOCK_FILE_NAME)
-    try:
-        with open(lockfile, 'x') as f:
-            f.write('Open for lock on ')
-            f.write(str(datetime.now()))
-            return True
-    except:
-        return False
-
-def unlockfile(config_dir):
-    ''' Unlocks the lockfile for the month
+    Splits the command line into positional arguments and options
+    argv - command line arguments, possibly including options of the form --name value
+    returns a tuple of the list of positional arguments and a dict of option name to value
     '''
-    lockfile = os.path.join(config_dir, LOCK_FILE_NAME)
-    os.remove(lockfile)
+    args = []
+    options = {}
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith("--") and i + 1 < len(argv):
+            options[argv[i][2:]] = argv[i + 1]
+            i += 2
+        else:
+            args.append(argv[i])
+            i += 1
+    return args, options
 
-def clear_lock(config_dir):
+def get_int_option(options, name, default):
     '''
-    Clears the lock file
+    Gets a positive integer option, exiting if it isn't valid
     '''
-    lockfile = os.path.join(config_dir, LOCK_FILE_NAME)
-    if os.path.exists(lockfile):
-        os.remove(lockfile)
-
-def exec_command(SCAFFOLD_HOME, cfg, args):
+    if name not in options:
+        return default
+    try:
+        value = int(options[name])
+    except ValueError:
+        value = 0
+    if value < 1:
+        print(f"Invalid value for --{name}: {options[name]}")
+        sys.exit(1)
+    return value
+
+# How a command needs the month locked while it runs
+# doesn't change the config, and so doesn't need a lock
+LOCK_NONE = "none"
+# the project or subproject it is run for, or else the whole month
+LOCK_SCOPE = "scope"
+# the whole month, even when run for a single project
+LOCK_MONTH = "month"
+# takes its own locks as it goes
+LOCK_SELF = "self"
+
+class Command:
     '''
-    Executes the command
-    cfg - Configuration
-    args - Arguments - args[1] month; args[2] command; args[3] optional project; args[4] optional subproject
-    returns true if successful, false if not
+    A command, and what it needs before it can run. Its module is only
+    imported when the command is run, so that commands which just print
+    things don't wait for the runners and their dependencies to load.
+    module - module with the function that does the work, or None for this one
+    function - name of that function
+    handler - calls the function; see the call... functions below
+    secrets - whether to load secrets with the config
+    fossology - whether to set up a Fossology server before running
+    lock - one of the LOCK_ values above
     '''
-    # we'll check if added optional args limit to one prj / sp
-    prj_only = ""
-    sp_only = ""
-    ran_command = False
-
-    if len(args) >= 3:
-        command = args[2]
-
-    if len(args) >= 4:
-        prj_only = args[3]
-        if len(args) >= 5:
-            sp_only = args[4]
-
-    if command == "status":
-        ran_command = True
-        status(cfg, prj_only, sp_only)
-
-    elif command == "newmonth":
-        ran_command = True
-        copyToNextMonth(SCAFFOLD_HOME, cfg)
-
-    elif command == "run":
-        ran_command = True
-        saveBackupConfig(SCAFFOLD_HOME, cfg)
-
-        # setup FOSSOlogy server
-        fossologyServer = fossologySetup(cfg._secrets, cfg._secrets_file)
-        if not fossologyServer:
-            print(f"Unable to connect to Fossology server")
-            sys.exit(1)
 
-        # run commands
-        doNextThing(SCAFFOLD_HOME, cfg, fossologyServer, prj_only, sp_only)
-
-        # save modified config file
-        saveConfig(SCAFFOLD_HOME, cfg)
-
-    elif command == "ws":
-        ran_command = True
-        if prj_only == "" or sp_only == "":
-            print(f"ws command requires specifying project and subproject")
-            sys.exit(1)
-
-        # run WS agent manually if between ZIPPEDCODE and CLEARED state
-        # does not modify the config file
-        runManualWSAgent(cfg, prj_only, sp_only)
-        
-    elif command == "sbom":
-        ran_command = True
-        if prj_only == "":
-            print(f"sbom command requires specifying project")
-            sys.exit(1)
-
-        # run sbom agent manually if between ZIPPEDCODE and CLEARED state
-        # does not modify the config file
-        runManualSbomAgent(cfg, prj_only, sp_only)
-        saveConfig(SCAFFOLD_HOME, cfg)
-
-    elif command == "clear":
-        ran_command = True
-        saveBackupConfig(SCAFFOLD_HOME, cfg)
+    def __init__(self, module, function, handler, secrets=False, fossology=False, lock=LOCK_SCOPE):
+        self._module = module
+        self._function = function
+        self._handler = handler
+        self._secrets = secrets
+        self._fossology = fossology
+        self._lock = lock
+
+    def getFunction(self):
+        if self._module is None:
+            return globals()[self._function]
+        return getattr(importlib.import_module(self._module), self._function)
+
+# Handlers: each calls a command's function with what it needs, as
+# handler(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer)
+
+def callForCfg(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    fn(cfg, prj_only, sp_only)
+
+def callForHome(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    fn(SCAFFOLD_HOME, cfg, prj_only, sp_only)
+
+def callWithBackup(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    saveBackupConfig(SCAFFOLD_HOME, cfg)
+    fn(SCAFFOLD_HOME, cfg, prj_only, sp_only)
+    # save config file, even if not modified (b/c saved backup)
+    saveConfig(SCAFFOLD_HOME, cfg)
+
+def callNewMonth(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    fn(SCAFFOLD_HOME, cfg)
+
+def callRun(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    from runners import doNextThing
+    from runagents import doRunAgentsBatch
+    from codestages import doWSAgentBatch
+
+    saveBackupConfig(SCAFFOLD_HOME, cfg)
+
+    # run commands, in parallel if requested
+    jobs = get_int_option(options, "jobs", 1)
+    def runAll():
+        if jobs > 1:
+            fn(SCAFFOLD_HOME, cfg, fossologyServer, prj_only, sp_only, jobs)
+        else:
+            doNextThing(SCAFFOLD_HOME, cfg, fossologyServer, prj_only, sp_only)
+    runAll()
+
+    # in WhiteSource batch mode, the unified agent was left for the
+    # subprojects with zipped code; run it for all of them together, and
+    # then carry on with those it ran for
+    if cfg._ws_batch and doWSAgentBatch(SCAFFOLD_HOME, cfg, prj_only, sp_only):
+        runAll()
+
+    # in batch mode, scanning jobs were only scheduled above; wait for
+    # all of them together
+    if cfg._fossology_batch_jobs:
+        doRunAgentsBatch(SCAFFOLD_HOME, cfg, fossologyServer, prj_only, sp_only)
+
+    # save modified config file
+    saveConfig(SCAFFOLD_HOME, cfg)
+
+def callServe(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    # keep advancing subprojects until stopped; takes its own locks
+    jobs = get_int_option(options, "jobs", 1)
+    interval = get_int_option(options, "interval", 60)
+    port = get_int_option(options, "port", 8470)
+    if not fn(SCAFFOLD_HOME, cfg, lambda: fossologySetup(cfg._secrets, cfg._secrets_file), jobs, interval, port):
+        sys.exit(1)
 
-        # clear if in RANAGENTS state
-        doCleared(SCAFFOLD_HOME, cfg, prj_only, sp_only)
+def callWS(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    if prj_only == "":
+        print(f"ws command requires specifying project")
+        sys.exit(1)
 
-        # save config file, even if not modified (b/c saved backup)
-        saveConfig(SCAFFOLD_HOME, cfg)
+    # run WS agent manually if between ZIPPEDCODE and CLEARED state
+    # does not modify the config file
+    fn(cfg, prj_only, sp_only)
 
-    elif command == "approve":
-        ran_command = True
-        saveBackupConfig(SCAFFOLD_HOME, cfg)
+def callSbom(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    if prj_only == "":
+        print(f"sbom command requires specifying project")
+        sys.exit(1)
 
-        # approve if in MADEDRAFTFINDINGS state
-        doApprove(SCAFFOLD_HOME, cfg, prj_only, sp_only)
+    # run sbom agent manually if between ZIPPEDCODE and CLEARED state
+    # does not modify the config file
+    fn(cfg, prj_only, sp_only)
+    saveConfig(SCAFFOLD_HOME, cfg)
 
-        # save config file, even if not modified (b/c saved backup)
-        saveConfig(SCAFFOLD_HOME, cfg)
+def callGetMetrics(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    from metricsfile import saveMetrics
 
-    elif command == "printemail":
-        ran_command = True
+    all_metrics = fn(cfg, fossologyServer)
+    metricsFilename = os.path.join(cfg._storepath, cfg._month, "metrics.json")
+    saveMetrics(metricsFilename, all_metrics)
 
-        # print email details if in UPLOADEDREPORTS state
-        printEmail(cfg, prj_only, sp_only)
+def callTimings(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    fn(SCAFFOLD_HOME, cfg, prj_only, sp_only, options.get("by", "stage"))
 
-    elif command == "printlinks":
-        ran_command = True
+def callPrintMetrics(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    metricsFilename = os.path.join(cfg._storepath, cfg._month, "metrics.json")
+    fn(metricsFilename)
 
-        # print report link details if in UPLOADEDREPORTS state
-        printAllLinks(cfg, prj_only, sp_only)
+def callTransfer(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, fn, fossologyServer):
+    print("Not upgraded for the new FOSSOlogy Python scripts")
+    sys.exit(1)
 
-    elif command == "printreportlinks":
-        ran_command = True
+    # TODO: To fix this we'll need to change Config() to take a parameter for the secrets file
+    # - this would be useful for unit tests anyway
+    from config import loadSecrets
 
-        # print report link details if in UPLOADEDREPORTS state
-        printReportLinks(cfg, prj_only, sp_only)
+    # set up fossdriver server connections
+    old_fossdriverrc_path = os.path.join(str(Path.home()), ".fossdriver", "fossdriverrc.json")
+    oldConfig = loadSecrets('.scaffold-secrets-old.json')
+    old_server = fossologySetup(oldConfig, cfg._secrets_file)
+    if not old_server:
+        print(f"Unable to connect to old Fossology server")
+        sys.exit(1)
+    new_server = fossologySetup(cfg._secrets, cfg._secrets_file)
+    if not new_server:
+        print(f"Unable to connect to new Fossology server")
+        sys.exit(1)
 
-    elif command == "deliver":
-        ran_command = True
-        saveBackupConfig(SCAFFOLD_HOME, cfg)
+    # run transfer
+    fn(SCAFFOLD_HOME, cfg, prj_only, old_server, new_server)
+
+COMMANDS = {
+    # running
+    "newmonth": Command("newmonth", "copyToNextMonth", callNewMonth, lock=LOCK_MONTH),
+    "run": Command("runners", "doNextThingParallel", callRun, secrets=True, fossology=True),
+    "serve": Command("serve", "doServe", callServe, secrets=True, lock=LOCK_SELF),
+    "clear": Command("clearing", "doCleared", callWithBackup),
+    "approve": Command("approving", "doApprove", callWithBackup),
+    "deliver": Command("delivering", "doDelivered", callWithBackup),
+    # manual run
+    "ws": Command("manualws", "runManualWSAgent", callWS, secrets=True),
+    "sbom": Command("manualsbom", "runManualSbomAgent", callSbom),
+    # printing
+    "status": Command(None, "status", callForCfg, lock=LOCK_NONE),
+    "plan": Command("planning", "printPlan", callForHome, lock=LOCK_NONE),
+    "printemail": Command("emailing", "printEmail", callForCfg, lock=LOCK_NONE),
+    "printlinks": Command("emailing", "printAllLinks", callForCfg, lock=LOCK_NONE),
+    "printreportlinks": Command("emailing", "printReportLinks", callForCfg, lock=LOCK_NONE),
+    # metrics
+    "timings": Command("timings", "printTimings", callTimings, lock=LOCK_NONE),
+    "getmetrics": Command("metrics", "getMetrics", callGetMetrics, secrets=True, fossology=True, lock=LOCK_MONTH),
+    "printmetrics": Command("metrics", "printMetrics", callPrintMetrics, lock=LOCK_NONE),
+    # admin
+    "transfer": Command("transfer", "doTransfer", callTransfer, secrets=True, lock=LOCK_MONTH),
+}
+
+def exec_command(SCAFFOLD_HOME, cfg, args, options=None):
+    '''
+    Executes the command
+    cfg - Configuration
+    args - Arguments - args[1] month; args[2] command; args[3] optional project; args[4] optional subproject
+    options - Optional dict of option name to value, e.g. {"jobs": "4"}
+    returns true if successful, false if not
+    '''
+    if options is None:
+        options = {}
+    # we'll check if added optional args limit to one prj / sp
+    prj_only = ""
+    sp_only = ""
 
-        # clear if in UPLOADEDSPDX state
-        doDelivered(SCAFFOLD_HOME, cfg, prj_only, sp_only)
+    if len(args) < 3 or args[2] not in COMMANDS:
+        return False
+    command = COMMANDS[args[2]]
 
-        # save config file, even if not modified (b/c saved backup)
-        saveConfig(SCAFFOLD_HOME, cfg)
+    if len(args) >= 4:
+        prj_only = args[3]
+        if len(args) >= 5:
+            sp_only = args[4]
 
-    elif command == "getmetrics":
-        ran_command = True
+    # setup FOSSOlogy server
+    fossologyServer = None
+    if command._fossology:
         fossologyServer = fossologySetup(cfg._secrets, cfg._secrets_file)
         if not fossologyServer:
             print(f"Unable to connect to Fossology server")
             sys.exit(1)
-        all_metrics = getMetrics(cfg, fossologyServer)
-
-        metricsFilename = os.path.join(cfg._storepath, cfg._month, "metrics.json")
-        saveMetrics(metricsFilename, all_metrics)
-
-    elif command == "printmetrics":
-        ran_command = True
-        metricsFilename = os.path.join(cfg._storepath, cfg._month, "metrics.json")
-        printMetrics(metricsFilename)
-
-    elif command == "transfer":
-        print("Not upgraded for the new FOSSOlogy Python scripts")
-        sys.exit(1)
-        
-        # TODO: To fix this we'll need to change Config() to take a parameter for the secrets file
-        # - this would be useful for unit tests anyway
-        ran_command = True
-
-        # set up fossdriver server connections
-        old_fossdriverrc_path = os.path.join(str(Path.home()), ".fossdriver", "fossdriverrc.json")
-        oldConfig = loadSecrets('.scaffold-secrets-old.json')
-        old_server = fossologySetup(oldConfig, cfg._secrets_file)
-        if not old_server:
-            print(f"Unable to connect to old Fossology server")
-            sys.exit(1)
-        new_server = fossologySetup(cfg._secrets, cfg._secrets_file)
-        if not new_server:
-            print(f"Unable to connect to new Fossology server")
-            sys.exit(1)
 
-        # run transfer
-        doTransfer(SCAFFOLD_HOME, cfg, prj_only, old_server, new_server)
-        
-    return ran_command
+    command._handler(SCAFFOLD_HOME, cfg, prj_only, sp_only, options, command.getFunction(), fossologyServer)
+    return True
 
 if __name__ == "__main__":
     # check and parse year-month
-    if len(sys.argv) < 2:
+    args, options = parse_options(sys.argv)
+    if len(args) < 3:
         printUsage()
         sys.exit(1)
-    year, month = datefuncs.parseYM(sys.argv[1])
+    year, month = datefuncs.parseYM(args[1])
     if year == 0 and month == 0:
         print("Invalid month\n")
         printUsage()
@@ -331,24 +390,44 @@ if __name__ == "__main__":
         SCAFFOLD_HOME = os.path.join(Path.home(), "scaffold")
     MONTH_DIR = os.path.join(SCAFFOLD_HOME, datefuncs.getYMStr(year, month))
 
-    if sys.argv[2] == "clearlock":
+    if args[2] == "clearlock":
         clear_lock(MONTH_DIR)
+    elif args[2] not in COMMANDS:
+        printUsage()
+        sys.exit(1)
     else:
-        # load configuration file for this month
+        command = COMMANDS[args[2]]
+        prj_only = args[3] if len(args) >= 4 else ""
+        sp_only = args[4] if len(args) >= 5 else ""
         cfg_file = os.path.join(MONTH_DIR, "config.json")
-        cfg = loadConfig(cfg_file, SCAFFOLD_HOME)
         ran_command = False
-        if lockfile(MONTH_DIR):
-            try:
-                ran_command = exec_command(SCAFFOLD_HOME, cfg, sys.argv)
-            finally:
-                unlockfile(MONTH_DIR)
+
+        if command._lock in [LOCK_NONE, LOCK_SELF]:
+            cfg = loadConfig(cfg_file, SCAFFOLD_HOME, load_secrets=command._secrets)
+            ran_command = exec_command(SCAFFOLD_HOME, cfg, args, options)
         else:
-            print("""
-It looks like Scaffold is already running for this month.
+            # lock just the project or subproject the command is for, if
+            # any, so that other projects can be worked on at the same time
+            if command._lock == LOCK_MONTH:
+                prj_only = ""
+                sp_only = ""
+            if lockfile(MONTH_DIR, prj_only, sp_only):
+                try:
+                    # load configuration file for this month, now that
+                    # nobody else can change our part of it
+                    cfg = loadConfig(cfg_file, SCAFFOLD_HOME, load_secrets=command._secrets)
+                    if prj_only != "":
+                        cfg._lock_scopes = [(prj_only, sp_only)]
+                    ran_command = exec_command(SCAFFOLD_HOME, cfg, args, options)
+                finally:
+                    unlockfile(MONTH_DIR, prj_only, sp_only)
+            else:
+                print("""
+It looks like Scaffold is already running for this month, or for this project.
 If you are Absolutely sure scaffold is Not being run by another user,
-you can run the 'clearlock' command to remove the lock file.
+you can run the 'clearlock' command to remove the lock files.
             """)
+                sys.exit(1)
         if not ran_command:
             printUsage()
-            sys.exit(1) 
+            sys.exit(1)
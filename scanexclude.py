@@ -0,0 +1,70 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from fnmatch import fnmatch
+import mimetypes
+
+# reasons a file is left out by a project's scan-exclude policy, in the
+# order they're checked
+EXCLUDE_GLOB = "glob"
+EXCLUDE_MIME = "mime"
+EXCLUDE_SIZE = "size"
+
+# Returns True if path matches one of the project's scan-exclude globs.
+# Globs without a "/" are matched against the file name, e.g. "*.min.js";
+# others are matched against the end of the path, e.g. "gen/*.pb.go", with
+# "*" also matching "/". Matching ignores case.
+def matchesScanExcludeGlob(prj, path):
+    path = path.lower()
+    filename = path.rsplit("/", 1)[-1]
+    for glob in prj._slm_scan_exclude_globs:
+        glob = glob.lower()
+        if "/" not in glob:
+            if fnmatch(filename, glob):
+                return True
+        elif fnmatch(path, glob) or fnmatch(path, "*/" + glob.lstrip("/")):
+            return True
+    return False
+
+# Returns True if the MIME type guessed from path's name matches one of
+# the project's scan-exclude MIME type globs, e.g. "image/*".
+def matchesScanExcludeMimeType(prj, path):
+    if prj._slm_scan_exclude_mime_types == []:
+        return False
+    mimeType, _ = mimetypes.guess_type(path, strict=False)
+    if mimeType is None:
+        return False
+    for pattern in prj._slm_scan_exclude_mime_types:
+        if fnmatch(mimeType, pattern.lower()):
+            return True
+    return False
+
+# Gets the reason the project's scan-exclude policy leaves out the file at
+# path, which is size bytes long, or "" if it doesn't. Pass None for size
+# when it isn't known, e.g. for paths in an SPDX file.
+def getScanExcludeReason(prj, path, size=None):
+    if matchesScanExcludeGlob(prj, path):
+        return EXCLUDE_GLOB
+    if matchesScanExcludeMimeType(prj, path):
+        return EXCLUDE_MIME
+    if size is not None and prj._slm_scan_exclude_max_size > 0 and size > prj._slm_scan_exclude_max_size:
+        return EXCLUDE_SIZE
+    return ""
+
+def hasScanExcludePolicy(prj):
+    return prj._slm_scan_exclude_globs != [] or prj._slm_scan_exclude_mime_types != [] or prj._slm_scan_exclude_max_size > 0
+
+# Gets a function for buildZip that says whether to leave out a file under
+# the project's scan-exclude policy, counting the files left out for each
+# reason in counts. Returns None if the project has no policy.
+def getScanExcludeFn(prj, counts):
+    if not hasScanExcludePolicy(prj):
+        return None
+
+    def excludeFn(arcname, size):
+        reason = getScanExcludeReason(prj, arcname, size)
+        if reason == "":
+            return False
+        counts[reason] = counts.get(reason, 0) + 1
+        return True
+    return excludeFn
@@ -0,0 +1,164 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+import multiprocessing
+import os
+import pickle
+
+from datatypes import StageClass, Status
+from ws.wscfg import isWSEnabled
+
+# What kind of work the runners do to move a subproject on from each status.
+# Statuses that wait for manual action, or that are final, are not listed.
+SUBPROJECT_STAGE_CLASSES = {
+    # get repo listing from GitHub
+    Status.START: StageClass.IO,
+    # clone repos
+    Status.GOTLISTING: StageClass.IO,
+    # delete .git folders and zip code
+    Status.GOTCODE: StageClass.CPU,
+    # run WhiteSource unified agent, upload code to Fossology and run
+    # sbom agent, at the same time (see ZIPPEDCODE_STAGES)
+    Status.ZIPPEDCODE: StageClass.IO,
+    # upload code to Fossology, for subprojects that got to UPLOADEDWS
+    # before these stages ran at the same time
+    Status.UPLOADEDWS: StageClass.IO,
+    # run and wait for Fossology agents
+    Status.UPLOADEDCODE: StageClass.IO,
+    # get SPDX tag-value file from Fossology
+    Status.CLEARED: StageClass.IO,
+    # parse SPDX tag-value file
+    Status.GOTSPDX: StageClass.CPU,
+    # create xlsx report
+    Status.PARSEDSPDX: StageClass.CPU,
+    # analyze findings and create draft findings report
+    Status.CREATEDREPORTS: StageClass.CPU,
+    Status.MADEDRAFTFINDINGS: StageClass.CPU,
+    # create final findings report
+    Status.APPROVEDFINDINGS: StageClass.CPU,
+    # push SPDX file to GitHub
+    Status.MADEFINALFINDINGS: StageClass.IO,
+    # upload reports to web server
+    Status.UPLOADEDSPDX: StageClass.IO,
+    # file tickets
+    Status.UPLOADEDREPORTS: StageClass.IO,
+}
+
+def getStageClass(status):
+    return SUBPROJECT_STAGE_CLASSES.get(status, StageClass.NONE)
+
+# stages that run once a subproject's code is zipped
+STAGE_WS = "ws"
+STAGE_FOSSOLOGY_UPLOAD = "fossology-upload"
+STAGE_SBOM = "sbom"
+
+# The stages for ZIPPEDCODE, each with the stages that have to be done
+# before it. They all only need the zip file, so they run at the same time;
+# the subproject moves on to UPLOADEDCODE once all of the enabled ones are
+# done, and in the meantime records which are done in its stages-done.
+ZIPPEDCODE_STAGES = {
+    STAGE_WS: [],
+    STAGE_FOSSOLOGY_UPLOAD: [],
+    STAGE_SBOM: [],
+}
+
+# Gets the ZIPPEDCODE stages that are enabled for this subproject.
+def getEnabledZippedCodeStages(cfg, prj, sp):
+    enabled = [STAGE_FOSSOLOGY_UPLOAD]
+    if isWSEnabled(cfg, prj, sp):
+        enabled.append(STAGE_WS)
+    if prj._sbom_enabled:
+        enabled.append(STAGE_SBOM)
+    return enabled
+
+# Gets the enabled stages of dag that aren't done, but whose prerequisites
+# are done or aren't enabled, in the order they're listed in dag.
+def getReadyStages(dag, enabled, done):
+    ready = []
+    for stage, deps in dag.items():
+        if stage not in enabled or stage in done:
+            continue
+        if all([dep in done or dep not in enabled for dep in deps]):
+            ready.append(stage)
+    return ready
+
+# Gets a copy of cfg to send to a worker process for a step of one of
+# prj's subprojects, holding only that project, and without the listings
+# cached for the rest of the run.
+def getStepConfig(cfg, prj):
+    stepCfg = copy.copy(cfg)
+    stepCfg._projects = {prj._name: prj}
+    stepCfg._github_listings = {}
+    stepCfg._gerrit_listings = {}
+    stepCfg._fossology_upload_indexes = {}
+    return stepCfg
+
+# Gets the project's own fields, leaving out its subprojects, pickled one
+# by one so that they can be compared.
+def getPickledProjectFields(prj):
+    return {k: pickle.dumps(v) for k, v in prj.__dict__.items() if k != "_subprojects"}
+
+# Runs in a worker process: unpacks the step, runs it and sends back the
+# resulting subproject state, and any of the project's own fields that it
+# changed, since changes made in the worker process are otherwise lost.
+def _runPickledStep(payload):
+    scaffold_home, cfg, prj, sp, nextThingFn = pickle.loads(payload)
+    before = getPickledProjectFields(prj)
+    retval = nextThingFn(scaffold_home, cfg, None, prj, sp)
+    prj_changes = {k: v for k, v in prj.__dict__.items() if k != "_subprojects" and before.get(k, None) != pickle.dumps(v)}
+    return retval, sp.__dict__, prj_changes
+
+class StageScheduler:
+    '''
+    Schedules subproject steps for parallel runs. Each subproject is driven
+    by one of `jobs` driver threads; each of its steps is then dispatched,
+    based on the subproject's status, to a thread pool for I/O-bound steps
+    or to a process pool for CPU-bound steps, so that zipping and parsing
+    don't wait behind network transfers and vice versa.
+    '''
+
+    def __init__(self, jobs, io_workers=0, cpu_workers=0):
+        if io_workers < 1:
+            io_workers = jobs
+        if cpu_workers < 1:
+            cpu_workers = min(jobs, os.cpu_count() or 1)
+        self._drivers = ThreadPoolExecutor(max_workers=jobs)
+        self._io_pool = ThreadPoolExecutor(max_workers=io_workers)
+        # spawn rather than fork, since the parent has many threads running
+        self._cpu_pool = ProcessPoolExecutor(max_workers=cpu_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown()
+        return False
+
+    # submit a function that drives a subproject through its steps
+    def submit(self, fn, *args):
+        return self._drivers.submit(fn, *args)
+
+    # run one step for this subproject on the right pool, and wait for it;
+    # returns what the step returned
+    def runStep(self, scaffold_home, cfg, fossologyServer, prj, sp, nextThingFn):
+        if getStageClass(sp._status) == StageClass.CPU:
+            # pickle now, while holding the lock, rather than in the
+            # executor's feeder thread while other threads change things
+            with cfg._lock:
+                payload = pickle.dumps((scaffold_home, getStepConfig(cfg, prj), prj, sp, nextThingFn))
+            retval, sp_state, prj_changes = self._cpu_pool.submit(_runPickledStep, payload).result()
+            sp.__dict__.update(sp_state)
+            # only the fields the step changed, so as not to undo changes
+            # made to the project meanwhile by steps of other subprojects
+            with cfg._lock:
+                prj.__dict__.update(prj_changes)
+            return retval
+
+        return self._io_pool.submit(nextThingFn, scaffold_home, cfg, fossologyServer, prj, sp).result()
+
+    def shutdown(self):
+        self._drivers.shutdown()
+        self._io_pool.shutdown()
+        self._cpu_pool.shutdown()
@@ -0,0 +1,331 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import signal
+import threading
+import time
+import traceback
+
+from config import getConfigFilename, isInThisCycle, loadConfig, saveConfig, updateProjectStatusToSubprojectMin, useLoadedSecrets
+from datatypes import Config, ProjectRepoType, StageClass, Status
+from locks import lockfile, unlockfile
+from runners import doAllThingsForSubprojectParallel, doNextThingForGerritSubproject, doNextThingForSubproject, updateProjectPostSubproject
+from repolisting import doRepoListingForProject, doRepoListingForGerritProject
+from scheduler import StageScheduler, getStageClass
+from timings import PROJECT_LISTING_STAGE, runTimedStep
+
+# how long to leave a subproject that got nowhere before trying it again,
+# unless its status is changed by someone else in the meantime
+RETRY_AFTER_SECONDS = 30 * 60
+
+# how often to set up a new Fossology session, so the token stays current
+FOSSOLOGY_REFRESH_SECONDS = 24 * 60 * 60
+
+# how many finished items to show in the status
+RECENT_ITEMS = 50
+
+def getSubprojectMinStatus(prj):
+    return min([sp._status for sp in prj._subprojects.values()], key=lambda status: status.value)
+
+class PipelineServer:
+    '''
+    Keeps the pipeline running for one month. Every `interval` seconds (or
+    when asked over HTTP) it reloads the config and queues each subproject
+    whose next step doesn't need manual action, e.g. once an operator has
+    run `clear`. Queued subprojects are advanced as far as they can go on
+    a StageScheduler that stays up for as long as the server does, as does
+    the Fossology session.
+
+    Each item takes the lock for just its subproject (or project, for
+    project-level steps) and loads its own copy of the config, so that
+    operators can still run scaffold commands for other subprojects. Once
+    a subproject has moved on, its project is queued as an item of its
+    own, to update the project's status and combined reports under the
+    project's lock. The secrets are loaded once, when the server starts,
+    and only config.json is reloaded.
+    '''
+
+    def __init__(self, scaffold_home, month, secrets, fossologySetupFn, jobs=1, io_workers=0, cpu_workers=0, interval=60):
+        self._scaffold_home = scaffold_home
+        self._month = month
+        self._month_dir = os.path.join(scaffold_home, month)
+        self._secrets = secrets
+        self._fossologySetupFn = fossologySetupFn
+        self._fossologyServer = None
+        self._fossologyCreated = 0
+        self._jobs = jobs
+        self._io_workers = io_workers
+        self._cpu_workers = cpu_workers
+        self._interval = interval
+
+        # guards the item tracking below
+        self._lock = threading.Lock()
+        # (prj, sp) => "queued" or "running"; sp is "" for project-level items
+        self._items = {}
+        # (prj, sp) => (status name, time) of attempts that got nowhere
+        self._stuck = {}
+        self._recent = []
+
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._scheduler = None
+
+    def loadConfig(self):
+        try:
+            cfg = loadConfig(getConfigFilename(self._scaffold_home, self._month), self._scaffold_home, load_secrets=False)
+        except RuntimeError as e:
+            print(f"serve: unable to load config: {e}")
+            return None
+        if not isinstance(cfg, Config) or not cfg._ok:
+            print(f"serve: unable to load config")
+            return None
+        useLoadedSecrets(cfg, self._secrets)
+        # each worker waits on its own subproject's scanning job, so they
+        # already run side by side; and there's no end of a run to leave
+        # the WhiteSource agent until, so it runs for each subproject,
+        # still into the products that batch mode uses
+        cfg._fossology_batch_jobs = False
+        cfg._ws_batch_deferred = False
+        return cfg
+
+    def getFossologyServer(self):
+        with self._lock:
+            if self._fossologyServer is None or time.monotonic() - self._fossologyCreated > FOSSOLOGY_REFRESH_SECONDS:
+                server = self._fossologySetupFn()
+                if server:
+                    self._fossologyServer = server
+                    self._fossologyCreated = time.monotonic()
+            return self._fossologyServer
+
+    # Finds what's ready to go and queues it
+    def scan(self):
+        cfg = self.loadConfig()
+        if cfg is None:
+            return
+        now = time.monotonic()
+        for prj in cfg._projects.values():
+            if not isInThisCycle(cfg, prj, None):
+                continue
+            if prj._repotype != ProjectRepoType.GITHUB and prj._status == Status.START:
+                if not self.isStuck(prj._name, "", prj._status, now):
+                    self.queue(prj._name, "")
+                continue
+
+            for sp in prj._subprojects.values():
+                if not isInThisCycle(cfg, prj, sp) or getStageClass(sp._status) == StageClass.NONE:
+                    continue
+                if prj._repotype == ProjectRepoType.GERRIT and sp._status == Status.START:
+                    continue
+                if not self.isStuck(prj._name, sp._name, sp._status, now):
+                    self.queue(prj._name, sp._name)
+
+            # catch up on the project's status and combined reports, if
+            # its project item couldn't run after its subprojects moved on,
+            # e.g. because another of them still held its lock
+            if prj._status == Status.UNKNOWN or len(prj._subprojects) == 0:
+                continue
+            minStatus = getSubprojectMinStatus(prj)
+            if prj._status != minStatus and not self.isStuck(prj._name, "", minStatus, now):
+                self.queue(prj._name, "")
+
+    # Returns True if the last try for this project (with sp_name "") or
+    # subproject, at this same status, got nowhere not long ago.
+    def isStuck(self, prj_name, sp_name, status, now):
+        with self._lock:
+            stuck = self._stuck.get((prj_name, sp_name), None)
+        return stuck is not None and stuck[0] == status.name and now - stuck[1] < RETRY_AFTER_SECONDS
+
+    def setStuck(self, prj_name, sp_name, status):
+        with self._lock:
+            self._stuck[(prj_name, sp_name)] = (status.name, time.monotonic())
+
+    # Queues a project (with sp_name "") or subproject unless it's already
+    # queued or running; returns True if it was queued.
+    def queue(self, prj_name, sp_name):
+        with self._lock:
+            if (prj_name, sp_name) in self._items:
+                return False
+            self._items[(prj_name, sp_name)] = "queued"
+        self._scheduler.submit(self._runItem, prj_name, sp_name)
+        return True
+
+    def _runItem(self, prj_name, sp_name):
+        with self._lock:
+            self._items[(prj_name, sp_name)] = "running"
+        result = "locked"
+        moved = False
+        try:
+            if self._stopping.is_set():
+                result = "cancelled"
+            elif lockfile(self._month_dir, prj_name, sp_name):
+                try:
+                    if sp_name == "":
+                        result = self._advanceProject(prj_name)
+                    else:
+                        result, moved = self._advanceSubproject(prj_name, sp_name)
+                finally:
+                    unlockfile(self._month_dir, prj_name, sp_name)
+            # the project's own steps need the lock for the whole project,
+            # so once a subproject has moved on they're queued as an item
+            # of their own; if another subproject holds its lock by then,
+            # the next scan catches up
+            if moved:
+                self.queue(prj_name, "")
+        except Exception:
+            print(f"serve: {prj_name}/{sp_name}: unexpected error")
+            traceback.print_exc()
+            result = "error"
+        finally:
+            with self._lock:
+                del self._items[(prj_name, sp_name)]
+                self._recent.append({"project": prj_name, "subproject": sp_name, "result": result, "finished": datetime.now().isoformat(timespec="seconds")})
+                self._recent = self._recent[-RECENT_ITEMS:]
+
+    def _advanceSubproject(self, prj_name, sp_name):
+        # load now that we hold the lock, to pick up any changes made
+        # since the scan
+        cfg = self.loadConfig()
+        if cfg is None:
+            return "error", False
+        cfg._lock_scopes = [(prj_name, sp_name)]
+        prj = cfg._projects.get(prj_name, None)
+        sp = prj._subprojects.get(sp_name, None) if prj else None
+        if sp is None:
+            return "missing", False
+
+        if prj._repotype == ProjectRepoType.GERRIT:
+            nextThingFn = doNextThingForGerritSubproject
+        else:
+            nextThingFn = doNextThingForSubproject
+        startStatus = sp._status
+        did_something = doAllThingsForSubprojectParallel(self._scaffold_home, cfg, self.getFossologyServer(), prj, sp, self._scheduler, nextThingFn)
+        saveConfig(self._scaffold_home, cfg)
+
+        if not did_something:
+            self.setStuck(prj_name, sp_name, sp._status)
+        return f"{startStatus.name} -> {sp._status.name}", did_something
+
+    def _advanceProject(self, prj_name):
+        cfg = self.loadConfig()
+        if cfg is None:
+            return "error"
+        cfg._lock_scopes = [(prj_name, "")]
+        prj = cfg._projects.get(prj_name, None)
+        if prj is None:
+            return "missing"
+
+        startStatus = prj._status
+        if prj._status == Status.START and prj._repotype == ProjectRepoType.GERRIT:
+            runTimedStep(self._scaffold_home, cfg, prj, None, PROJECT_LISTING_STAGE, doRepoListingForGerritProject, self._scaffold_home, cfg, prj)
+            updateProjectStatusToSubprojectMin(cfg, prj)
+        elif prj._status == Status.START and prj._repotype == ProjectRepoType.GITHUB_SHARED:
+            runTimedStep(self._scaffold_home, cfg, prj, None, PROJECT_LISTING_STAGE, doRepoListingForProject, self._scaffold_home, cfg, prj)
+        else:
+            updateProjectPostSubproject(cfg, prj)
+        saveConfig(self._scaffold_home, cfg)
+
+        if prj._status == startStatus:
+            # a listing is tried again once it's been a while, and the
+            # project's own steps once its subprojects have moved on
+            self.setStuck(prj_name, "", prj._status if startStatus == Status.START else getSubprojectMinStatus(prj))
+        elif startStatus == Status.START:
+            # its subprojects are ready now
+            self._wake.set()
+        return f"{startStatus.name} -> {prj._status.name}"
+
+    def getStatus(self):
+        with self._lock:
+            return {
+                "month": self._month,
+                "jobs": self._jobs,
+                "interval": self._interval,
+                "queued": [f"{prj}/{sp}" if sp else prj for (prj, sp), state in self._items.items() if state == "queued"],
+                "running": [f"{prj}/{sp}" if sp else prj for (prj, sp), state in self._items.items() if state == "running"],
+                "recent": list(self._recent),
+            }
+
+    # forget that this subproject got nowhere, e.g. after it was fixed up by hand
+    def retry(self, prj_name, sp_name):
+        with self._lock:
+            self._stuck.pop((prj_name, sp_name), None)
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        with StageScheduler(self._jobs, self._io_workers, self._cpu_workers) as scheduler:
+            self._scheduler = scheduler
+            while not self._stopping.is_set():
+                self.scan()
+                self._wake.wait(self._interval)
+                self._wake.clear()
+            print(f"serve: stopping, waiting for running items to finish")
+
+class _ControlHandler(BaseHTTPRequestHandler):
+    '''
+    Local control interface:
+      GET  /status                  queued, running and recently finished items
+      POST /scan                    look for ready subprojects now
+      POST /retry/<prj>/<sp>        try a subproject again now, even if it got nowhere last time
+      POST /stop                    stop once running items are done
+    '''
+
+    def _reply(self, code, js):
+        body = json.dumps(js, indent=2).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._reply(200, self.server.pipeline.getStatus())
+        else:
+            self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        parts = [p for p in self.path.split("/") if p != ""]
+        if parts == ["scan"]:
+            self.server.pipeline._wake.set()
+            self._reply(200, {"result": "scanning"})
+        elif len(parts) == 3 and parts[0] == "retry":
+            self.server.pipeline.retry(parts[1], parts[2])
+            self._reply(200, {"result": f"retrying {parts[1]}/{parts[2]}"})
+        elif parts == ["stop"]:
+            self.server.pipeline.stop()
+            self._reply(200, {"result": "stopping"})
+        else:
+            self._reply(404, {"error": f"unknown path {self.path}"})
+
+    def log_message(self, format, *args):
+        # keep the server's output to the pipeline itself
+        pass
+
+def doServe(scaffold_home, cfg, fossologySetupFn, jobs=1, interval=60, port=8470):
+    pipeline = PipelineServer(scaffold_home, cfg._month, cfg._secrets, fossologySetupFn, jobs, cfg._workers_io, cfg._workers_cpu, interval)
+    if not pipeline.getFossologyServer():
+        print(f"Unable to connect to Fossology server")
+        return False
+
+    # only listen locally; there's no authentication
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), _ControlHandler)
+    httpd.pipeline = pipeline
+    httpThread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    httpThread.start()
+    print(f"serve: {cfg._month} with {jobs} jobs, checking every {interval} seconds; control at http://127.0.0.1:{port}/status")
+
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(sig, lambda signum, frame: pipeline.stop())
+    try:
+        pipeline.run()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    return True
@@ -10,7 +10,14 @@ from datatypes import SLMLicense
 ##### Main xlsx reporting functions
 ##### External usage shouldn't require calling anything except these
 
-def makeXlsx(categories):
+# labels in the summary for the reasons files were left out of the scan
+EXCLUDED_LABELS = OrderedDict([
+    ("glob", "Matching scan-exclude globs"),
+    ("mime", "Excluded MIME types"),
+    ("size", "Over the scan-exclude size limit"),
+])
+
+def makeXlsx(categories, excludedCounts=None):
     wb = openpyxl.Workbook()
 
     # look for "No license found" category, and if one exists, annotate it
@@ -19,7 +26,7 @@ def makeXlsx(categories):
             _annotateNoLicenseFound(cat)
 
     # create sheets
-    _generateSummarySheet(wb, categories)
+    _generateSummarySheet(wb, categories, excludedCounts)
     _generateCategorySheets(wb, categories)
     _generateFileListings(wb, categories)
 
@@ -35,7 +42,7 @@ def saveXlsx(wb, path):
 
 ##### Helper functions for xlsx reporting
 
-def _generateSummarySheet(wb, categories):
+def _generateSummarySheet(wb, categories, excludedCounts=None):
     # use the first (existing) sheet as the summary sheet
     ws = wb.active
     ws.title = "License summary"
@@ -83,6 +90,24 @@ def _generateSummarySheet(wb, categories):
     ws[f'C{row}'] = total
     ws[f'C{row}'].font = fontBold
 
+    # and the files that weren't scanned, if any
+    if not excludedCounts:
+        return
+    row += 2
+    ws[f'A{row}'] = "Not scanned:"
+    ws[f'A{row}'].font = fontBold
+    row += 1
+    for reason, label in EXCLUDED_LABELS.items():
+        count = excludedCounts.get(reason, 0)
+        if count <= 0:
+            continue
+        ws[f'B{row}'] = label
+        ws[f'B{row}'].font = fontNormal
+        ws[f'B{row}'].alignment = alignNormal
+        ws[f'C{row}'] = count
+        ws[f'C{row}'].font = fontNormal
+        row += 1
+
 def _generateCategorySheets(wb, categories):
     # create font styles
     fontBold = openpyxl.styles.Font(size=16, bold=True)
@@ -0,0 +1,106 @@
+import unittest
+import os
+import tempfile
+import shutil
+from config import loadConfig, saveConfig, saveConfigJournal, getConfigJournalFilename
+from datatypes import Status
+
+SECRET_FILE_NAME = ".test-scaffold-secrets.json"
+TEST_SCAFFOLD_HOME = os.path.join(os.path.dirname(__file__), "testresources", "scaffoldhome")
+TEST_MONTH = "2023-07"
+
+'''
+Tests saving and loading the config, including the config journal
+'''
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scaffold_home_dir = os.path.join(self.temp_dir.name, "scaffold")
+        shutil.copytree(TEST_SCAFFOLD_HOME, self.scaffold_home_dir)
+        self.cfg_file = os.path.join(self.scaffold_home_dir, TEST_MONTH, "config.json")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_journal_replayed_on_load(self):
+        cfg = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        prj = cfg._projects['prj1']
+        sp = prj._subprojects['sp1']
+        sp._status = Status.GOTCODE
+        sp._code_pulled = "2023-07-09"
+        saveConfigJournal(self.scaffold_home_dir, cfg, prj, sp)
+        # config.json itself is untouched
+        cfg2 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        self.assertEqual(Status.GOTCODE, cfg2._projects['prj1']._subprojects['sp1']._status)
+        self.assertEqual("2023-07-09", cfg2._projects['prj1']._subprojects['sp1']._code_pulled)
+        self.assertEqual(1, cfg2._journal_records)
+
+    def test_journal_partial_record_ignored(self):
+        cfg = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        prj = cfg._projects['prj1']
+        sp = prj._subprojects['sp1']
+        sp._status = Status.GOTCODE
+        saveConfigJournal(self.scaffold_home_dir, cfg, prj, sp)
+        # simulate a crash part-way through appending the next record
+        with open(getConfigJournalFilename(self.scaffold_home_dir, TEST_MONTH), "a") as f:
+            f.write('{"project": "prj1", "fie')
+        cfg2 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        self.assertEqual(Status.GOTCODE, cfg2._projects['prj1']._subprojects['sp1']._status)
+
+    def test_save_compacts_journal(self):
+        cfg = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        prj = cfg._projects['prj1']
+        sp = prj._subprojects['sp1']
+        sp._status = Status.ZIPPEDCODE
+        saveConfigJournal(self.scaffold_home_dir, cfg, prj, sp)
+        saveConfig(self.scaffold_home_dir, cfg)
+        self.assertFalse(os.path.exists(getConfigJournalFilename(self.scaffold_home_dir, TEST_MONTH)))
+        self.assertFalse(os.path.exists(self.cfg_file + ".tmp"))
+        cfg2 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        self.assertEqual(Status.ZIPPEDCODE, cfg2._projects['prj1']._subprojects['sp1']._status)
+        self.assertEqual(0, cfg2._journal_records)
+
+    def test_save_merges_locked_project(self):
+        # two processes, each holding the lock for a different project
+        cfg1 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg1._lock_scopes = [('prj1', '')]
+        cfg2 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg2._lock_scopes = [('TEST-DEPENDENCIES', 'sp2')]
+        cfg1._projects['prj1']._subprojects['sp1']._status = Status.GOTCODE
+        saveConfig(self.scaffold_home_dir, cfg1)
+        cfg2._projects['TEST-DEPENDENCIES']._subprojects['sp2']._status = Status.ZIPPEDCODE
+        # changes outside the locked subproject aren't saved
+        cfg2._projects['TEST-DEPENDENCIES']._subprojects['sp1']._status = Status.STOPPED
+        saveConfig(self.scaffold_home_dir, cfg2)
+        cfg3 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        self.assertEqual(Status.GOTCODE, cfg3._projects['prj1']._subprojects['sp1']._status)
+        self.assertEqual(Status.ZIPPEDCODE, cfg3._projects['TEST-DEPENDENCIES']._subprojects['sp2']._status)
+        self.assertEqual(Status.START, cfg3._projects['TEST-DEPENDENCIES']._subprojects['sp1']._status)
+
+    def test_save_subproject_keeps_project_fields(self):
+        # one process holds a subproject's lock, while another updates the
+        # project's own fields
+        cfg1 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg1._lock_scopes = [('prj1', 'sp1')]
+        cfg2 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg2._lock_scopes = [('prj1', '')]
+        cfg2._projects['prj1']._ws_env = {"WS_EXCLUDES": "**/test/**"}
+        saveConfig(self.scaffold_home_dir, cfg2)
+
+        # neither a save nor a journal record from the subproject's
+        # process puts back its stale copy of the project's fields
+        prj = cfg1._projects['prj1']
+        sp = prj._subprojects['sp1']
+        sp._status = Status.ZIPPEDCODE
+        saveConfigJournal(self.scaffold_home_dir, cfg1, prj, sp)
+        cfg3 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        self.assertEqual({"WS_EXCLUDES": "**/test/**"}, cfg3._projects['prj1']._ws_env)
+        self.assertEqual(Status.ZIPPEDCODE, cfg3._projects['prj1']._subprojects['sp1']._status)
+        saveConfig(self.scaffold_home_dir, cfg1)
+        cfg3 = loadConfig(self.cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        self.assertEqual({"WS_EXCLUDES": "**/test/**"}, cfg3._projects['prj1']._ws_env)
+        self.assertEqual(Status.ZIPPEDCODE, cfg3._projects['prj1']._subprojects['sp1']._status)
+
+if __name__ == '__main__':
+    unittest.main()
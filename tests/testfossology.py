@@ -6,7 +6,8 @@ from scaffold import fossologySetup
 from config import loadSecrets, loadConfig
 from uploadcode import doUploadCodeForSubproject, doUploadCodeForProject
 from datatypes import Status, ProjectRepoType
-from runagents import getUploadFolder, doRunAgentsForSubproject, getUpload, uploadExists
+import runagents
+from runagents import getUploadFolder, doRunAgentsBatch, doRunAgentsForSubproject, getUpload, uploadExists
 from getspdx import doGetSPDXForSubproject
 from newmonth import copyToNextMonth
 from getcode import doGetRepoCodeForSubproject
@@ -285,6 +286,30 @@ class TestFossology(unittest.TestCase):
                     fossologyServer.delete_folder(test_project_folder)
                 fossologyServer.close()        
 
+    def test_run_agents_batch_gives_up(self):
+        # a job that can't be checked, e.g. because it was deleted, is
+        # given up on rather than waited for forever
+        cfg = loadConfig(os.path.join(self.config_month_dir, "config.json"), self.scaffold_home_dir, SECRET_FILE_NAME, load_secrets=False)
+        prj = cfg._projects["prj1"]
+        sp = prj._subprojects["sp1"]
+        sp._status = Status.UPLOADEDCODE
+        sp._fossology_job_id = 42
+        checks = []
+        class Server:
+            def detail_job(self, job_id):
+                checks.append(job_id)
+                raise RuntimeError("no such job")
+        saved = (runagents.JOB_POLL_INTERVAL, runagents.JOB_CHECK_ATTEMPTS)
+        runagents.JOB_POLL_INTERVAL = 0
+        runagents.JOB_CHECK_ATTEMPTS = 3
+        try:
+            self.assertTrue(doRunAgentsBatch(self.scaffold_home_dir, cfg, Server(), "prj1", "sp1"))
+        finally:
+            runagents.JOB_POLL_INTERVAL, runagents.JOB_CHECK_ATTEMPTS = saved
+        self.assertEqual([42, 42, 42], checks)
+        self.assertEqual(-1, sp._fossology_job_id)
+        self.assertEqual(Status.UPLOADEDCODE, sp._status)
+
     def test_newmonth(self):
         cfg_file = os.path.join(self.config_month_dir, "config.json")       
         cfg = loadConfig(cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
@@ -0,0 +1,76 @@
+import unittest
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from datatypes import Config
+import gerrit
+from gerrit import getGerritRepoDict, getGerritRepoList, iterJSONObjectItems
+
+'''
+Tests listing Gerrit projects, against a local stand-in for the REST API
+'''
+class TestGerrit(unittest.TestCase):
+
+    def setUp(self):
+        self.projects = {f"group{i % 3}/repo{i:04d}": {"id": f"repo{i:04d}", "state": "ACTIVE"} for i in range(1200)}
+        self.projects["group0/old"] = {"id": "old", "state": "READ_ONLY"}
+        self.requests = []
+        test = self
+
+        class StandIn(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                n = int(query["n"][0])
+                start = int(query["S"][0])
+                test.requests.append((n, start))
+                names = sorted(test.projects.keys())[start:start + n]
+                body = (")]}'\n" + json.dumps({name: test.projects[name] for name in names}, indent=2)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.apiurl = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_iter_json_object_items(self):
+        text = ")]}'\n" + json.dumps({"a/b": {"state": "ACTIVE", "n": 12345}, "c": [1, "}"], "d": 678})
+        # cut into chunks as small as they can be
+        self.assertEqual([("a/b", {"state": "ACTIVE", "n": 12345}), ("c", [1, "}"]), ("d", 678)], list(iterJSONObjectItems(list(text), ")]}'")))
+        self.assertEqual([], list(iterJSONObjectItems(["{", " }"], ")]}'")))
+        with self.assertRaises(ValueError):
+            list(iterJSONObjectItems(['{"a": 1', ', "b"']))
+        with self.assertRaises(ValueError):
+            list(iterJSONObjectItems(['[1, 2]']))
+
+    def test_listing_paged(self):
+        cfg = Config()
+        repos = getGerritRepoList(cfg, self.apiurl)
+        self.assertEqual(sorted([name for name, data in self.projects.items() if data["state"] == "ACTIVE"]), repos)
+        self.assertEqual([(500, 0), (500, 500), (500, 1000)], self.requests)
+
+        # other projects on the same server share the listing
+        self.requests.clear()
+        rd = getGerritRepoDict(cfg, self.apiurl)
+        self.assertEqual(["group0", "group1", "group2"], sorted(rd.keys()))
+        self.assertEqual(400, len(rd["group1"]))
+        self.assertNotIn("group0/old", rd["group0"])
+        self.assertEqual([], self.requests)
+
+    def test_listing_exact_page(self):
+        self.projects = dict(list(self.projects.items())[:gerrit.LISTING_PAGE_SIZE])
+        self.assertEqual(gerrit.LISTING_PAGE_SIZE, len(getGerritRepoList(Config(), self.apiurl)))
+        self.assertEqual([(500, 0), (500, 500)], self.requests)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,15 @@
 import unittest
+import io
 import os
+import tarfile
 import tempfile
+import threading
 import shutil
+import zipfile
 from datetime import datetime
-from getcode import doGetRepoCodeForSubproject
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import git
+from getcode import doGetRepoCodeForSubproject, doGetRepoCodeForGerritSubproject
 from config import loadConfig, saveConfig
 from datatypes import Status, ProjectRepoType
 from zipcode import doZipRepoCodeForSubproject
@@ -159,6 +165,255 @@ class TestGetCode(unittest.TestCase):
         cfg2 = loadConfig(cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
         self.assertEqual(newZipPath, cfg2._zippath)
         
+    def _make_local_repo(self, parent, name):
+        repo_path = os.path.join(parent, name)
+        r = git.Repo.init(repo_path)
+        with open(os.path.join(repo_path, "README"), "w") as f:
+            f.write(name)
+        r.index.add(["README"])
+        actor = git.Actor("Test", "test@example.com")
+        commit = r.index.commit("initial", author=actor, committer=actor)
+        r.close()
+        return commit.hexsha
+
+    def test_resume_clone(self):
+        # Repos cloned before a failed clone are kept and not cloned again
+        subProjectName = 'sp1'
+        projectName = 'prj1'
+        cfg_file = os.path.join(self.config_month_dir, "config.json")
+        cfg = loadConfig(cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg._zippath = self.temp_dir.name
+        remotes = os.path.join(self.temp_dir.name, "remotes")
+        commit1 = self._make_local_repo(remotes, "repo1")
+        prj = cfg._projects[projectName]
+        prj._gerrit_apiurl = remotes
+        sp = prj._subprojects[subProjectName]
+        sp._repos = ["repo1", "repo2"]
+        sp._status = Status.GOTLISTING
+
+        # repo2 doesn't exist yet, so the first try fails
+        self.assertFalse(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+        self.assertEqual(Status.GOTLISTING, sp._status)
+        self.assertEqual({"repo1": commit1}, sp._code_repos)
+        ziporg_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name, sp._name)
+        marker = os.path.join(ziporg_path, "repo1", "marker")
+        with open(marker, "w") as f:
+            f.write("not re-cloned")
+
+        # once it exists, only repo2 is cloned
+        commit2 = self._make_local_repo(remotes, "repo2")
+        self.assertTrue(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+        self.assertEqual(Status.GOTCODE, sp._status)
+        self.assertEqual({"repo1": commit1, "repo2": commit2}, sp._code_repos)
+        self.assertTrue(os.path.isfile(marker))
+
+    def test_parallel_clone(self):
+        # Repos are cloned several at a time; a failure doesn't stop the
+        # others, and commits are recorded in the order of the repo listing
+        subProjectName = 'sp1'
+        projectName = 'prj1'
+        cfg_file = os.path.join(self.config_month_dir, "config.json")
+        cfg = loadConfig(cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg._zippath = self.temp_dir.name
+        remotes = os.path.join(self.temp_dir.name, "remotes")
+        prj = cfg._projects[projectName]
+        prj._gerrit_apiurl = remotes
+        prj._clone_workers = 3
+        sp = prj._subprojects[subProjectName]
+        sp._repos = ["repo5", "repo4", "missing", "repo3", "repo2", "repo1"]
+        commits = {}
+        for repo in sp._repos:
+            if repo != "missing":
+                commits[repo] = self._make_local_repo(remotes, repo)
+        sp._status = Status.GOTLISTING
+
+        self.assertFalse(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+        self.assertEqual(["repo5", "repo4", "repo3", "repo2", "repo1"], list(sp._code_repos.keys()))
+        self.assertEqual(commits, sp._code_repos)
+
+    def test_mirror_cache(self):
+        # With gitMirrors, code is fetched into mirrors under storepath and
+        # exported from them; mirrors of dropped repos are removed
+        subProjectName = 'sp1'
+        projectName = 'prj1'
+        cfg_file = os.path.join(self.config_month_dir, "config.json")
+        cfg = loadConfig(cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg._zippath = self.temp_dir.name
+        cfg._storepath = os.path.join(self.temp_dir.name, "store")
+        cfg._git_mirrors = True
+        remotes = os.path.join(self.temp_dir.name, "remotes")
+        commit1 = self._make_local_repo(remotes, "repo1")
+        commit2 = self._make_local_repo(remotes, "repo2")
+        prj = cfg._projects[projectName]
+        prj._gerrit_apiurl = remotes
+        sp = prj._subprojects[subProjectName]
+        sp._repos = ["repo1", "repo2"]
+        sp._status = Status.GOTLISTING
+
+        self.assertTrue(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+        self.assertEqual({"repo1": commit1, "repo2": commit2}, sp._code_repos)
+        ziporg_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name, sp._name)
+        self.assertTrue(os.path.isfile(os.path.join(ziporg_path, "repo1", "README")))
+        self.assertFalse(os.path.exists(os.path.join(ziporg_path, "repo1", ".git")))
+        mirrors_path = os.path.join(cfg._storepath, "mirrors", prj._name, sp._name)
+        self.assertEqual(["repo1.git", "repo2.git"], sorted(os.listdir(mirrors_path)))
+
+        # next month, repo1 has changed and repo2 has been dropped
+        r = git.Repo(os.path.join(remotes, "repo1"))
+        with open(os.path.join(remotes, "repo1", "README"), "w") as f:
+            f.write("changed")
+        r.index.add(["README"])
+        actor = git.Actor("Test", "test@example.com")
+        commit1b = r.index.commit("change", author=actor, committer=actor).hexsha
+        r.close()
+        sp._repos = ["repo1"]
+        sp._code_repos = {}
+        sp._status = Status.GOTLISTING
+        self.assertTrue(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+        self.assertEqual({"repo1": commit1b}, sp._code_repos)
+        with open(os.path.join(ziporg_path, "repo1", "README")) as f:
+            self.assertEqual("changed", f.read())
+        self.assertEqual(["repo1.git"], os.listdir(mirrors_path))
+
+        # a fetch that fails, e.g. because the remote can't be reached,
+        # keeps the mirror for the next try, but a corrupt one is removed
+        shutil.move(os.path.join(remotes, "repo1"), os.path.join(remotes, "moved"))
+        sp._code_repos = {}
+        sp._status = Status.GOTLISTING
+        self.assertFalse(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+        self.assertEqual(["repo1.git"], os.listdir(mirrors_path))
+        os.remove(os.path.join(mirrors_path, "repo1.git", "HEAD"))
+        self.assertFalse(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+        self.assertEqual([], os.listdir(mirrors_path))
+
+    def _make_large_repo(self, parent, name):
+        repo_path = os.path.join(parent, name)
+        r = git.Repo.init(repo_path)
+        files = {"README": b"small", "vendor/lib/lib.c": b"vendored", "data/big.bin": os.urandom(20000)}
+        for path, data in files.items():
+            os.makedirs(os.path.dirname(os.path.join(repo_path, path)), exist_ok=True)
+            with open(os.path.join(repo_path, path), "wb") as f:
+                f.write(data)
+        r.index.add(list(files.keys()))
+        actor = git.Actor("Test", "test@example.com")
+        commit = r.index.commit("initial", author=actor, committer=actor)
+        # local clones only filter if the remote allows it
+        r.git.config("uploadpack.allowFilter", "true")
+        r.close()
+        return commit.hexsha
+
+    def test_partial_clone(self):
+        # repo-dirs-delete and files over the blob size limit are left out
+        # of the clone, and recorded, with and without mirrors
+        subProjectName = 'sp1'
+        projectName = 'prj1'
+        cfg_file = os.path.join(self.config_month_dir, "config.json")
+        cfg = loadConfig(cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg._zippath = self.temp_dir.name
+        cfg._storepath = os.path.join(self.temp_dir.name, "store")
+        cfg._clone_blob_limit = 10000
+        remotes = os.path.join(self.temp_dir.name, "remotes")
+        commit1 = self._make_large_repo(remotes, "repo1")
+        prj = cfg._projects[projectName]
+        prj._gerrit_apiurl = "file://" + remotes
+        sp = prj._subprojects[subProjectName]
+        sp._repos = ["repo1"]
+        sp._repo_dirs_delete = {"repo1": ["vendor"]}
+        ziporg_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name, sp._name)
+
+        for mirrors in [False, True]:
+            cfg._git_mirrors = mirrors
+            sp._code_repos = {}
+            sp._code_excluded = {}
+            sp._status = Status.GOTLISTING
+            self.assertTrue(doGetRepoCodeForGerritSubproject(cfg, prj, sp))
+            self.assertEqual({"repo1": commit1}, sp._code_repos)
+            self.assertEqual({"repo1": {"dirs": ["vendor"], "large-files": ["data/big.bin"]}}, sp._code_excluded)
+            self.assertTrue(os.path.isfile(os.path.join(ziporg_path, "repo1", "README")))
+            self.assertFalse(os.path.exists(os.path.join(ziporg_path, "repo1", "vendor")))
+            self.assertFalse(os.path.exists(os.path.join(ziporg_path, "repo1", "data", "big.bin")))
+
+    def test_tarball_retrieval(self):
+        # With githubRetrieval "tarball", each repo's top commit is found
+        # and its tarball downloaded over the REST API, from a local
+        # stand-in here, and zipped without being extracted
+        subProjectName = 'sp1'
+        projectName = 'prj1'
+        cfg_file = os.path.join(self.config_month_dir, "config.json")
+        cfg = loadConfig(cfg_file, self.scaffold_home_dir, SECRET_FILE_NAME)
+        cfg._zippath = self.temp_dir.name
+        cfg._github_retrieval = "tarball"
+        prj = cfg._projects[projectName]
+        prj._clone_workers = 2
+        sp = prj._subprojects[subProjectName]
+        sp._repotype = ProjectRepoType.GITHUB
+        sp._github_org = "org"
+        sp._github_ziporg = "org"
+        sp._github_branch = ""
+        sp._repos = ["repo2", "repo1", "empty"]
+        sp._repo_dirs_delete = {"repo1": ["vendor"]}
+        sp._status = Status.GOTLISTING
+        commits = {"repo1": "1" * 40, "repo2": "2" * 40}
+
+        def makeTarball(repo):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+                for path, data in [("README", repo.encode()), ("vendor/lib.c", b"lib"), ("data/big.bin", b"x" * 100)]:
+                    info = tarfile.TarInfo(f"org-{repo}-{commits[repo][:7]}/{path}")
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+            return buf.getvalue()
+
+        class StandIn(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts[:2] != ["repos", "org"] or len(parts) != 5:
+                    self.send_error(404)
+                elif parts[2] == "empty" and parts[3] == "commits":
+                    self.send_error(409)
+                elif parts[3] == "commits" and parts[4] == "HEAD":
+                    self.send_response(200)
+                    self.end_headers()
+                    self.wfile.write(commits[parts[2]].encode())
+                elif parts[3] == "tarball" and parts[4] == commits[parts[2]]:
+                    # GitHub redirects to codeload
+                    self.send_response(302)
+                    self.send_header("Location", f"/repos/org/{parts[2]}/codeload/{parts[4]}")
+                    self.end_headers()
+                elif parts[3] == "codeload":
+                    body = makeTarball(parts[2])
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            cfg._github_api_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+            self.assertTrue(doGetRepoCodeForSubproject(cfg, prj, sp))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+        self.assertEqual(Status.GOTCODE, sp._status)
+        self.assertEqual(commits, sp._code_repos)
+        ziporg_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name, "org")
+        self.assertEqual(["repo1.tar.gz", "repo2.tar.gz"], sorted(os.listdir(ziporg_path)))
+
+        # files over cloneBlobLimit are left out of the zip file
+        cfg._clone_blob_limit = 50
+        self.assertTrue(doZipRepoCodeForSubproject(cfg, prj, sp))
+        with zipfile.ZipFile(sp._code_path) as zf:
+            self.assertEqual(["repo1/README", "repo2/README", "repo2/vendor/lib.c"], zf.namelist())
+            self.assertEqual(b"repo1", zf.read("repo1/README"))
+        self.assertEqual({"repo1": {"dirs": ["vendor"], "large-files": ["data/big.bin"]}, "repo2": {"large-files": ["data/big.bin"]}}, sp._code_excluded)
+        self.assertFalse(os.path.exists(ziporg_path))
+
 if __name__ == '__main__':
     unittest.main()
         
\ No newline at end of file
@@ -0,0 +1,91 @@
+import unittest
+import json
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from datatypes import Config
+from github import getGithubRepoList
+
+'''
+Tests listing GitHub repos, against a local stand-in for the REST API
+'''
+class TestGithub(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.repos = {"orgs/org": [f"repo{i:03d}" for i in range(250)], "users/someone": ["dotfiles"]}
+        self.requests = []
+        test = self
+
+        class StandIn(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                owner = url.path.strip("/").rsplit("/", 1)[0]
+                if owner not in test.repos:
+                    test.requests.append((owner, 0, 404))
+                    self.send_error(404)
+                    return
+                query = parse_qs(url.query)
+                page = int(query["page"][0])
+                per_page = int(query["per_page"][0])
+                names = test.repos[owner][(page - 1) * per_page:page * per_page]
+                etag = f'"{owner}-{page}-{"-".join(names)}"'
+                if self.headers.get("If-None-Match", "") == etag:
+                    test.requests.append((owner, page, 304))
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                test.requests.append((owner, page, 200))
+                body = json.dumps([{"name": name} for name in names]).encode()
+                last = max(1, (len(test.repos[owner]) + per_page - 1) // per_page)
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Link", f'<http://{self.headers["Host"]}{url.path}?page={last}&per_page={per_page}>; rel="last"')
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.temp_dir.cleanup()
+
+    def _new_cfg(self):
+        cfg = Config()
+        cfg._storepath = self.temp_dir.name
+        cfg._github_api_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        return cfg
+
+    def test_listing_cached(self):
+        cfg = self._new_cfg()
+        self.assertEqual(self.repos["orgs/org"], getGithubRepoList(cfg, "token", "org"))
+        self.assertEqual([1, 2, 3], sorted([page for _, page, code in self.requests if code == 200]))
+
+        # subprojects in the same run share the listing
+        self.requests.clear()
+        self.assertEqual(self.repos["orgs/org"], getGithubRepoList(cfg, "token", "org"))
+        self.assertEqual([], self.requests)
+
+        # next run, unchanged pages come back as 304s
+        self.assertEqual(self.repos["orgs/org"], getGithubRepoList(self._new_cfg(), "token", "org"))
+        self.assertEqual([304, 304, 304], [code for _, _, code in self.requests])
+
+        # and new repos spill over onto a new page
+        self.requests.clear()
+        self.repos["orgs/org"] += [f"repo{i:03d}" for i in range(250, 320)]
+        self.assertEqual(self.repos["orgs/org"], getGithubRepoList(self._new_cfg(), "token", "org"))
+        self.assertEqual([(1, 304), (2, 304), (3, 200), (4, 200)], sorted([(page, code) for _, page, code in self.requests]))
+
+    def test_listing_user(self):
+        self.assertEqual(["dotfiles"], getGithubRepoList(self._new_cfg(), "token", "someone"))
+        self.assertIsNone(getGithubRepoList(self._new_cfg(), "token", "nobody"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+import os
+import tempfile
+from locks import lockfile, unlockfile, clear_lock
+
+'''
+Tests the month, project and subproject lock files
+'''
+class TestLocking(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.month_dir = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_separate_projects(self):
+        self.assertTrue(lockfile(self.month_dir, "prj1"))
+        self.assertTrue(lockfile(self.month_dir, "prj2"))
+        self.assertTrue(lockfile(self.month_dir, "prj3", "sp1"))
+        self.assertTrue(lockfile(self.month_dir, "prj3", "sp2"))
+
+    def test_overlapping_scopes(self):
+        self.assertTrue(lockfile(self.month_dir, "prj1"))
+        self.assertFalse(lockfile(self.month_dir, "prj1"))
+        self.assertFalse(lockfile(self.month_dir, "prj1", "sp1"))
+        self.assertFalse(lockfile(self.month_dir))
+        unlockfile(self.month_dir, "prj1")
+        self.assertTrue(lockfile(self.month_dir, "prj1", "sp1"))
+        self.assertFalse(lockfile(self.month_dir, "prj1"))
+        self.assertFalse(lockfile(self.month_dir))
+        # a failed attempt doesn't leave its lock file behind
+        self.assertEqual(["lock@prj1@sp1.lock"], os.listdir(self.month_dir))
+
+    def test_month_lock(self):
+        self.assertTrue(lockfile(self.month_dir))
+        self.assertFalse(lockfile(self.month_dir, "prj1"))
+        self.assertFalse(lockfile(self.month_dir, "prj1", "sp1"))
+        clear_lock(self.month_dir)
+        self.assertTrue(lockfile(self.month_dir, "prj1"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import os
+import tempfile
+from datatypes import Config, Subproject
+from reconcile import RepoDiff, isRepoDiffEmpty, loadRepoChanges, reconcileRepos, reportRepoDiff
+
+'''
+Tests reconciling configured repos with the repos a listing found
+'''
+class TestReconcile(unittest.TestCase):
+
+    def _new_sp(self, name, repos):
+        sp = Subproject()
+        sp._name = name
+        sp._repos = repos
+        return sp
+
+    def test_reconcile_pending(self):
+        sp1 = self._new_sp("sp1", ["a", "gone1", "b"])
+        sp2 = self._new_sp("sp2", ["c"])
+        ignore = ["d", "gone2"]
+        pending = ["e"]
+        diff = RepoDiff("prj1")
+        reconcileRepos(diff, ["f", "a", "b", "c", "d", "e", "g", "f"], [sp1, sp2], ignore, pending)
+        self.assertEqual(["a", "b"], sp1._repos)
+        self.assertEqual(["c"], sp2._repos)
+        self.assertEqual(["d"], ignore)
+        self.assertEqual(["e", "f", "g"], pending)
+        self.assertEqual({"sp1": ["gone1"]}, diff._removed)
+        self.assertEqual(["gone2"], diff._ignore_removed)
+        self.assertEqual(["f", "g"], diff._pending)
+        self.assertEqual({}, diff._added)
+
+    def test_reconcile_added(self):
+        sp1 = self._new_sp("sp1", ["b", "gone"])
+        diff = RepoDiff("prj1")
+        reconcileRepos(diff, ["a", "b", "c"], [sp1])
+        self.assertEqual(["b", "a", "c"], sp1._repos)
+        self.assertEqual({"sp1": ["a", "c"]}, diff._added)
+        self.assertEqual({"sp1": ["gone"]}, diff._removed)
+
+        diff = RepoDiff("prj1")
+        reconcileRepos(diff, ["a", "b", "c"], [sp1])
+        self.assertTrue(isRepoDiffEmpty(diff))
+
+    def test_change_log(self):
+        with tempfile.TemporaryDirectory() as scaffold_home:
+            cfg = Config()
+            cfg._month = "2023-07"
+            os.makedirs(os.path.join(scaffold_home, cfg._month))
+            reportRepoDiff(scaffold_home, cfg, RepoDiff("prj1", "sp1"))
+            self.assertEqual([], loadRepoChanges(scaffold_home, "2023-07"))
+
+            diff = RepoDiff("prj1", "sp1")
+            sp1 = self._new_sp("sp1", ["old"])
+            reconcileRepos(diff, ["new"], [sp1], [], [])
+            reportRepoDiff(scaffold_home, cfg, diff)
+            records = loadRepoChanges(scaffold_home, "2023-07")
+            self.assertEqual(1, len(records))
+            self.assertEqual("sp1", records[0]["subproject"])
+            self.assertEqual({"sp1": ["old"]}, records[0]["removed"])
+            self.assertEqual(["new"], records[0]["pending"])
+            self.assertNotIn("added", records[0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import os
+import tempfile
+import zipfile
+from datatypes import Project
+from scanexclude import getScanExcludeFn, getScanExcludeReason
+from zipbuilder import buildZip
+
+'''
+Tests the scan-exclude policy for leaving files out of the scan
+'''
+class TestScanExclude(unittest.TestCase):
+
+    def setUp(self):
+        self.prj = Project()
+        self.prj._name = "prj1"
+        self.prj._slm_scan_exclude_globs = ["*.min.js", "gen/*.pb.go"]
+        self.prj._slm_scan_exclude_mime_types = ["image/*"]
+        self.prj._slm_scan_exclude_max_size = 100
+
+    def test_exclude_reason(self):
+        self.assertEqual("glob", getScanExcludeReason(self.prj, "repo1/static/jquery.MIN.js", 10))
+        self.assertEqual("glob", getScanExcludeReason(self.prj, "repo1/api/gen/api.pb.go", 10))
+        self.assertEqual("", getScanExcludeReason(self.prj, "repo1/api/api.pb.go", 10))
+        self.assertEqual("mime", getScanExcludeReason(self.prj, "repo1/logo.png", 10))
+        self.assertEqual("size", getScanExcludeReason(self.prj, "repo1/main.c", 101))
+        self.assertEqual("", getScanExcludeReason(self.prj, "repo1/main.c", 100))
+        # size isn't known for paths from SPDX files
+        self.assertEqual("", getScanExcludeReason(self.prj, "sp1.zip/repo1/main.c"))
+        self.assertEqual("glob", getScanExcludeReason(self.prj, "sp1.zip/repo1/app.min.js"))
+
+    def test_no_policy(self):
+        self.assertIsNone(getScanExcludeFn(Project(), {}))
+
+    def test_build_zip_with_policy(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            src_path = os.path.join(temp_dir, "src")
+            files = {
+                "repo1/main.c": b"int x;\n",
+                "repo1/app.min.js": b"var a;",
+                "repo1/logo.png": b"png",
+                "repo1/data.bin": b"0" * 200,
+            }
+            for path, data in files.items():
+                fpath = os.path.join(src_path, path)
+                os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                with open(fpath, "wb") as f:
+                    f.write(data)
+
+            counts = {}
+            zf_path = os.path.join(temp_dir, "sp1.zip")
+            buildZip(src_path, zf_path, workers=1, excludeFn=getScanExcludeFn(self.prj, counts))
+            with zipfile.ZipFile(zf_path) as zf:
+                self.assertEqual(["repo1/main.c"], zf.namelist())
+            self.assertEqual({"glob": 1, "mime": 1, "size": 1}, counts)
+
+if __name__ == '__main__':
+    unittest.main()
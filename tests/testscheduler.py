@@ -0,0 +1,62 @@
+import unittest
+from datatypes import Config, Project, Status, Subproject
+from scheduler import STAGE_FOSSOLOGY_UPLOAD, STAGE_SBOM, STAGE_WS, ZIPPEDCODE_STAGES, StageScheduler, getEnabledZippedCodeStages, getReadyStages
+
+# a CPU step, run in a worker process
+def _cpuStep(scaffold_home, cfg, fossologyServer, prj, sp):
+    prj._ws_env = {"PROJECTS": str(len(cfg._projects))}
+    sp._status = Status.ZIPPEDCODE
+    return True
+
+'''
+Tests working out which stages for the zipped code can run
+'''
+class TestScheduler(unittest.TestCase):
+
+    def test_enabled_stages(self):
+        cfg = Config()
+        prj = Project()
+        sp = Subproject()
+        self.assertEqual([STAGE_FOSSOLOGY_UPLOAD], getEnabledZippedCodeStages(cfg, prj, sp))
+        prj._ws_enabled = True
+        prj._sbom_enabled = True
+        self.assertEqual([STAGE_FOSSOLOGY_UPLOAD, STAGE_WS, STAGE_SBOM], getEnabledZippedCodeStages(cfg, prj, sp))
+        sp._ws_override_disable_anyway = True
+        self.assertEqual([STAGE_FOSSOLOGY_UPLOAD, STAGE_SBOM], getEnabledZippedCodeStages(cfg, prj, sp))
+
+    def test_ready_stages(self):
+        enabled = [STAGE_FOSSOLOGY_UPLOAD, STAGE_WS]
+        # independent stages are all ready at once
+        self.assertEqual([STAGE_WS, STAGE_FOSSOLOGY_UPLOAD], getReadyStages(ZIPPEDCODE_STAGES, enabled, []))
+        self.assertEqual([STAGE_WS], getReadyStages(ZIPPEDCODE_STAGES, enabled, [STAGE_FOSSOLOGY_UPLOAD]))
+        self.assertEqual([], getReadyStages(ZIPPEDCODE_STAGES, enabled, enabled))
+
+        # a stage waits for the enabled stages it needs
+        dag = {"a": [], "b": ["a"], "c": ["a", "d"], "d": []}
+        self.assertEqual(["a"], getReadyStages(dag, ["a", "b", "c"], []))
+        self.assertEqual(["b", "c"], getReadyStages(dag, ["a", "b", "c"], ["a"]))
+
+    def test_cpu_step(self):
+        cfg = Config()
+        for name in ["prj1", "prj2"]:
+            prj = Project()
+            prj._name = name
+            cfg._projects[name] = prj
+        prj = cfg._projects["prj1"]
+        sp = Subproject()
+        sp._name = "sp1"
+        sp._status = Status.GOTCODE
+        prj._subprojects["sp1"] = sp
+        prj._ws_enabled = True
+
+        with StageScheduler(1) as scheduler:
+            self.assertTrue(scheduler.runStep("", cfg, None, prj, sp, _cpuStep))
+        # the worker only got this project, and the changes it made to the
+        # subproject and project come back, without undoing anything else
+        self.assertEqual(Status.ZIPPEDCODE, sp._status)
+        self.assertEqual({"PROJECTS": "1"}, prj._ws_env)
+        self.assertTrue(prj._ws_enabled)
+        self.assertEqual(2, len(cfg._projects))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import git
+from config import getConfigJournalFilename, loadConfig
+from datatypes import Status, ProjectRepoType
+from planning import planStepsForSubproject
+from unchanged import doCarryForwardIfUnchangedForSubproject
+
+SECRET_FILE_NAME = ".test-scaffold-secrets.json"
+TEST_SCAFFOLD_HOME = os.path.join(os.path.dirname(__file__), "testresources", "scaffoldhome")
+TEST_MONTH = "2023-07"
+TEST_PRIOR_MONTH = "2023-06"
+
+'''
+Tests carrying forward last month's results for unchanged subprojects
+'''
+class TestUnchanged(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.scaffold_home_dir = os.path.join(self.temp_dir.name, "scaffold")
+        shutil.copytree(TEST_SCAFFOLD_HOME, self.scaffold_home_dir)
+        self.remotes = os.path.join(self.temp_dir.name, "remotes")
+        self.commit = self._make_local_repo(self.remotes, "repo1")
+
+        # last month got as far as the reports, with these results
+        pulled = "2023-06-05"
+        report_dir = os.path.join(self.scaffold_home_dir, TEST_PRIOR_MONTH, "report", "prj1")
+        spdx_dir = os.path.join(self.scaffold_home_dir, TEST_PRIOR_MONTH, "spdx", "prj1")
+        code_dir = os.path.join(self.scaffold_home_dir, TEST_PRIOR_MONTH, "code", "prj1", "sp1")
+        self.prior_files = {
+            "zip": os.path.join(code_dir, f"sp1-{pulled}.zip"),
+            "spdx": os.path.join(spdx_dir, f"sp1-{pulled}.spdx"),
+            "json": os.path.join(report_dir, f"sp1-{pulled}.json"),
+            "xlsx": os.path.join(report_dir, f"sp1-{pulled}.xlsx"),
+        }
+        for path in self.prior_files.values():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(os.path.basename(path))
+
+        with open(os.path.join(self.scaffold_home_dir, TEST_MONTH, "config.json")) as f:
+            js = json.load(f)
+        js["config"]["month"] = TEST_PRIOR_MONTH
+        sp_dict = js["projects"]["prj1"]["subprojects"]["sp1"]
+        sp_dict["status"] = "DELIVERED"
+        sp_dict["code"] = {"anyfiles": True, "pulled": pulled, "path": self.prior_files["zip"], "repos": {"repo1": self.commit}}
+        sp_dict["slm"]["report-json"] = self.prior_files["json"]
+        sp_dict["slm"]["report-xlsx"] = self.prior_files["xlsx"]
+        os.makedirs(os.path.join(self.scaffold_home_dir, TEST_PRIOR_MONTH), exist_ok=True)
+        with open(os.path.join(self.scaffold_home_dir, TEST_PRIOR_MONTH, "config.json"), "w") as f:
+            json.dump(js, f)
+
+        self.cfg = loadConfig(os.path.join(self.scaffold_home_dir, TEST_MONTH, "config.json"), self.scaffold_home_dir, SECRET_FILE_NAME)
+        self.cfg._storepath = self.scaffold_home_dir
+        self.cfg._zippath = self.scaffold_home_dir
+        self.prj = self.cfg._projects["prj1"]
+        self.prj._repotype = ProjectRepoType.GERRIT
+        self.prj._gerrit_apiurl = self.remotes
+        self.sp = self.prj._subprojects["sp1"]
+        self.sp._repos = ["repo1"]
+        self.sp._status = Status.GOTLISTING
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _make_local_repo(self, parent, name):
+        repo_path = os.path.join(parent, name)
+        r = git.Repo.init(repo_path)
+        with open(os.path.join(repo_path, "README"), "w") as f:
+            f.write(name)
+        r.index.add(["README"])
+        actor = git.Actor("Test", "test@example.com")
+        commit = r.index.commit("initial", author=actor, committer=actor)
+        r.close()
+        return commit.hexsha
+
+    def test_carry_forward_unchanged(self):
+        self.assertTrue(doCarryForwardIfUnchangedForSubproject(self.scaffold_home_dir, self.cfg, self.prj, self.sp))
+        self.assertEqual(Status.CREATEDREPORTS, self.sp._status)
+        self.assertEqual(TEST_PRIOR_MONTH, self.sp._code_unchanged_from)
+        self.assertEqual({"repo1": self.commit}, self.sp._code_repos)
+        for path in [self.sp._code_path, self.sp._slm_report_json, self.sp._slm_report_xlsx]:
+            self.assertIn(os.sep + TEST_MONTH + os.sep, path)
+            self.assertTrue(os.path.isfile(path))
+
+    def test_changed_repo_not_carried_forward(self):
+        self._make_local_repo(self.remotes, "repo2")
+        self.sp._repos = ["repo1", "repo2"]
+        self.assertFalse(doCarryForwardIfUnchangedForSubproject(self.scaffold_home_dir, self.cfg, self.prj, self.sp))
+        self.assertEqual(Status.GOTLISTING, self.sp._status)
+
+        # same repos, but a new commit
+        self.sp._repos = ["repo1"]
+        r = git.Repo(os.path.join(self.remotes, "repo1"))
+        actor = git.Actor("Test", "test@example.com")
+        r.index.commit("change", author=actor, committer=actor)
+        r.close()
+        self.assertFalse(doCarryForwardIfUnchangedForSubproject(self.scaffold_home_dir, self.cfg, self.prj, self.sp))
+        self.assertEqual("", self.sp._code_unchanged_from)
+
+    def test_prior_month_journal_replayed(self):
+        # last month's config.json has a stale commit, but its journal has
+        # the commit that was actually scanned
+        prior_cfg_file = os.path.join(self.scaffold_home_dir, TEST_PRIOR_MONTH, "config.json")
+        with open(prior_cfg_file) as f:
+            js = json.load(f)
+        sp_dict = js["projects"]["prj1"]["subprojects"]["sp1"]
+        with open(getConfigJournalFilename(self.scaffold_home_dir, TEST_PRIOR_MONTH), "w") as f:
+            f.write(json.dumps({"project": "prj1", "subproject": "sp1", "subproject-fields": dict(sp_dict)}) + "\n")
+        sp_dict["code"] = dict(sp_dict["code"], repos={"repo1": "0" * 40})
+        with open(prior_cfg_file, "w") as f:
+            json.dump(js, f)
+        self.assertTrue(doCarryForwardIfUnchangedForSubproject(self.scaffold_home_dir, self.cfg, self.prj, self.sp))
+        self.assertEqual({"repo1": self.commit}, self.sp._code_repos)
+
+    def test_plan_carry_forward(self):
+        # plan walks the same steps as run, so it only shows the clone and
+        # scans if the subproject wouldn't be carried forward
+        steps, stopStatus = planStepsForSubproject(self.scaffold_home_dir, self.cfg, self.prj, self.sp)
+        self.assertEqual("clone repos", steps[0][1])
+        self.assertEqual(Status.RANAGENTS, stopStatus)
+
+        self.cfg._skip_unchanged = True
+        steps, stopStatus = planStepsForSubproject(self.scaffold_home_dir, self.cfg, self.prj, self.sp)
+        self.assertEqual([(Status.GOTLISTING, "carry forward unchanged results"), (Status.CREATEDREPORTS, "make draft findings")], steps)
+        self.assertEqual(Status.MADEDRAFTFINDINGS, stopStatus)
+        # and nothing was carried forward
+        self.assertEqual(Status.GOTLISTING, self.sp._status)
+        self.assertEqual("", self.sp._code_unchanged_from)
+
+if __name__ == '__main__':
+    unittest.main()
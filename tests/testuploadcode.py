@@ -0,0 +1,138 @@
+import unittest
+import json
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import requests
+import uploadcode
+from uploadcode import upload_file
+
+'''
+Tests streaming uploads to Fossology, against a local stand-in for its API
+'''
+class TestUploadCode(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.zipPath = os.path.join(self.temp_dir.name, "sp.zip")
+        self.content = os.urandom(3 * uploadcode.UPLOAD_CHUNK_SIZE + 123)
+        with open(self.zipPath, "wb") as f:
+            f.write(self.content)
+        self.saved = (uploadcode.TIME_BETWEEN_RETRIES, uploadcode.UPLOAD_ATTEMPTS)
+        uploadcode.TIME_BETWEEN_RETRIES = 0
+        uploadcode.UPLOAD_ATTEMPTS = 3
+        # status codes to answer POSTs with, before answering 201
+        self.post_failures = []
+        self.posts = 0
+        self.gets = 0
+        self.bodies = []
+        test = self
+
+        class StandIn(BaseHTTPRequestHandler):
+            def do_POST(self):
+                test.posts += 1
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                code = test.post_failures.pop(0) if test.post_failures != [] else 201
+                if code == 201:
+                    test.bodies.append((self.headers["Content-Type"], self.headers["folderId"], body))
+                self._send(code, {"message": 42})
+
+            def do_GET(self):
+                test.gets += 1
+                # still unpacking the first time it's checked
+                if test.gets == 1:
+                    self._send(503, {})
+                    return
+                self._send(200, {"folderid": 7, "foldername": "prj-2021-09", "id": 42, "description": "",
+                    "uploadname": "sp.zip", "uploaddate": "", "hash": {"sha1": "abc", "md5": "", "sha256": "", "size": 0}})
+
+            def _send(self, code, js):
+                out = json.dumps(js).encode()
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.fossologyServer = SimpleNamespace(session=requests.Session(), api=f"http://127.0.0.1:{self.httpd.server_address[1]}")
+        self.folder = SimpleNamespace(id=7)
+
+    def tearDown(self):
+        uploadcode.TIME_BETWEEN_RETRIES, uploadcode.UPLOAD_ATTEMPTS = self.saved
+        self.fossologyServer.session.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.temp_dir.cleanup()
+
+    def test_upload_streamed(self):
+        metrics = {}
+        upload = upload_file(self.fossologyServer, self.folder, self.zipPath, metrics=metrics)
+        self.assertEqual(42, upload.id)
+        self.assertEqual((1, 2), (self.posts, self.gets))
+
+        # the body is the multipart form Fossology expects
+        contentType, folderId, body = self.bodies[0]
+        self.assertEqual("7", folderId)
+        boundary = contentType.split("boundary=")[1]
+        self.assertTrue(body.startswith(f'--{boundary}\r\nContent-Disposition: form-data; name="fileInput"; filename="sp.zip"'.encode()))
+        self.assertTrue(body.endswith(self.content + f"\r\n--{boundary}--\r\n".encode()))
+        self.assertEqual(len(self.content), metrics["upload-bytes"])
+        self.assertEqual(len(self.content), metrics["upload-sent"])
+        self.assertEqual(1, metrics["upload-tries"])
+
+    def test_upload_retried(self):
+        self.post_failures = [500]
+        metrics = {}
+        self.assertEqual(42, upload_file(self.fossologyServer, self.folder, self.zipPath, metrics=metrics).id)
+        self.assertEqual(2, self.posts)
+        self.assertEqual(2 * len(self.content), metrics["upload-sent"])
+        self.assertEqual(2, metrics["upload-tries"])
+
+        # but not for errors that won't go away
+        self.post_failures = [403]
+        with self.assertRaises(Exception):
+            upload_file(self.fossologyServer, self.folder, self.zipPath)
+        self.post_failures = [500, 502, 503]
+        with self.assertRaises(Exception):
+            upload_file(self.fossologyServer, self.folder, self.zipPath)
+
+    def test_upload_found_after_failure(self):
+        # Fossology took the file in, but the response was lost
+        self.post_failures = [502]
+        existing = SimpleNamespace(id=41)
+        upload = upload_file(self.fossologyServer, self.folder, self.zipPath, findExisting=lambda: existing)
+        self.assertEqual(41, upload.id)
+        self.assertEqual((1, 0), (self.posts, self.gets))
+
+    def test_upload_index_listed_once(self):
+        calls = []
+        upload = SimpleNamespace(id=7, hash=SimpleNamespace(sha1="ABC"), filesha1=None)
+        def list_uploads(**kwargs):
+            calls.append(kwargs)
+            return [upload], 1
+        server = SimpleNamespace(list_uploads=list_uploads)
+        cfg = SimpleNamespace(_fossology_upload_indexes={})
+        prj = SimpleNamespace(_name="prj")
+        prjFolder = SimpleNamespace(id=3)
+        for _ in range(3):
+            index = uploadcode.getProjectUploadIndex(cfg, server, prj, prjFolder)
+            self.assertEqual(index, {"abc": upload})
+        self.assertEqual(len(calls), 1)
+        # new uploads are added to the index without listing again
+        newUpload = SimpleNamespace(id=8)
+        uploadcode.addToProjectUploadIndex(cfg, prjFolder, "def", newUpload)
+        self.assertIs(uploadcode.getProjectUploadIndex(cfg, server, prj, prjFolder)["def"], newUpload)
+        self.assertEqual(len(calls), 1)
+        # looking for one zip file only lists uploads with its name
+        self.assertIs(uploadcode.findUploadOfZip(server, prjFolder, "/tmp/sp.zip", "abc"), upload)
+        self.assertEqual(calls[1]["name"], "sp.zip")
+        self.assertFalse(calls[1]["recursive"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import os
+import tempfile
+from datatypes import Config, Project, Secrets, Subproject, WSSecret
+from ws.wsagent import getWSBatches, runAgentCommand
+from ws.wscfg import getWSProductName
+
+'''
+Tests grouping subprojects for batch runs of the WhiteSource unified agent
+'''
+class TestWSAgent(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = Config()
+        self.cfg._secrets = Secrets()
+        ws_secret = WSSecret()
+        ws_secret._ws_api_key = "org-token"
+        ws_secret._ws_api_key_overrides = {"other-org": "other-token"}
+        self.cfg._secrets._ws["prj"] = ws_secret
+        self.prj = Project()
+        self.prj._name = "prj"
+
+    def _new_sp(self, name, product="", project=""):
+        sp = Subproject()
+        sp._name = name
+        sp._ws_override_product = product
+        sp._ws_override_project = project
+        return sp
+
+    def test_batches(self):
+        sps = [
+            self._new_sp("a", product="shared"),
+            self._new_sp("b", product="shared"),
+            self._new_sp("c"),
+            self._new_sp("d", product="shared", project="a"),
+            self._new_sp("other-org", product="shared"),
+        ]
+        batches = getWSBatches(self.cfg, self.prj, sps)
+        # d goes to the same WS project as a, so can't share its folder
+        self.assertEqual([["a", "b"], ["c"], ["d"], ["other-org"]], [[sp._name for sp in b] for b in batches])
+
+    def test_batches_env(self):
+        sps = [self._new_sp("a", product="shared"), self._new_sp("b", product="shared")]
+        sps[1]._ws_env = {"WS_EXCLUDES": "**/test/**"}
+        self.assertEqual(2, len(getWSBatches(self.cfg, self.prj, sps)))
+
+    def test_batches_default_product(self):
+        # without overrides, each subproject has its own product, unless
+        # batch mode puts them all in the project's product
+        sps = [self._new_sp("a"), self._new_sp("b")]
+        self.assertEqual([["a"], ["b"]], [[sp._name for sp in b] for b in getWSBatches(self.cfg, self.prj, sps)])
+        self.cfg._ws_batch = True
+        self.assertEqual([["a", "b"]], [[sp._name for sp in b] for b in getWSBatches(self.cfg, self.prj, sps)])
+        self.assertEqual("prj", getWSProductName(self.cfg, self.prj, sps[0]))
+
+    def test_log_output(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            logPath = os.path.join(temp_dir, "ws", "prj", "a-ws.log")
+            cmd = ["python3", "-c", "import sys\nfor i in range(50): print(i)\nsys.exit(3)"]
+            returncode, tail = runAgentCommand(cmd, dict(os.environ), logPath)
+            self.assertEqual(3, returncode)
+            self.assertEqual("".join([f"{i}\n" for i in range(30, 50)]), tail)
+            with open(logPath, "r") as f:
+                self.assertEqual(50, len(f.readlines()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datatypes import Config, Project
+import ws.wsapi
+from ws.wsapi import RateLimiter, createProduct, getProductToken, getProjectToken
+
+'''
+Tests getting WhiteSource tokens, against a local stand-in for the API
+'''
+class TestWSAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.products = {f"product{i}": f"prd-token{i}" for i in range(8)}
+        self.requests = []
+        test = self
+
+        class StandIn(BaseHTTPRequestHandler):
+            def do_POST(self):
+                js = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                test.requests.append(js["requestType"])
+                rj = {"message": "Success"}
+                if js["requestType"] == "getAllProducts":
+                    rj["products"] = [{"productName": name, "productToken": token} for name, token in test.products.items()]
+                elif js["requestType"] == "getAllProjects":
+                    i = js["productToken"][len("prd-token"):]
+                    rj["projects"] = [{"projectName": f"project{i}", "projectToken": f"prj-token{i}"}]
+                elif js["requestType"] == "createProduct":
+                    test.products[js["productName"]] = "prd-new"
+                    rj["productToken"] = "prd-new"
+                body = json.dumps(rj).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.temp_dir.cleanup()
+
+    def _new_cfg(self):
+        cfg = Config()
+        cfg._storepath = self.temp_dir.name
+        cfg._ws_api_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/api/v1.3"
+        cfg._ws_api_rate = 0
+        return cfg
+
+    def _new_prj(self):
+        prj = Project()
+        prj._name = "prj1"
+        return prj
+
+    def test_tokens_cached(self):
+        cfg = self._new_cfg()
+        prj = self._new_prj()
+        self.assertEqual("prd-token3", getProductToken(cfg, prj, "product3", "userkey", "org"))
+        self.assertEqual("prj-token7", getProjectToken(cfg, prj, "project7", "userkey", "org"))
+        self.assertEqual(["getAllProducts"] + ["getAllProjects"] * 8, self.requests)
+
+        # the next run uses the cache
+        self.requests.clear()
+        self.assertEqual("prj-token5", getProjectToken(cfg, self._new_prj(), "project5", "userkey", "org"))
+        self.assertEqual([], self.requests)
+
+        # unless it's too old
+        cachePath = ws.wsapi.getTokenCachePath(cfg, ws.wsapi.getOrgTokenKey("org"))
+        with open(cachePath) as f:
+            js = json.load(f)
+        js["fetched"] -= 25 * 3600
+        with open(cachePath, "w") as f:
+            json.dump(js, f)
+        self.assertEqual("prj-token5", getProjectToken(cfg, self._new_prj(), "project5", "userkey", "org"))
+        self.assertEqual(9, len(self.requests))
+        self.assertNotIn("org", open(cachePath).read())
+
+    def test_cache_miss_and_create(self):
+        cfg = self._new_cfg()
+        getProductToken(cfg, self._new_prj(), "product0", "userkey", "org")
+
+        # a product made since the cache was saved is found by asking again
+        self.products["product8"] = "prd-token8"
+        self.requests.clear()
+        prj = self._new_prj()
+        self.assertEqual("prd-token8", getProductToken(cfg, prj, "product8", "userkey", "org"))
+        self.assertEqual(["getAllProducts"] + ["getAllProjects"] * 9, self.requests)
+
+        # but not again in the same run, and made products are cached
+        self.requests.clear()
+        self.assertEqual("", getProductToken(cfg, prj, "product9", "userkey", "org"))
+        self.assertEqual("prd-new", createProduct(cfg, prj, "userkey", "org", "product9"))
+        self.assertEqual(["createProduct"], self.requests)
+        self.requests.clear()
+        self.assertEqual("prd-new", getProductToken(cfg, self._new_prj(), "product9", "userkey", "org"))
+        self.assertEqual([], self.requests)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(20)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.wait) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # the first goes straight away, and the others 1/20 s apart
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+import os
+import json
+import tempfile
+import zipfile
+import zipbuilder
+from zipbuilder import buildZip, getFileSHA1, getManifestPath
+
+'''
+Tests building zip files of code
+'''
+class TestZipBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.src_path = os.path.join(self.temp_dir.name, "src")
+        self.files = {
+            "repo2/main.c": b"int main() { return 0; }\n" * 100,
+            "repo1/logo.png": os.urandom(1000),
+            "repo1/docs/README": b"read me\n" * 50,
+            "repo1/empty": b"",
+        }
+        for path, data in self.files.items():
+            fpath = os.path.join(self.src_path, path)
+            os.makedirs(os.path.dirname(fpath), exist_ok=True)
+            with open(fpath, "wb") as f:
+                f.write(data)
+        os.symlink("main.c", os.path.join(self.src_path, "repo2", "link.c"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_build_zip(self):
+        zf_path = os.path.join(self.temp_dir.name, "sp1-2023-07-09.zip")
+        buildZip(self.src_path, zf_path, workers=3)
+        with zipfile.ZipFile(zf_path) as zf:
+            self.assertIsNone(zf.testzip())
+            # sorted, and without the symlink
+            self.assertEqual(sorted(self.files.keys()), zf.namelist())
+            for path, data in self.files.items():
+                self.assertEqual(data, zf.read(path))
+            self.assertEqual(zipfile.ZIP_STORED, zf.getinfo("repo1/logo.png").compress_type)
+            self.assertEqual(zipfile.ZIP_DEFLATED, zf.getinfo("repo2/main.c").compress_type)
+
+        with open(getManifestPath(zf_path)) as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(self.files.keys()), [m["path"] for m in manifest])
+        self.assertEqual({"path": "repo1/empty", "size": 0, "sha1": "da39a3ee5e6b4b0d3255bfef95601890afd80709"}, manifest[1])
+
+    def test_build_zip_deterministic(self):
+        zf_path1 = os.path.join(self.temp_dir.name, "first.zip")
+        buildZip(self.src_path, zf_path1, workers=1)
+
+        # same code, cloned at another time and with other permissions
+        main_path = os.path.join(self.src_path, "repo2", "main.c")
+        os.utime(main_path, (1700000000, 1700000000))
+        os.chmod(main_path, 0o664)
+        os.chmod(os.path.join(self.src_path, "repo1", "docs", "README"), 0o600)
+        zf_path2 = os.path.join(self.temp_dir.name, "second.zip")
+        buildZip(self.src_path, zf_path2, workers=3)
+        self.assertEqual(getFileSHA1(zf_path1), getFileSHA1(zf_path2))
+
+        # but being executable is kept
+        os.chmod(main_path, 0o775)
+        zf_path3 = os.path.join(self.temp_dir.name, "third.zip")
+        buildZip(self.src_path, zf_path3, workers=3)
+        self.assertNotEqual(getFileSHA1(zf_path1), getFileSHA1(zf_path3))
+        with zipfile.ZipFile(zf_path3) as zf:
+            self.assertEqual((1980, 1, 1, 0, 0, 0), zf.getinfo("repo2/main.c").date_time)
+            self.assertEqual(0o755, (zf.getinfo("repo2/main.c").external_attr >> 16) & 0o777)
+            self.assertEqual(0o644, (zf.getinfo("repo1/docs/README").external_attr >> 16) & 0o777)
+
+    def test_build_zip_public_api(self):
+        # without the ZipFile internals, or with little memory to spare,
+        # the same zip file is made
+        zf_path1 = os.path.join(self.temp_dir.name, "first.zip")
+        buildZip(self.src_path, zf_path1, workers=3)
+        saved = (zipbuilder.RAW_WRITE_SUPPORTED, zipbuilder.MAX_BYTES_IN_FLIGHT)
+        try:
+            zipbuilder.RAW_WRITE_SUPPORTED = False
+            zipbuilder.MAX_BYTES_IN_FLIGHT = 100
+            zf_path2 = os.path.join(self.temp_dir.name, "second.zip")
+            buildZip(self.src_path, zf_path2, workers=3)
+        finally:
+            zipbuilder.RAW_WRITE_SUPPORTED, zipbuilder.MAX_BYTES_IN_FLIGHT = saved
+        with zipfile.ZipFile(zf_path2) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zipfile.ZIP_STORED, zf.getinfo("repo1/logo.png").compress_type)
+        self.assertEqual(getFileSHA1(zf_path1), getFileSHA1(zf_path2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from datetime import datetime
+import json
+import os
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+import statistics
+import threading
+import time
+import zipfile
+
+from tabulate import tabulate
+
+from config import isInThisCycle
+from datatypes import StageClass, Status
+from scheduler import getStageClass
+
+# steps whose work grows with the size of the subproject's code
+CODE_VOLUME_STEPS = [Status.GOTLISTING, Status.GOTCODE, Status.ZIPPEDCODE, Status.UPLOADEDWS]
+
+# stage name used for project-level repo listings
+PROJECT_LISTING_STAGE = "PROJECTLISTING"
+
+# serializes appends from threads in this process
+_timings_lock = threading.Lock()
+
+def getTimingsFilename(scaffold_home, month):
+    return os.path.join(scaffold_home, month, "timings.jsonl")
+
+def appendTiming(scaffold_home, month, record):
+    line = json.dumps(record) + "\n"
+    with _timings_lock:
+        # one write per record, so that records appended by worker
+        # processes at the same time don't get interleaved
+        with open(getTimingsFilename(scaffold_home, month), "a") as f:
+            f.write(line)
+
+# Loads timing records for this month, or for all months if month is "";
+# returns a list of dicts.
+def loadTimings(scaffold_home, month=""):
+    if month != "":
+        months = [month]
+    else:
+        months = sorted(os.listdir(scaffold_home)) if os.path.isdir(scaffold_home) else []
+
+    records = []
+    for ym in months:
+        timingsFilename = getTimingsFilename(scaffold_home, ym)
+        if not os.path.isfile(timingsFilename):
+            continue
+        with open(timingsFilename, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # a crash while appending can leave a partial last line
+                    continue
+    return records
+
+# Gets the number of files and bytes of this subproject's code: from the
+# zip file if it has been made, or else from the cloned code.
+def getCodeVolume(cfg, prj, sp):
+    if sp._code_path != "" and os.path.isfile(sp._code_path):
+        try:
+            with zipfile.ZipFile(sp._code_path) as zf:
+                numFiles = len(zf.infolist())
+        except zipfile.BadZipFile:
+            numFiles = 0
+        return numFiles, os.path.getsize(sp._code_path)
+
+    numFiles = 0
+    numBytes = 0
+    sp_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name)
+    for root, dirs, files in os.walk(sp_path):
+        if ".git" in dirs:
+            dirs.remove(".git")
+        for name in files:
+            try:
+                numBytes += os.path.getsize(os.path.join(root, name))
+                numFiles += 1
+            except OSError:
+                continue
+    return numFiles, numBytes
+
+# Gets the CPU time used by child processes that have finished, such as
+# git, java and trivy.
+def getChildrenCPU():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+# Runs fn, and records how long it took as a step for this project and
+# subproject (sp may be None for project-level steps), even if it raises.
+# The CPU time is this thread's plus that of the child processes that
+# finished meanwhile; when steps run side by side in one process, the
+# latter can include other steps' children. Returns what fn returned.
+def runTimedStep(scaffold_home, cfg, prj, sp, stage, fn, *args):
+    start = datetime.now()
+    startWall = time.perf_counter()
+    startCPU = time.thread_time()
+    startChildCPU = getChildrenCPU()
+    retval = None
+    error = None
+    try:
+        retval = fn(*args)
+        return retval
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        try:
+            recordStep(scaffold_home, cfg, prj, sp, stage, retval, error, start, time.perf_counter() - startWall, time.thread_time() - startCPU, getChildrenCPU() - startChildCPU)
+        except Exception as e:
+            # don't hide what the step itself returned or raised
+            print(f"{prj._name}: unable to record timing: {e}")
+
+def recordStep(scaffold_home, cfg, prj, sp, stage, retval, error, start, wall, cpu, childCPU):
+    record = {
+        "month": cfg._month,
+        "project": prj._name,
+        "subproject": sp._name if sp is not None else "",
+        "stage": stage,
+        "ok": bool(retval) and error is None,
+        "start": start.isoformat(timespec="seconds"),
+        "end": datetime.now().isoformat(timespec="seconds"),
+        "wall": round(wall, 3),
+        "cpu": round(cpu + childCPU, 3),
+        "child-cpu": round(childCPU, 3),
+    }
+    if error is not None:
+        record["error"] = f"{type(error).__name__}: {error}"
+    if sp is not None:
+        record["status"] = sp._status.name
+        record["repos"] = len(sp._repos)
+        if stage in [s.name for s in CODE_VOLUME_STEPS]:
+            record["files"], record["bytes"] = getCodeVolume(cfg, prj, sp)
+        if sp._upload_metrics != {}:
+            record.update(sp._upload_metrics)
+            sp._upload_metrics = {}
+    else:
+        record["status"] = prj._status.name
+        record["repos"] = sum([len(sp._repos) for sp in prj._subprojects.values()])
+
+    try:
+        appendTiming(scaffold_home, cfg._month, record)
+    except OSError as e:
+        print(f"{prj._name}: unable to record timing: {e}")
+
+# Wraps one of the runners' doNextThingFor...Subproject functions, so that
+# each step that does something gets timed; steps that only wait for
+# manual action aren't recorded. Can be sent to a worker process.
+def runTimedSubprojectStep(nextThingFn, scaffold_home, cfg, fossologyServer, prj, sp):
+    if getStageClass(sp._status) == StageClass.NONE or not isInThisCycle(cfg, prj, sp):
+        return nextThingFn(scaffold_home, cfg, fossologyServer, prj, sp)
+    return runTimedStep(scaffold_home, cfg, prj, sp, sp._status.name, nextThingFn, scaffold_home, cfg, fossologyServer, prj, sp)
+
+def formatSeconds(secs):
+    secs = int(round(secs))
+    if secs >= 3600:
+        return f"{secs // 3600}h{(secs % 3600) // 60:02d}m"
+    if secs >= 60:
+        return f"{secs // 60}m{secs % 60:02d}s"
+    return f"{secs}s"
+
+def _summarizeTimings(records, keyFn):
+    groups = {}
+    for r in records:
+        groups.setdefault(keyFn(r), []).append(r)
+
+    table = []
+    for key, rs in groups.items():
+        walls = [r.get("wall", 0) for r in rs]
+        totalWall = sum(walls)
+        totalBytes = sum([r.get("bytes", 0) for r in rs])
+        throughput = f"{totalBytes / totalWall / (1024 * 1024):.1f} MB/s" if totalBytes > 0 and totalWall > 0 else ""
+        table.append(list(key) + [
+            len(rs),
+            len([r for r in rs if not r.get("ok", False)]),
+            formatSeconds(totalWall),
+            formatSeconds(statistics.median(walls)),
+            formatSeconds(max(walls)),
+            formatSeconds(sum([r.get("cpu", 0) for r in rs])),
+            sum([r.get("files", 0) for r in rs]),
+            throughput,
+        ])
+    return sorted(table, key=lambda row: [str(k) for k in row[:len(key)]])
+
+# Prints timing records aggregated by stage, project or subproject for
+# this month, or by month and stage across all months.
+def printTimings(scaffold_home, cfg, prj_only, sp_only, by="stage"):
+    if by == "month":
+        records = loadTimings(scaffold_home)
+    else:
+        records = loadTimings(scaffold_home, cfg._month)
+    records = [r for r in records if (prj_only == "" or r.get("project") == prj_only) and (sp_only == "" or r.get("subproject") == sp_only)]
+    if records == []:
+        print(f"No timings recorded")
+        return
+
+    statHeaders = ["Steps", "Failed", "Total time", "Median", "Max", "CPU", "Files", "Throughput"]
+    if by == "stage":
+        headers = ["Stage"]
+        keyFn = lambda r: (r.get("stage", ""),)
+    elif by == "project":
+        headers = ["Project", "Stage"]
+        keyFn = lambda r: (r.get("project", ""), r.get("stage", ""))
+    elif by == "subproject":
+        headers = ["Project", "Subproject", "Stage"]
+        keyFn = lambda r: (r.get("project", ""), r.get("subproject", ""), r.get("stage", ""))
+    elif by == "month":
+        headers = ["Month", "Stage"]
+        keyFn = lambda r: (r.get("month", ""), r.get("stage", ""))
+    else:
+        print(f"Invalid value for --by: {by}; expected stage, project, subproject or month")
+        return
+    print(tabulate(_summarizeTimings(records, keyFn), headers=headers + statHeaders))
+
+    # and the slowest individual steps
+    print("")
+    slowest = sorted(records, key=lambda r: r.get("wall", 0), reverse=True)[:10]
+    table = [[r.get("month", ""), r.get("project", ""), r.get("subproject", ""), r.get("stage", ""), formatSeconds(r.get("wall", 0)), r.get("start", "")] for r in slowest]
+    print(tabulate(table, headers=["Month", "Project", "Subproject", "Stage", "Time", "Started"]))
+
+# Estimates how long the given stage will take for this subproject, from
+# recorded timings: the subproject's own most recent successful run of
+# the stage if there is one, or else the median for the stage scaled by
+# code size where that's known. Returns None if there's no history.
+def estimateStageSeconds(records, prj, sp, status, numBytes):
+    stage = status.name
+    stageRecords = [r for r in records if r.get("stage") == stage and r.get("ok", False)]
+    if stageRecords == []:
+        return None
+
+    own = [r for r in stageRecords if r.get("project") == prj._name and r.get("subproject") == sp._name]
+    if own != []:
+        return own[-1].get("wall", 0)
+
+    if status in CODE_VOLUME_STEPS and numBytes > 0:
+        rates = [r["wall"] / r["bytes"] for r in stageRecords if r.get("bytes", 0) > 0]
+        if rates != []:
+            return statistics.median(rates) * numBytes
+
+    return statistics.median([r.get("wall", 0) for r in stageRecords])
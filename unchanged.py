@@ -0,0 +1,166 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+
+import git
+
+from config import loadPriorMonthConfigJSON
+from datatypes import Status
+from getcode import getCloneWorkers, getRepoURL
+from zipbuilder import getManifestPath
+
+# Gets the current top commit of each of the subproject's repos, on the
+# branch that would be cloned, with up to the clone workers' worth of
+# `git ls-remote` calls at a time. Returns a mapping of repo name to
+# commit, with "" for repos that have no commits, or None if any of them
+# couldn't be reached.
+def getRemoteHeads(cfg, prj, sp):
+    ref = f"refs/heads/{sp._github_branch}" if sp._github_branch != "" else "HEAD"
+
+    def lsRemote(repo):
+        out = git.Git().ls_remote(getRepoURL(prj, sp, repo), ref)
+        for line in out.splitlines():
+            commit, _, name = line.partition("\t")
+            if name == ref:
+                return commit
+        return ""
+
+    heads = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(getCloneWorkers(cfg, prj), len(sp._repos)))) as pool:
+        futures = [(repo, pool.submit(lsRemote, repo)) for repo in sp._repos]
+        for repo, future in futures:
+            try:
+                heads[repo] = future.result()
+            except git.exc.GitError as e:
+                print(f"{prj._name}/{sp._name}: unable to check {repo} for changes: {e}")
+                return None
+    return heads
+
+# Hard links src to dst if they're on the same file system, or else copies it.
+def carryForwardFile(src, dst):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# Gets the status that a subproject carried forward skips ahead to: for
+# projects with combined reports, GOTSPDX, so that the combined JSON and
+# report are still made, or else CREATEDREPORTS.
+def getCarryForwardStatus(prj):
+    if prj._slm_combined_report:
+        return Status.GOTSPDX
+    return Status.CREATEDREPORTS
+
+# Checks whether none of the subproject's repos has changed since last
+# month, and last month's results got as far as the reports and are all
+# still there, without changing anything. Returns what
+# carryForwardPriorResults needs to bring them into this month, or None if
+# the subproject should go on as usual.
+def findUnchangedPriorResults(scaffold_home, cfg, prj, sp):
+    if len(sp._repos) == 0:
+        return None
+
+    prior_js = loadPriorMonthConfigJSON(scaffold_home, cfg)
+    priorYM = prior_js.get('config', {}).get('month', "")
+    prior_sp_dict = prior_js.get('projects', {}).get(prj._name, {}).get('subprojects', {}).get(sp._name, {})
+    if priorYM == "" or prior_sp_dict == {}:
+        return None
+    prior_status = Status.__members__.get(prior_sp_dict.get('status', ""), Status.UNKNOWN)
+    if prior_status == Status.STOPPED or prior_status.value < Status.CREATEDREPORTS.value:
+        return None
+    prior_code_dict = prior_sp_dict.get('code', {})
+    prior_repos = prior_code_dict.get('repos', {})
+    if sorted(prior_repos.keys()) != sorted(sp._repos):
+        return None
+
+    # all of last month's results must still be there
+    pulled = prior_code_dict.get('pulled', "")
+    prior_slm_dict = prior_sp_dict.get('slm', {})
+    priorReportFolder = os.path.join(cfg._storepath, priorYM, "report", prj._name)
+    artifacts = {
+        "zip": prior_code_dict.get('path', ""),
+        "spdx": os.path.join(cfg._storepath, priorYM, "spdx", prj._name, f"{sp._name}-{pulled}.spdx"),
+        "json": prior_slm_dict.get('report-json', ""),
+        "xlsx": prior_slm_dict.get('report-xlsx', ""),
+    }
+    if pulled == "" or not all([path != "" and os.path.isfile(path) for path in artifacts.values()]):
+        return None
+    # instances are only there if last month's findings were made
+    instancesPath = os.path.join(priorReportFolder, f"{sp._name}-instances-{pulled}.json")
+
+    heads = getRemoteHeads(cfg, prj, sp)
+    if heads is None or heads != prior_repos:
+        return None
+
+    return {
+        "month": priorYM,
+        "code": prior_code_dict,
+        "slm": prior_slm_dict,
+        "artifacts": artifacts,
+        "instances": instancesPath,
+    }
+
+# Brings last month's zip, SPDX file, SLM JSON, XLSX report and instances,
+# as found by findUnchangedPriorResults, into this month and skips ahead to
+# getCarryForwardStatus, so that the code isn't cloned, uploaded or scanned
+# again. Returns True if it skipped ahead, or False if they couldn't be
+# brought in.
+def carryForwardPriorResults(cfg, prj, sp, prior):
+    priorYM = prior["month"]
+    prior_code_dict = prior["code"]
+    prior_slm_dict = prior["slm"]
+    artifacts = prior["artifacts"]
+    instancesPath = prior["instances"]
+    pulled = prior_code_dict.get('pulled', "")
+
+    print(f"{prj._name}/{sp._name}: no repos changed since {priorYM}, carrying forward its results")
+    sp_path = os.path.join(cfg._zippath, cfg._month, "code", prj._name, sp._name)
+    spdxFolder = os.path.join(cfg._storepath, cfg._month, "spdx", prj._name)
+    reportFolder = os.path.join(cfg._storepath, cfg._month, "report", prj._name)
+    try:
+        zipPath = os.path.join(sp_path, os.path.basename(artifacts["zip"]))
+        carryForwardFile(artifacts["zip"], zipPath)
+        if os.path.isfile(getManifestPath(artifacts["zip"])):
+            carryForwardFile(getManifestPath(artifacts["zip"]), getManifestPath(zipPath))
+        carryForwardFile(artifacts["spdx"], os.path.join(spdxFolder, os.path.basename(artifacts["spdx"])))
+        if not prj._slm_combined_report:
+            jsonPath = os.path.join(reportFolder, os.path.basename(artifacts["json"]))
+            carryForwardFile(artifacts["json"], jsonPath)
+            xlsxPath = os.path.join(reportFolder, os.path.basename(artifacts["xlsx"]))
+            carryForwardFile(artifacts["xlsx"], xlsxPath)
+            if os.path.isfile(instancesPath):
+                carryForwardFile(instancesPath, os.path.join(reportFolder, os.path.basename(instancesPath)))
+    except OSError as e:
+        print(f"{prj._name}/{sp._name}: unable to carry forward results from {priorYM}, getting code instead: {e}")
+        return False
+
+    sp._code_pulled = pulled
+    sp._code_path = zipPath
+    sp._code_anyfiles = prior_code_dict.get('anyfiles', True)
+    sp._code_repos = prior_code_dict.get('repos', {})
+    sp._code_sha1 = prior_code_dict.get('sha1', "")
+    sp._code_excluded = prior_code_dict.get('excluded', {})
+    sp._code_scan_excluded = prior_code_dict.get('scan-excluded', {})
+    sp._code_unchanged_from = priorYM
+    if not prj._slm_combined_report:
+        sp._slm_report_json = jsonPath
+        sp._slm_report_xlsx = xlsxPath
+        sp._slm_pending_lics = prior_slm_dict.get('licenses-pending', [])
+    sp._status = getCarryForwardStatus(prj)
+    return True
+
+# Pre-check for GOTLISTING: if the subproject is unchanged since last month
+# (see findUnchangedPriorResults), carries forward last month's results.
+# Returns True if it skipped ahead, or False if the subproject should go
+# on as usual.
+def doCarryForwardIfUnchangedForSubproject(scaffold_home, cfg, prj, sp):
+    if sp._status != Status.GOTLISTING:
+        return False
+    prior = findUnchangedPriorResults(scaffold_home, cfg, prj, sp)
+    return prior is not None and carryForwardPriorResults(cfg, prj, sp, prior)
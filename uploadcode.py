@@ -2,9 +2,13 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
+import threading
 import time
+import uuid
 from pathlib import Path
+
 from fossology.obj import Upload
+import requests
 
 from datatypes import Status, ProjectRepoType
 
@@ -12,59 +16,275 @@ from datatypes import Status, ProjectRepoType
 TIME_BETWEEN_RETRIES = 10  # seconds
 RETRIES_BETWEEN_MESSAGES = 12
 
-def upload_file(fossologyServer, folder, file):
+# bytes of the zip file read and sent at a time, so that only this much of
+# it is held in memory however big it is
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# times to try sending a zip file before giving up; the wait between tries
+# starts at TIME_BETWEEN_RETRIES and doubles each time
+UPLOAD_ATTEMPTS = 4
+
+# seconds between progress messages while a zip file is being sent
+UPLOAD_PROGRESS_SECONDS = 30
+
+# seconds to wait for Fossology to connect, and then to send a response
+UPLOAD_TIMEOUT = (60, 1800)
+
+# An upload failed in a way that might not happen again, e.g. a dropped
+# connection or a server error, so it's worth trying again.
+class UploadRetryError(Exception):
+    pass
+
+# Prints how much of a file has been sent, at most every
+# UPLOAD_PROGRESS_SECONDS, and keeps track of the bytes sent over all tries.
+class UploadProgress:
+
+    def __init__(self, label, total):
+        super(UploadProgress, self).__init__()
+
+        self._label = label
+        self._total = total
+        self._start = time.monotonic()
+        self._lastMessage = self._start
+        # bytes of the file sent, over all tries
+        self._sent = 0
+
+    def update(self, numBytes, done, total):
+        self._sent += numBytes
+        now = time.monotonic()
+        if now - self._lastMessage < UPLOAD_PROGRESS_SECONDS or done == total:
+            return
+        self._lastMessage = now
+        print(f"{self._label}: sent {formatMiB(done)} of {formatMiB(total)} ({100 * done // max(total, 1)}%), {formatMiB(self._sent / (now - self._start))}/s")
+
+def formatMiB(numBytes):
+    return f"{numBytes / (1024 * 1024):.1f} MiB"
+
+# A multipart/form-data body with the file as its fileInput, as Fossology
+# expects, that reads the file a chunk at a time as it's sent rather than
+# all at once as requests does for files=. Its length is known up front, so
+# it's sent with a Content-Length rather than chunked.
+class MultipartFileBody:
+
+    def __init__(self, path, progress=None):
+        super(MultipartFileBody, self).__init__()
+
+        self._path = path
+        self._boundary = uuid.uuid4().hex
+        filename = os.path.basename(path).replace('"', "%22")
+        self._head = (f'--{self._boundary}\r\n'
+            f'Content-Disposition: form-data; name="fileInput"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode("utf-8")
+        self._tail = f"\r\n--{self._boundary}--\r\n".encode("utf-8")
+        self._size = os.path.getsize(path)
+        self._progress = progress
+
+    def getContentType(self):
+        return f"multipart/form-data; boundary={self._boundary}"
+
+    def __len__(self):
+        return len(self._head) + self._size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        done = 0
+        with open(self._path, "rb") as fp:
+            while True:
+                chunk = fp.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                done += len(chunk)
+                if self._progress:
+                    self._progress.update(len(chunk), done, self._size)
+                yield chunk
+        if done != self._size:
+            raise UploadRetryError(f"{self._path} changed size while being sent")
+        yield self._tail
+
+# Sends the file to Fossology, streaming it from disk. Returns the new
+# upload's ID. Raises UploadRetryError if it's worth trying again, or
+# Exception if not.
+def postUploadFile(fossologyServer, headers, file, progress):
+    body = MultipartFileBody(file, progress)
+    headers = dict(headers)
+    headers["Content-Type"] = body.getContentType()
+    try:
+        response = fossologyServer.session.post(f"{fossologyServer.api}/uploads", data=body, headers=headers, timeout=UPLOAD_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as ex:
+        raise UploadRetryError(f"error sending {file}: {ex}")
+    except UploadRetryError:
+        raise
+    except Exception as ex:
+        print("Unexpected exception posting file upload")
+        print(ex)
+        raise ex
+    if response.status_code == 201:
+        return response.json()["message"]
+    elif response.status_code == 403:
+        raise Exception(f"Authorization error uploading {file}")
+    elif response.status_code >= 500:
+        raise UploadRetryError(f"got status code {response.status_code} uploading {file}")
+    else:
+        raise Exception(f"Error uploading {file}: got status code {response.status_code}")
+
+# Waits for Fossology to finish taking in an upload, and returns it. Raises
+# UploadRetryError if it's worth trying again, or Exception if not.
+def waitForUpload(fossologyServer, upload_id, file):
+    retries = 0
+    while True:
+        try:
+            checkResponse = fossologyServer.session.get(f"{fossologyServer.api}/uploads/{upload_id}", headers={}, timeout=UPLOAD_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            raise UploadRetryError(f"error checking upload {upload_id} of {file}: {ex}")
+        if checkResponse.status_code == 200:
+            # we're done
+            return Upload.from_json(checkResponse.json())
+        elif checkResponse.status_code == 403:
+            description = f"Authorization error checking for status on upload for {file}"
+            raise Exception(description)
+        elif checkResponse.status_code == 503:
+            # Still waiting
+            retries = retries + 1
+            if retries % RETRIES_BETWEEN_MESSAGES == 0:
+                msg = f"Waiting for upload of {file}"
+                print(msg)
+            time.sleep(TIME_BETWEEN_RETRIES)
+        elif checkResponse.status_code >= 500:
+            raise UploadRetryError(f"got status code {checkResponse.status_code} checking upload {upload_id} of {file}")
+        else:
+            description = f"Error checking for status on upload for {file}"
+            raise Exception(description)
+
+# Uploads a file to the folder, over the Fossology server's session, and
+# waits for Fossology to take it in. The file is streamed from disk, so
+# memory use doesn't grow with its size, and its progress is printed as
+# it's sent.
+#
+# Fossology can't pick up a partly sent file where it left off, so after a
+# dropped connection or a server error, the upload is resumed from the
+# last step that finished: if Fossology had already given it an ID, only
+# the wait is tried again; otherwise, if findExisting is given, it's called
+# to look for an upload of the same file that Fossology took in even though
+# the response was lost, and only if there's none is the file sent again.
+#
+# If metrics is given, the file's size in bytes, the bytes sent over all
+# tries, the seconds taken and the number of tries are put in it. Returns
+# the upload, or raises an Exception.
+def upload_file(fossologyServer, folder, file, label="", findExisting=None, metrics=None):
     # some code copied from fossology-python https://github.com/fossology/fossology-python/blob/main/fossology/uploads.py#L128
     # Licensed under MIT
     headers = {"folderId": str(folder.id)}
     headers["uploadType"] = "file"
-    with open(file, "rb") as fp:
-        files = {"fileInput": fp}
+    label = label or file
+    size = os.path.getsize(file)
+    progress = UploadProgress(label, size)
+    upload = None
+    upload_id = None
+    attempt = 0
+    while upload is None:
+        attempt += 1
+        if attempt > 1:
+            time.sleep(TIME_BETWEEN_RETRIES * 2 ** (attempt - 2))
         try:
-            response = fossologyServer.session.post(
-                f"{fossologyServer.api}/uploads", files=files, headers=headers
-        )
-        except Exception as ex:
-            print("Unexpected exception posting file upload")
-            print(ex)
-            raise ex
-        # This will initiate the file upload
-    source = f"{file}"
-    if response.status_code == 201:
-        # Successfully initiated - now we need to check to see if it is done
-        upload_id =  response.json()["message"]
-        done = False
-        retries = 0
-        while not done:
+            if upload_id is None:
+                # This will initiate the file upload
+                upload_id = postUploadFile(fossologyServer, headers, file, progress)
+            # Successfully initiated - now we need to check to see if it is done
+            upload = waitForUpload(fossologyServer, upload_id, file)
+        except UploadRetryError as e:
+            print(f"{label}: upload try {attempt} of {UPLOAD_ATTEMPTS} failed: {e}")
+            if upload_id is None and findExisting:
+                upload = findExisting()
+                if upload:
+                    print(f"{label}: Fossology already has upload {upload.id} of {file}; using it")
+                    break
+            if attempt >= UPLOAD_ATTEMPTS:
+                raise Exception(f"Error uploading {file}: giving up after {attempt} tries")
+
+    seconds = time.monotonic() - progress._start
+    print(f"Upload completed for {file}: sent {formatMiB(progress._sent)} in {seconds:.0f}s, {formatMiB(progress._sent / max(seconds, 0.001))}/s")
+    if metrics is not None:
+        metrics["upload-bytes"] = size
+        metrics["upload-sent"] = progress._sent
+        metrics["upload-wall"] = round(seconds, 3)
+        metrics["upload-tries"] = attempt
+    return upload
+
+# Gets an upload's SHA1, from its hash on newer FOSSology servers or from
+# its filesha1 on older ones; "" if it has neither.
+def getUploadSHA1(upload):
+    if upload.hash and upload.hash.sha1:
+        return upload.hash.sha1.lower()
+    if upload.filesha1:
+        return upload.filesha1.lower()
+    return ""
+
+# Indexes the uploads in the project's folder and the monthly folders under
+# it by their SHA1, keeping the most recent upload for each.
+def getUploadIndex(fossologyServer, prjFolder):
+    index = {}
+    uploads = fossologyServer.list_uploads(folder=prjFolder, recursive=True, all_pages=True)[0]
+    for upload in sorted(uploads, key=lambda u: u.id):
+        sha1 = getUploadSHA1(upload)
+        if sha1 != "":
+            index[sha1] = upload
+    return index
+
+# one lock for each project folder being indexed, so that subprojects of
+# the same project wait for one listing rather than each making their own
+_uploadIndexLocksLock = threading.Lock()
+_uploadIndexLocks = {}
+
+# Gets the index of uploads in the project's folder (see getUploadIndex),
+# listing them once per run and sharing the index between the project's
+# subprojects, in cfg._fossology_upload_indexes. Returns {} if they can't
+# be listed, so that the code is uploaded anyway.
+def getProjectUploadIndex(cfg, fossologyServer, prj, prjFolder):
+    with _uploadIndexLocksLock:
+        indexLock = _uploadIndexLocks.setdefault(prjFolder.id, threading.Lock())
+    with indexLock:
+        if prjFolder.id not in cfg._fossology_upload_indexes:
             try:
-                checkResponse = fossologyServer.session.get(f"{fossologyServer.api}/uploads/{upload_id}", headers={})
-            except Exception as ex:
-                print("Unexpected exception checking upload response")
-                print(ex)
-                raise ex
-            if checkResponse.status_code == 200:
-                # we're done
-                done = True
-                upload = Upload.from_json(checkResponse.json())
-                print(f"Upload completed for {file}")
-            elif checkResponse.status_code == 403:
-                description = f"Authorization error checking for status on upload for {file}"
-                raise Exception(description)
-            elif checkResponse.status_code == 503:
-                # Still waiting
-                retries = retries + 1
-                if retries % RETRIES_BETWEEN_MESSAGES == 0:
-                    msg = f"Waiting for upload of {file}"
-                    print(msg)
-                time.sleep(TIME_BETWEEN_RETRIES)
-            else:
-                description = f"Error checking for status on upload for {file}"
-                raise Exception(description)
-    elif response.status_code == 403:
-        description = f"Authorization error uploading {file}"
-        raise Exception(description)
-    else:
-        description = "Error uploading {file}"
-        raise Exception(description)
+                cfg._fossology_upload_indexes[prjFolder.id] = getUploadIndex(fossologyServer, prjFolder)
+            except Exception as e:
+                print(f"{prj._name}: unable to list existing uploads, uploading anyway: {e}")
+                return {}
+        return cfg._fossology_upload_indexes[prjFolder.id]
+
+# Adds a new upload to the project's index, if it has been listed.
+def addToProjectUploadIndex(cfg, prjFolder, sha1, upload):
+    index = cfg._fossology_upload_indexes.get(prjFolder.id, None)
+    if index is not None and sha1 != "":
+        index[sha1] = upload
+
+# Looks in folder for an upload of the zip file with this SHA1, listing
+# only the uploads with its name rather than the whole project. Returns
+# None if there's none, or if they can't be listed.
+def findUploadOfZip(fossologyServer, folder, zipPath, sha1):
+    if sha1 == "":
+        return None
+    try:
+        uploads = fossologyServer.list_uploads(folder=folder, recursive=False, name=os.path.basename(zipPath), all_pages=True)[0]
+    except Exception as e:
+        print(f"Unable to list uploads of {zipPath}: {e}")
+        return None
+    for upload in uploads:
+        if getUploadSHA1(upload) == sha1:
+            return upload
+    return None
+
+# If the subproject's zip file was already uploaded, e.g. on an earlier try
+# that didn't get as far as saving its status, or because the code is the
+# same as in an earlier month, records that upload for the subproject and
+# returns True, so that the zip file isn't sent and unpacked again.
+def reuseExistingUpload(index, prj, sp):
+    if sp._code_sha1 == "":
+        return False
+    upload = index.get(sp._code_sha1, None)
+    if not upload:
+        return False
+    print(f"{prj._name}/{sp._name}: reusing upload {upload.id} ({upload.uploadname} in {upload.foldername}) with the same SHA1")
+    sp._fossology_upload_id = upload.id
     return True
 
 def doUploadCodeForProject(cfg, fossologyServer, prj):
@@ -80,6 +300,7 @@ def doUploadCodeForProject(cfg, fossologyServer, prj):
     # create one project-level folder for this month, and
     # upload all code there
     
+    prjFolder = folder
     dstFolder = f"{prj._name}-{cfg._month}"
     try:
         folder = fossologyServer.create_folder(folder, dstFolder)
@@ -89,6 +310,8 @@ def doUploadCodeForProject(cfg, fossologyServer, prj):
         print(f"{prj._name}/{sp._name}: Could not create folder {dstFolder}")
         return False
 
+    index = getProjectUploadIndex(cfg, fossologyServer, prj, prjFolder)
+
     # and now cycle through each subproject and upload the code here
     for sp in prj._subprojects.values():
         # make sure the subproject has not already had its code uploaded
@@ -100,6 +323,9 @@ def doUploadCodeForProject(cfg, fossologyServer, prj):
             print(f"{prj._name}/{sp._name}: skipping, no path found for retrieved code")
             sp._status = Status.STOPPED
             continue
+        if reuseExistingUpload(index, prj, sp):
+            sp._status = Status.UPLOADEDCODE
+            continue
         print(f"{prj._name}/{sp._name}: uploading {zipPath} to {dstFolder}")
         retval = None
         try:
@@ -109,6 +335,8 @@ def doUploadCodeForProject(cfg, fossologyServer, prj):
         if not retval:
             print(f"Error: Could not upload")
             return False
+        sp._fossology_upload_id = retval.id
+        addToProjectUploadIndex(cfg, prjFolder, sp._code_sha1, retval)
         # once we get here, the project's code has been uploaded
         sp._status = Status.UPLOADEDCODE
     
@@ -117,7 +345,33 @@ def doUploadCodeForProject(cfg, fossologyServer, prj):
     return True
 
 def doUploadCodeForSubproject(cfg, fossologyServer, prj, sp):
+    # make sure the subproject has not already had its code uploaded
+    if sp._status != Status.UPLOADEDWS:
+        print(f"{prj._name}/{sp._name}: skipping, status is {sp._status.name}, expected UPLOADEDWS")
+        return True
+    if sp._code_path == "":
+        print(f"{prj._name}/{sp._name}: skipping, no path found for retrieved code")
+        sp._status = Status.STOPPED
+        return True
+
+    if not uploadCodeForSubproject(cfg, fossologyServer, prj, sp):
+        return False
+
+    # once we get here, the project's code has been uploaded
+    sp._status = Status.UPLOADEDCODE
+    
+    # and when we return, the runner framework should update the project's
+    # status to reflect the min of its subprojects
+    return True
+
+# Uploads the subproject's zip file to this month's folder for the project,
+# or reuses an earlier upload of the same zip file, and records the upload
+# for the subproject. Doesn't check or change the subproject's status, so
+# that it can run alongside the other stages for zipped code. Returns True
+# if the code is uploaded.
+def uploadCodeForSubproject(cfg, fossologyServer, prj, sp):
     # create top-level folder for project, if it doesn't already exist
+    folder = None
     try:
         folder = fossologyServer.create_folder(fossologyServer.rootFolder, prj._name)
     except Exception as e:
@@ -129,37 +383,35 @@ def doUploadCodeForSubproject(cfg, fossologyServer, prj, sp):
     # create one project-level folder for this month, and
     # upload all code there
     
+    prjFolder = folder
     dstFolder = f"{prj._name}-{cfg._month}"
+    folder = None
     try:
-        folder = fossologyServer.create_folder(folder, dstFolder)
+        folder = fossologyServer.create_folder(prjFolder, dstFolder)
     except Exception as e:
         print("Exception creating folder", e)
     if not folder:
         print(f"{prj._name}/{sp._name}: Could not create folder {dstFolder}")
         return False
 
-    # make sure the subproject has not already had its code uploaded
-    if sp._status != Status.UPLOADEDWS:
-        print(f"{prj._name}/{sp._name}: skipping, status is {sp._status.name}, expected UPLOADEDWS")
+    index = getProjectUploadIndex(cfg, fossologyServer, prj, prjFolder)
+    if reuseExistingUpload(index, prj, sp):
         return True
+
+    # if a try fails before Fossology answers, it may have the zip file
+    # anyway, in this month's folder, so look there before sending it again
     zipPath = sp._code_path
-    if zipPath == "":
-        print(f"{prj._name}/{sp._name}: skipping, no path found for retrieved code")
-        sp._status = Status.STOPPED
-        return True
+    findExisting = lambda: findUploadOfZip(fossologyServer, folder, zipPath, sp._code_sha1)
+
     print(f"{prj._name}/{sp._name}: uploading {zipPath} to {dstFolder}")
     retval = None
     try:
-        retval = upload_file(fossologyServer, folder, zipPath)
+        retval = upload_file(fossologyServer, folder, zipPath, f"{prj._name}/{sp._name}", findExisting, sp._upload_metrics)
     except Exception as e:
         print("Exception uploading file", e)
     if not retval:
         print(f"Error: Could not upload")
         return False
-
-    # once we get here, the project's code has been uploaded
-    sp._status = Status.UPLOADEDCODE
-    
-    # and when we return, the runner framework should update the project's
-    # status to reflect the min of its subprojects
+    sp._fossology_upload_id = retval.id
+    addToProjectUploadIndex(cfg, prjFolder, sp._code_sha1, retval)
     return True
@@ -1,13 +1,28 @@
 # Copyright The Linux Foundation
 # SPDX-License-Identifier: Apache-2.0
 
+from collections import deque
 import os
-from subprocess import run, PIPE
-import sys
+import shutil
+from subprocess import Popen, PIPE, STDOUT
+import tempfile
 
 import ws.wscfg
 
-def runUnifiedAgent(cfg, prj, sp):
+# lines from the end of the agent's output that are printed if it fails
+WS_LOG_TAIL_LINES = 20
+
+# Gets the path of the file that the unified agent's output is written to
+# for this subproject.
+def getWSLogPath(cfg, prj, sp):
+    return os.path.join(cfg._storepath, cfg._month, "ws", prj._name, f"{sp._name}-ws.log")
+
+# Gets the path of the file that the unified agent's output is written to
+# for a batch of subprojects, named after its first one.
+def getWSBatchLogPath(cfg, prj, sps):
+    return os.path.join(cfg._storepath, cfg._month, "ws", prj._name, f"batch-{sps[0]._name}-ws.log")
+
+def isCodePathOK(prj, sp):
     # make sure that the code to upload actually exists!
     if not sp._code_path:
         print(f"{prj._name}/{sp._name}: No code path found; not uploading to WS")
@@ -18,6 +33,24 @@ def runUnifiedAgent(cfg, prj, sp):
     if not os.path.isfile(sp._code_path):
         print(f"{prj._name}/{sp._name}: Code path {sp._code_path} exists but is not a file; not uploading to WS")
         return False
+    return True
+
+# Runs cmd, writing its output and errors to the log file as they come
+# rather than holding them in memory. Returns the exit code and the last
+# few lines of output.
+def runAgentCommand(cmd, env, logPath):
+    os.makedirs(os.path.dirname(logPath), exist_ok=True)
+    with open(logPath, "w") as f:
+        tail = deque(maxlen=WS_LOG_TAIL_LINES)
+        with Popen(cmd, env=env, stdout=PIPE, stderr=STDOUT, universal_newlines=True) as proc:
+            for line in proc.stdout:
+                tail.append(line)
+                f.write(line)
+        return proc.returncode, "".join(tail)
+
+def runUnifiedAgent(cfg, prj, sp):
+    if not isCodePathOK(prj, sp):
+        return False
 
     # get environment, including necessary values
     env = ws.wscfg.getWSEnv(cfg, prj, sp)
@@ -34,18 +67,97 @@ def runUnifiedAgent(cfg, prj, sp):
         "-d", sp._code_path,
         "-noconfig", "true"
     ]
-    cp = run(cmd, env=env, stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    if cp.returncode != 0:
-        print(f"""{prj._name}/{sp._name}: WS unified agent failed with error code {cp.returncode}:
-----------
-output:
-{cp.stdout}
+    logPath = getWSLogPath(cfg, prj, sp)
+    returncode, tail = runAgentCommand(cmd, env, logPath)
+    if returncode != 0:
+        print(f"""{prj._name}/{sp._name}: WS unified agent failed with error code {returncode}; output is in {logPath}, ending:
 ----------
-errors:
-{cp.stderr}
+{tail}
 ----------
 """)
         return False
     else:
         print(f"{prj._name}/{sp._name}: WS unified agent call succeeded")
         return True
+
+# Gets the key that subprojects need to share to be run through the unified
+# agent together: the same org token and environment.
+def getWSBatchKey(cfg, prj, sp):
+    env = ws.wscfg.getWSEnv(cfg, prj, sp)
+    return (ws.wscfg.getWSOrgToken(cfg, prj, sp), tuple(sorted(env.items())))
+
+# Splits subprojects into batches that can each be run through one
+# unified agent: those with the same batch key going to the same product,
+# and no two with the same WS project name, since each gets a folder named
+# after its project. In batch mode, subprojects without a product override
+# all go to the project's product (see ws.wscfg.getWSProductName).
+def getWSBatches(cfg, prj, sps):
+    batches = []
+    open_batches = {}
+    for sp in sps:
+        key = (getWSBatchKey(cfg, prj, sp), ws.wscfg.getWSProductName(cfg, prj, sp))
+        project_name = ws.wscfg.getWSProjectName(cfg, prj, sp)
+        batch = open_batches.get(key, None)
+        if batch is None or project_name in [ws.wscfg.getWSProjectName(cfg, prj, b) for b in batch]:
+            batch = []
+            batches.append(batch)
+            open_batches[key] = batch
+        batch.append(sp)
+    return batches
+
+# Runs the unified agent once over the zip files of several subprojects
+# that share a batch key (see getWSBatches), so that the JVM and the agent
+# only start up once. Each zip file is linked into a folder named after its
+# subproject's WS project, and the agent makes one project per folder, in
+# the shared product. The output goes to one log file for the batch, and
+# each subproject's log file says where to find it. Returns the
+# subprojects that the agent ran for.
+def runUnifiedAgentBatch(cfg, prj, sps):
+    sps = [sp for sp in sps if isCodePathOK(prj, sp)]
+    if len(sps) <= 1:
+        return [sp for sp in sps if runUnifiedAgent(cfg, prj, sp)]
+
+    env = ws.wscfg.getWSEnv(cfg, prj, sps[0])
+    env["WS_WSS_URL"] = cfg._ws_server_url + "/agent"
+    org_token = ws.wscfg.getWSOrgToken(cfg, prj, sps[0])
+    product_name = ws.wscfg.getWSProductName(cfg, prj, sps[0])
+    env["WS_PRODUCTNAME"] = product_name
+    env["WS_PROJECTPERFOLDER"] = "true"
+
+    names = ", ".join([sp._name for sp in sps])
+    batchParent = os.path.join(cfg._zippath, cfg._month, "code", prj._name)
+    os.makedirs(batchParent, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="ws-batch-", dir=batchParent) as batchPath:
+        for sp in sps:
+            folder = os.path.join(batchPath, ws.wscfg.getWSProjectName(cfg, prj, sp))
+            os.makedirs(folder)
+            dst = os.path.join(folder, os.path.basename(sp._code_path))
+            # hard link if on the same file system, so the zip isn't copied
+            try:
+                os.link(sp._code_path, dst)
+            except OSError:
+                shutil.copy2(sp._code_path, dst)
+
+        cmd = ["java", "-jar", cfg._ws_unified_agent_jar_path,
+            "-apiKey", org_token,
+            "-d", batchPath,
+            "-noconfig", "true"
+        ]
+        print(f"{prj._name}: running WS unified agent for {names}")
+        batchLogPath = getWSBatchLogPath(cfg, prj, sps)
+        returncode, tail = runAgentCommand(cmd, env, batchLogPath)
+
+    for sp in sps:
+        with open(getWSLogPath(cfg, prj, sp), "w") as f:
+            f.write(f"WS unified agent ran for {names} together, with error code {returncode}; its output is in {batchLogPath}\n")
+
+    if returncode != 0:
+        print(f"""{prj._name}: WS unified agent failed for {names} with error code {returncode}; output is in {batchLogPath}, ending:
+----------
+{tail}
+----------
+""")
+        return []
+    else:
+        print(f"{prj._name}: WS unified agent call succeeded for {names}")
+        return sps
@@ -1,21 +1,60 @@
 # Copyright The Linux Foundation
 # SPDX-License-Identifier: Apache-2.0
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
 import os
-import sys
+import threading
 import time
 
 import requests
 
+# seconds to wait for the WS API to connect or send more data
+WSAPI_TIMEOUT = 60
+
+# number of getAllProjects calls that can be waiting on the WS API at
+# the same time; how often they start is limited by wsApiRate
+WSAPI_WORKERS = 4
+
+# guards loading and updating projects' product and project tokens, since
+# subprojects of the same project can run the agent at the same time
+_tokensLock = threading.RLock()
+
+# Spaces out callers of wait() so that no more than `rate` of them go
+# ahead each second, across threads. A rate of 0 means no limit.
+class RateLimiter:
+
+    def __init__(self, rate):
+        super(RateLimiter, self).__init__()
+
+        self._interval = 1.0 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self._interval == 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self._interval
+        if at > now:
+            time.sleep(at - now)
+
 # make and verify successful WS API call
 # return dict of full response or empty dict if couldn't
 # be validated
-def _ws_post(js_dict):
+def _ws_post(api_url, js_dict, session=None):
     # make API call
-    r = requests.post("https://saas.whitesourcesoftware.com/api/v1.3", json=js_dict)
+    request_type = js_dict.get("requestType", "")
+    try:
+        r = (session or requests).post(api_url, json=js_dict, timeout=WSAPI_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"WS API call {request_type} failed: {e}")
+        return {}
     if r.status_code != requests.codes.ok:
-        print(f"WS API call failed for org_token {js_dict.org_token}: got status code {r.status_code}")
+        print(f"WS API call {request_type} failed: got status code {r.status_code}")
         return {}
 
     # parse content and verify success response
@@ -34,7 +73,7 @@ def _ws_post(js_dict):
 
 # returns hash of product name to product token, for all
 # products in the org
-def getAllProductsAndTokens(userkey, org_token):
+def getAllProductsAndTokens(api_url, userkey, org_token, session=None):
     # make API call
     js_dict = {
         "requestType": "getAllProducts",
@@ -42,7 +81,7 @@ def getAllProductsAndTokens(userkey, org_token):
         "userKey": userkey,
     }
     print(f"WSAPI: making getAllProducts call")
-    rj = _ws_post(js_dict)
+    rj = _ws_post(api_url, js_dict, session)
     if rj == {}:
         return None
 
@@ -59,65 +98,146 @@ def getAllProductsAndTokens(userkey, org_token):
 # product tokens that were already retrieved
 # note that each product is expected to have only one project,
 # with this current model
-def getAllProjectsAndTokens(userkey, product_tokens):
-    projects = {}
+# up to WSAPI_WORKERS calls are made at a time, starting no more than
+# rate of them each second
+def getAllProjectsAndTokens(api_url, userkey, product_tokens, rate, session=None):
     num_product_tokens = len(product_tokens)
-    current_token = 0
+    limiter = RateLimiter(rate)
 
-    for product_name, product_token in product_tokens.items():
+    def getProjects(current_token, product_token):
         # make API call
         js_dict = {
             "requestType": "getAllProjects",
             "productToken": product_token,
             "userKey": userkey,
         }
-        current_token += 1
+        limiter.wait()
         print(f"WSAPI: making getAllProjects call ({current_token}/{num_product_tokens})")
-        rj = _ws_post(js_dict)
-        if rj == {}:
-            return None
+        return _ws_post(api_url, js_dict, session)
 
-        # parse response
-        for project_dict in rj.get("projects", []):
-            name = project_dict.get("projectName", "")
-            token = project_dict.get("projectToken", "")
-            projects[name] = token
-
-        # sleep a bit, because we're making a bunch of API calls
-        # potentially
-        time.sleep(1)
+    projects = {}
+    with ThreadPoolExecutor(max_workers=WSAPI_WORKERS) as pool:
+        futures = [pool.submit(getProjects, i + 1, product_token) for i, product_token in enumerate(product_tokens.values())]
+        # parse responses, in product order so that later products win
+        # any clashing project names, as they did when made one by one
+        for future in futures:
+            rj = future.result()
+            if rj == {}:
+                for f in futures:
+                    f.cancel()
+                return None
+            for project_dict in rj.get("projects", []):
+                name = project_dict.get("projectName", "")
+                token = project_dict.get("projectToken", "")
+                projects[name] = token
 
     return projects
 
+# Gets a key for an org token, so that its cache file doesn't hold the
+# token itself.
+def getOrgTokenKey(org_token):
+    return hashlib.sha256((org_token or "").encode("utf-8")).hexdigest()[:16]
+
+def getTokenCachePath(cfg, key):
+    return os.path.join(cfg._storepath, "ws-cache", f"{key}.json")
+
+# Loads the cached product and project tokens for an org token key, as a
+# dict with "fetched", "products" and "projects", or None if there are none
+# from within the last wsTokenCacheHours.
+def loadTokenCache(cfg, key):
+    if cfg._ws_token_cache_hours <= 0:
+        return None
+    try:
+        with open(getTokenCachePath(cfg, key), "r") as f:
+            js = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if time.time() - js.get("fetched", 0) > cfg._ws_token_cache_hours * 3600:
+        return None
+    return js
+
+def saveTokenCache(cfg, prj):
+    if cfg._ws_token_cache_hours <= 0:
+        return
+    path = getTokenCachePath(cfg, prj._ws_tokens_key)
+    js = {
+        "fetched": prj._ws_tokens_fetched,
+        "products": prj._ws_product_tokens,
+        "projects": prj._ws_project_tokens,
+    }
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(js, f, indent=4)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"{prj._name}: unable to cache WS tokens: {e}")
+
+# Makes sure the project's product and project tokens are loaded for the
+# org token: from the cache under storepath if it isn't too old, or else
+# from the API, after which they're cached. With refresh, they're got
+# from the API unless that was already done in this run. Returns True if
+# the tokens are loaded.
+def loadTokens(cfg, prj, userkey, org_token, refresh=False):
+    key = getOrgTokenKey(org_token)
+    with _tokensLock:
+        if prj._ws_tokens_key == key and (not refresh or prj._ws_tokens_fresh):
+            return True
+
+        if not refresh:
+            js = loadTokenCache(cfg, key)
+            if js is not None:
+                prj._ws_product_tokens = js.get("products", {})
+                prj._ws_project_tokens = js.get("projects", {})
+                prj._ws_tokens_key = key
+                prj._ws_tokens_fetched = js.get("fetched", 0)
+                prj._ws_tokens_fresh = False
+                return True
+
+        with requests.Session() as session:
+            fetched = time.time()
+            product_tokens = getAllProductsAndTokens(cfg._ws_api_url, userkey, org_token, session)
+            if product_tokens is None:
+                return False
+            project_tokens = getAllProjectsAndTokens(cfg._ws_api_url, userkey, product_tokens, cfg._ws_api_rate, session)
+            if project_tokens is None:
+                return False
+
+        prj._ws_product_tokens = product_tokens
+        prj._ws_project_tokens = project_tokens
+        prj._ws_tokens_key = key
+        prj._ws_tokens_fetched = fetched
+        prj._ws_tokens_fresh = True
+        saveTokenCache(cfg, prj)
+        return True
+
+# Gets a token from the project's product or project tokens, from the
+# cache or the API. If the cache doesn't have it, the tokens are got from
+# the API again, since it might have been made since they were cached.
+def _getToken(cfg, prj, userkey, org_token, tokens_attr, name):
+    with _tokensLock:
+        # check and cache tokens if not present
+        if not loadTokens(cfg, prj, userkey, org_token):
+            print(f"Error retrieving product or project tokens from WSAPI; bailing")
+            return ""
+        token = getattr(prj, tokens_attr).get(name, "")
+        if token == "" and not prj._ws_tokens_fresh:
+            if not loadTokens(cfg, prj, userkey, org_token, refresh=True):
+                print(f"Error retrieving product or project tokens from WSAPI; bailing")
+                return ""
+            token = getattr(prj, tokens_attr).get(name, "")
+        return token
+
 # returns token for product with given name
 # will call API to get list of all tokens if not already cached
 def getProductToken(cfg, prj, ws_product_name, userkey, org_token):
-    # check and cache tokens if not present
-    if prj._ws_product_tokens == {} or prj._ws_project_tokens == {}:
-        prj._ws_product_tokens = getAllProductsAndTokens(userkey, org_token)
-        prj._ws_project_tokens = getAllProjectsAndTokens(userkey, prj._ws_product_tokens)
-
-    # check to make sure we actually got some
-    if prj._ws_product_tokens == None or prj._ws_project_tokens == None:
-        print(f"Error retrieving product or project tokens from WSAPI; bailing")
-        return ""
-
-    return prj._ws_product_tokens.get(ws_product_name, "")
+    return _getToken(cfg, prj, userkey, org_token, "_ws_product_tokens", ws_product_name)
 
 # returns token for project with given name
 # will call API to get list of all tokens if not already cached
 def getProjectToken(cfg, prj, ws_project_name, userkey, org_token):
-    # check and cache tokens if not present
-    if prj._ws_product_tokens == {} or prj._ws_project_tokens == {}:
-        prj._ws_product_tokens = getAllProductsAndTokens(userkey, org_token)
-        prj._ws_project_tokens = getAllProjectsAndTokens(userkey, prj._ws_product_tokens)
-
-    # check to make sure we actually got some
-    if prj._ws_product_tokens == None or prj._ws_project_tokens == None:
-        print(f"Error retrieving product or project tokens from WSAPI; bailing")
-        return ""
-
-    return prj._ws_project_tokens.get(ws_project_name, "")
+    return _getToken(cfg, prj, userkey, org_token, "_ws_project_tokens", ws_project_name)
 
 # create product with the given name in the specified org
 # returns new product's token after caching it, or "" on failure
@@ -131,7 +251,7 @@ def createProduct(cfg, prj, userkey, org_token, product_name):
         "productName": product_name,
     }
     print(f"WSAPI: making createProduct call for {product_name}")
-    rj = _ws_post(js_dict)
+    rj = _ws_post(cfg._ws_api_url, js_dict)
     if rj == {}:
         print(f"Failed to create product {product_name}")
         return ""
@@ -142,7 +262,11 @@ def createProduct(cfg, prj, userkey, org_token, product_name):
         print(f"Tried to create product {product_name} but did not get product token in response")
         return ""
 
-    prj._ws_product_tokens[product_name] = product_token
+    with _tokensLock:
+        prj._ws_product_tokens[product_name] = product_token
+        # keep the cache in step, so that the next run doesn't miss it
+        if prj._ws_tokens_key == getOrgTokenKey(org_token):
+            saveTokenCache(cfg, prj)
     return product_token
 
 # create project with the given name in the specified product
@@ -157,7 +281,7 @@ def createProject(cfg, prj, userkey, product_token, project_name):
         "projectName": project_name,
     }
     print(f"WSAPI: making createProject call for {project_name}")
-    rj = _ws_post(js_dict)
+    rj = _ws_post(cfg._ws_api_url, js_dict)
     if rj == {}:
         print(f"Failed to create project {project_name}")
         return ""
@@ -168,5 +292,9 @@ def createProject(cfg, prj, userkey, product_token, project_name):
         print(f"Tried to create project {project_name} but did not get project token in response")
         return ""
 
-    prj._ws_project_tokens[project_name] = project_token
+    with _tokensLock:
+        prj._ws_project_tokens[project_name] = project_token
+        # keep the cache in step, so that the next run doesn't miss it
+        if prj._ws_tokens_key != "" and product_token in prj._ws_product_tokens.values():
+            saveTokenCache(cfg, prj)
     return project_token
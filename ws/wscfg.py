@@ -36,11 +36,15 @@ def getWSOrgToken(cfg, prj, sp):
     return _getWSSecretsApikey(cfg, prj)
 
 # get the actual expected WS product name for this subproject,
-# taking prj and sp overrides into account
+# taking prj and sp overrides into account; in batch mode, subprojects
+# without an override share a product named after the project, so that
+# they can be run through one unified agent
 def getWSProductName(cfg, prj, sp):
     if sp._ws_override_product != "":
         return sp._ws_override_product
 
+    if cfg._ws_batch:
+        return prj._name
     return sp._name
 
 # get the actual expected WS project name for this subproject,
@@ -0,0 +1,279 @@
+# Copyright The Linux Foundation
+# SPDX-License-Identifier: Apache-2.0
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import stat
+import sys
+import tarfile
+import zipfile
+import zlib
+
+# files with these extensions are already compressed, so they're stored
+# as they are rather than being compressed again
+STORED_EXTENSIONS = [
+    ".7z", ".aar", ".apk", ".br", ".bz2", ".deb", ".ear", ".gif", ".gz",
+    ".jar", ".jpeg", ".jpg", ".lz", ".lz4", ".lzma", ".mov", ".mp3", ".mp4",
+    ".nupkg", ".ogg", ".png", ".rar", ".rpm", ".tbz2", ".tgz", ".txz",
+    ".war", ".webm", ".webp", ".whl", ".woff", ".woff2", ".xz", ".zip",
+    ".zst",
+]
+
+# files bigger than this are compressed as they're written, rather than
+# being held in memory by a worker
+MAX_BUFFERED_FILE_SIZE = 64 * 1024 * 1024
+
+# most bytes of files that are read, and waiting to be written, at a time,
+# so that memory use stays bounded however many workers there are
+MAX_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+
+# number of files compressed at the same time, unless set in the config
+DEFAULT_ZIP_WORKERS = min(8, os.cpu_count() or 1)
+
+# zlib's default compression level, currently 6
+DEFAULT_ZIP_COMPRESSION_LEVEL = -1
+
+# every entry gets the same timestamp, the earliest a zip file can hold,
+# so that the same code always makes a byte-identical zip file
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# ZipFile has no public way to write a member that's already compressed,
+# so writeCompressedMember uses the internals that ZipFile.open(zinfo, "w")
+# does, on the versions of Python they're known to work with. Elsewhere,
+# the workers still read, hash and pick stored or deflated for each file,
+# but the data is compressed again as it's written, with writestr.
+RAW_WRITE_SUPPORTED = (3, 8) <= sys.version_info[:2] <= (3, 13) and hasattr(zipfile.ZipFile, "_writecheck")
+
+# Sets the level for ZipFile.open(zinfo, "w") to compress zinfo with;
+# Python 3.13 renamed ZipInfo's _compresslevel to compress_level.
+def setCompressLevel(zinfo, level):
+    if hasattr(zipfile.ZipInfo, "compress_level"):
+        zinfo.compress_level = level
+    else:
+        zinfo._compresslevel = level
+
+def getManifestPath(zf_path):
+    return os.path.splitext(zf_path)[0] + "-manifest.json"
+
+def isStoredFile(path):
+    return os.path.splitext(path)[1].lower() in STORED_EXTENSIONS
+
+# Makes the ZipInfo for a file, with a fixed timestamp and with permissions
+# that only depend on whether the file is executable, so that the zip file
+# doesn't change with when or by whom the code was cloned.
+def newZipInfo(arcname, executable):
+    zinfo = zipfile.ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+    # made on Unix, wherever it's actually built
+    zinfo.create_system = 3
+    mode = 0o755 if executable else 0o644
+    zinfo.external_attr = (stat.S_IFREG | mode) << 16
+    return zinfo
+
+def makeZipInfo(fpath, arcname):
+    return newZipInfo(arcname, os.stat(fpath).st_mode & 0o111 != 0)
+
+# Returns the SHA1 of a file, reading it a chunk at a time.
+def getFileSHA1(fpath):
+    sha1 = hashlib.sha1()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# Lists the regular files under src_path as (path, path in the zip file),
+# sorted by their path in the zip file. Symlinks are left out, as are
+# files for which excludeFn(path in the zip file, size) returns True.
+def listZipMembers(src_path, excludeFn=None):
+    members = []
+    for root, _, files in os.walk(src_path):
+        for f in files:
+            fpath = os.path.join(root, f)
+            if os.path.islink(fpath):
+                continue
+            arcname = os.path.relpath(fpath, src_path).replace(os.sep, "/")
+            if excludeFn is None or not excludeFn(arcname, os.path.getsize(fpath)):
+                members.append((fpath, arcname))
+    return sorted(members, key=lambda m: m[1])
+
+# Reads and compresses one file, on a worker thread; zlib and hashlib let
+# other threads run while they work. Returns the ZipInfo, with its sizes
+# and CRC filled in, the data to write and the file's SHA1. Files that
+# don't get any smaller are stored instead. Without RAW_WRITE_SUPPORTED,
+# the data to write is the file's own, to be compressed as it's written.
+def compressMember(fpath, arcname, level):
+    with open(fpath, "rb") as f:
+        data = f.read()
+    return compressData(makeZipInfo(fpath, arcname), data, level)
+
+# Compresses data that has already been read, for compressMember.
+def compressData(zinfo, data, level):
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data)
+    sha1 = hashlib.sha1(data).hexdigest()
+
+    zinfo.compress_type = zipfile.ZIP_STORED
+    payload = data
+    if not isStoredFile(zinfo.filename):
+        # raw deflate stream, as zip files hold it
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        if len(compressed) < len(data):
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            if RAW_WRITE_SUPPORTED:
+                payload = compressed
+    zinfo.compress_size = len(payload)
+    return zinfo, payload, sha1
+
+# Appends a member from compressData to zf. With RAW_WRITE_SUPPORTED, this
+# does what ZipFile.open(zinfo, "w") does, but without compressing the data
+# again; otherwise it writes the data with writestr.
+def writeCompressedMember(zf, zinfo, payload, level):
+    if not RAW_WRITE_SUPPORTED:
+        zf.writestr(zinfo, payload, compress_type=zinfo.compress_type, compresslevel=level)
+        return
+    zinfo.flag_bits = 0x00
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zf.fp.write(zinfo.FileHeader())
+    zf.fp.write(payload)
+    zf.start_dir = zf.fp.tell()
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+
+# Writes a big file to zf as it's read, on this thread, and returns its SHA1.
+def writeLargeMember(zf, fpath, arcname, level):
+    with open(fpath, "rb") as f:
+        return writeLargeStream(zf, makeZipInfo(fpath, arcname), f, os.path.getsize(fpath), level)
+
+# Writes size bytes read from src to zf as zinfo, on this thread, and
+# returns their SHA1.
+def writeLargeStream(zf, zinfo, src, size, level):
+    zinfo.compress_type = zipfile.ZIP_STORED if isStoredFile(zinfo.filename) else zipfile.ZIP_DEFLATED
+    setCompressLevel(zinfo, level)
+    # lets zipfile decide up front whether the entry needs ZIP64
+    zinfo.file_size = size
+    sha1 = hashlib.sha1()
+    with zf.open(zinfo, "w") as dst:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            sha1.update(chunk)
+            dst.write(chunk)
+    return sha1.hexdigest()
+
+def getZipWorkers(cfg):
+    if cfg._workers_zip > 0:
+        return cfg._workers_zip
+    return DEFAULT_ZIP_WORKERS
+
+# Zips the files under src_path into zf_path, compressing up to `workers`
+# files at a time, and writing them in sorted order with fixed timestamps
+# and permissions, so that the same code always makes the same zip file.
+# Already-compressed formats are stored rather than compressed, and files
+# for which excludeFn(path in the zip file, size) returns True are left
+# out. Also writes a manifest
+# alongside the zip file, listing each file's path, size and SHA1.
+# Returns the manifest as a list of dicts.
+def buildZip(src_path, zf_path, level=DEFAULT_ZIP_COMPRESSION_LEVEL, workers=DEFAULT_ZIP_WORKERS, excludeFn=None):
+    members = listZipMembers(src_path, excludeFn)
+    manifest = []
+    if os.path.exists(zf_path):
+        os.remove(zf_path)
+
+    with zipfile.ZipFile(zf_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            # keep a bounded number, and size, of compressed files waiting
+            # to be written, so that memory use doesn't grow with the repo
+            pending = deque()
+            remaining = iter(members)
+            maxPending = max(1, workers) * 4
+            inFlight = 0
+
+            def submitMore():
+                nonlocal inFlight
+                while len(pending) < maxPending and (len(pending) == 0 or inFlight < MAX_BYTES_IN_FLIGHT):
+                    member = next(remaining, None)
+                    if member is None:
+                        return
+                    fpath, arcname = member
+                    size = os.path.getsize(fpath)
+                    if size > MAX_BUFFERED_FILE_SIZE:
+                        pending.append((fpath, arcname, size, None))
+                    else:
+                        pending.append((fpath, arcname, size, pool.submit(compressMember, fpath, arcname, level)))
+                        inFlight += size
+
+            submitMore()
+            while len(pending) > 0:
+                fpath, arcname, size, future = pending.popleft()
+                if future is None:
+                    sha1 = writeLargeMember(zf, fpath, arcname, level)
+                else:
+                    zinfo, payload, sha1 = future.result()
+                    writeCompressedMember(zf, zinfo, payload, level)
+                    inFlight -= size
+                    size = zinfo.file_size
+                manifest.append({"path": arcname, "size": size, "sha1": sha1})
+                submitMore()
+
+    with open(getManifestPath(zf_path), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+# Zips the regular files in each of the tarballs, given as a list of
+# (folder in the zip file, tarball path), reading each tarball as a stream
+# so that nothing is extracted to disk. The tarballs' own top-level folder
+# is replaced by the given folder. Files are written in each tarball's
+# order, with up to `workers` compressed at a time, and with the same
+# fixed timestamps and permissions, exclusions and manifest as buildZip.
+# Returns the manifest as a list of dicts.
+def buildZipFromTarballs(tarballs, zf_path, level=DEFAULT_ZIP_COMPRESSION_LEVEL, workers=DEFAULT_ZIP_WORKERS, excludeFn=None):
+    manifest = []
+    if os.path.exists(zf_path):
+        os.remove(zf_path)
+
+    with zipfile.ZipFile(zf_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            pending = deque()
+            inFlight = 0
+
+            # writes compressed files in order until no more than `limit`
+            # are waiting, and they hold no more than MAX_BYTES_IN_FLIGHT
+            def writePending(limit):
+                nonlocal inFlight
+                while len(pending) > limit or (len(pending) > 0 and inFlight > MAX_BYTES_IN_FLIGHT):
+                    zinfo, payload, sha1 = pending.popleft().result()
+                    writeCompressedMember(zf, zinfo, payload, level)
+                    inFlight -= zinfo.file_size
+                    manifest.append({"path": zinfo.filename, "size": zinfo.file_size, "sha1": sha1})
+
+            for folder, tar_path in tarballs:
+                with tarfile.open(tar_path, mode="r|*") as tar:
+                    for member in tar:
+                        if not member.isfile():
+                            continue
+                        parts = member.name.split("/", 1)
+                        if len(parts) < 2 or parts[1] == "":
+                            continue
+                        arcname = f"{folder}/{parts[1]}"
+                        if excludeFn is not None and excludeFn(arcname, member.size):
+                            continue
+                        zinfo = newZipInfo(arcname, member.mode & 0o111 != 0)
+                        src = tar.extractfile(member)
+                        if member.size > MAX_BUFFERED_FILE_SIZE:
+                            # the stream can't come back to it, so write
+                            # it now, after everything before it
+                            writePending(0)
+                            sha1 = writeLargeStream(zf, zinfo, src, member.size, level)
+                            manifest.append({"path": arcname, "size": member.size, "sha1": sha1})
+                        else:
+                            pending.append(pool.submit(compressData, zinfo, src.read(), level))
+                            inFlight += member.size
+                            writePending(max(1, workers) * 4)
+            writePending(0)
+
+    with open(getManifestPath(zf_path), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
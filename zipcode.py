@@ -2,10 +2,27 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import os
-import zipfile
 import util
 
 from datatypes import ProjectRepoType, Status
+from getcode import getTarballPath, isUnderDirs, recordExclusions
+from scanexclude import getScanExcludeFn
+from zipbuilder import buildZip, buildZipFromTarballs, getFileSHA1, getZipWorkers
+
+# Gets a function for buildZipFromTarballs that leaves out the files in
+# each repo's repo-dirs-delete, then files bigger than cloneBlobLimit,
+# adding their paths to largeFiles by repo, and then anything excludeFn
+# leaves out.
+def getRepoDirsExcludeFn(cfg, sp, excludeFn, largeFiles):
+    def repoDirsExcludeFn(arcname, size):
+        repo, _, path = arcname.partition("/")
+        if isUnderDirs(path, sp._repo_dirs_delete.get(repo, [])):
+            return True
+        if cfg._clone_blob_limit > 0 and size > cfg._clone_blob_limit:
+            largeFiles.setdefault(repo, []).append(path)
+            return True
+        return excludeFn is not None and excludeFn(arcname, size)
+    return repoDirsExcludeFn
 
 # Runner for GOTCODE in GITHUB and GITHUB_SHARED
 def doZipRepoCodeForSubproject(cfg, prj, sp):
@@ -20,11 +37,16 @@ def doZipRepoCodeForSubproject(cfg, prj, sp):
     # remove each repo's .git directory
     for repo in sp._repos:
         dotgit_path = os.path.join(ziporg_path, repo, ".git")
-        util.retry_rmtree(dotgit_path)
+        # code exported from a mirror or downloaded as a tarball has none
+        if os.path.exists(dotgit_path):
+            util.retry_rmtree(dotgit_path)
         # also remove its repo-dirs-delete, if any
         delete_dirs = sp._repo_dirs_delete.get(repo, [])
         for delete_dir in delete_dirs:
             delete_dir_path = os.path.join(ziporg_path, repo, delete_dir)
+            # usually already left out when the code was retrieved
+            if not os.path.exists(delete_dir_path):
+                continue
             print(f"{prj._name}/{sp._name}: deleting {repo}:{delete_dir}")
             util.retry_rmtree(delete_dir_path)
 
@@ -38,16 +60,23 @@ def doZipRepoCodeForSubproject(cfg, prj, sp):
     # now zip it all together
     zf_path = os.path.join(sp_path, f"{ziporg_path}-{sp._code_pulled}.zip")
     print(f"{prj._name}/{sp._name}: zipping into {zf_path}")
-    if os.path.exists(zf_path):
-        os.remove(zf_path)
-    zf = zipfile.ZipFile(zf_path, 'w', compression=zipfile.ZIP_DEFLATED)
-    for root, _, files in os.walk(ziporg_path):
-        for f in files:
-            fpath = os.path.join(root, f)
-            rpath = os.path.relpath(fpath, ziporg_path)
-            if not os.path.islink(fpath):
-                zf.write(fpath, arcname=rpath)
-    zf.close()
+    sp._code_scan_excluded = {}
+    excludeFn = getScanExcludeFn(prj, sp._code_scan_excluded)
+    if cfg._github_retrieval == "tarball":
+        # zip straight from the downloaded tarballs, leaving out each
+        # repo's repo-dirs-delete and large files as we go
+        tarballs = [(repo, getTarballPath(ziporg_path, repo)) for repo in sorted(sp._repos) if os.path.isfile(getTarballPath(ziporg_path, repo))]
+        largeFiles = {}
+        buildZipFromTarballs(tarballs, zf_path, cfg._zip_compression_level, getZipWorkers(cfg), getRepoDirsExcludeFn(cfg, sp, excludeFn, largeFiles))
+        for repo, _ in tarballs:
+            recordExclusions(sp, repo, sp._repo_dirs_delete.get(repo, []), sorted(largeFiles.get(repo, [])))
+        if largeFiles != {}:
+            print(f"{prj._name}/{sp._name}: left out {sum(len(paths) for paths in largeFiles.values())} files over the clone blob limit")
+    else:
+        buildZip(ziporg_path, zf_path, cfg._zip_compression_level, getZipWorkers(cfg), excludeFn)
+    sp._code_sha1 = getFileSHA1(zf_path)
+    if sp._code_scan_excluded != {}:
+        print(f"{prj._name}/{sp._name}: left out {sum(sp._code_scan_excluded.values())} files under the scan-exclude policy")
 
     # and finally, remove the original unzipped directory
     util.retry_rmtree(ziporg_path)
@@ -68,11 +97,16 @@ def doZipRepoCodeForGerritSubproject(cfg, prj, sp):
         dashName = repo.replace("/", "-")
         dstFolder = os.path.join(ziporg_path, dashName)
         dotgit_path = os.path.join(dstFolder, ".git")
-        util.retry_rmtree(dotgit_path)
+        # code exported from a mirror or downloaded as a tarball has none
+        if os.path.exists(dotgit_path):
+            util.retry_rmtree(dotgit_path)
         # also remove its repo-dirs-delete, if any
         delete_dirs = sp._repo_dirs_delete.get(repo, [])
         for delete_dir in delete_dirs:
             delete_dir_path = os.path.join(ziporg_path, dashName, delete_dir)
+            # usually already left out when the code was retrieved
+            if not os.path.exists(delete_dir_path):
+                continue
             print(f"{prj._name}/{sp._name}: deleting {repo}:{delete_dir}")
             util.retry_rmtree(delete_dir_path)
 
@@ -86,16 +120,11 @@ def doZipRepoCodeForGerritSubproject(cfg, prj, sp):
     # now zip it all together
     zf_path = os.path.join(sp_path, f"{ziporg_path}-{sp._code_pulled}.zip")
     print(f"{prj._name}/{sp._name}: zipping into {zf_path}")
-    if os.path.exists(zf_path):
-        os.remove(zf_path)
-    zf = zipfile.ZipFile(zf_path, 'w', compression=zipfile.ZIP_DEFLATED)
-    for root, _, files in os.walk(ziporg_path):
-        for f in files:
-            fpath = os.path.join(root, f)
-            rpath = os.path.relpath(fpath, ziporg_path)
-            if not os.path.islink(fpath):
-                zf.write(fpath, arcname=rpath)
-    zf.close()
+    sp._code_scan_excluded = {}
+    buildZip(ziporg_path, zf_path, cfg._zip_compression_level, getZipWorkers(cfg), getScanExcludeFn(prj, sp._code_scan_excluded))
+    sp._code_sha1 = getFileSHA1(zf_path)
+    if sp._code_scan_excluded != {}:
+        print(f"{prj._name}/{sp._name}: left out {sum(sp._code_scan_excluded.values())} files under the scan-exclude policy")
 
     # and finally, remove the original unzipped directory
     util.retry_rmtree(ziporg_path)